@@ -0,0 +1,178 @@
+"""Static against adaptive flushing, in a simulation.
+
+Replays arrival patterns against a model of the handler's flush rules
+(flush on flush_limit or flush_interval after the first buffered line,
+max_concurrent_requests in flight, retries after a delay) and of the
+ingestion endpoint (a round trip time plus transfer time, and an error
+rate), on a simulated clock. Reports the requests made and how long lines
+took from being logged to being accepted, for the default static limits,
+static limits at the adaptive minimums, and adaptive flushing.
+
+    python -m benchmarks.bench_adaptive_batching
+"""
+import collections
+import heapq
+import itertools
+import random
+
+from logdna.adaptive import AdaptiveFlushPolicy
+from logdna.configs import defaults
+
+LINE_BYTES = 300
+CONCURRENCY = 10
+BANDWIDTH = 50 * 1024 * 1024  # bytes per second
+RETRY_DELAY_SECS = 1
+DURATION_SECS = 60
+
+
+def poisson(rng, rate, start, end):
+    now = start
+    while True:
+        now += rng.expovariate(rate)
+        if now >= end:
+            return
+        yield now
+
+
+def steady(rng):
+    return poisson(rng, 20, 0, DURATION_SECS)
+
+
+def bursty(rng):
+    # A quiet baseline with a one second burst every ten seconds
+    bursts = [
+        poisson(rng, 20000, start, start + 1)
+        for start in range(5, DURATION_SECS, 10)
+    ]
+    return sorted(itertools.chain(steady(rng), *bursts))
+
+
+def busy(rng):
+    return poisson(rng, 2000, 0, DURATION_SECS)
+
+
+# name: (arrivals, base round trip secs, error rate)
+SCENARIOS = collections.OrderedDict([
+    ('steady', (steady, 0.05, 0)),
+    ('bursty', (bursty, 0.05, 0)),
+    ('slow', (busy, 0.5, 0)),
+    ('failing', (busy, 0.05, 0.2)),
+])
+
+
+class Simulation():
+    def __init__(self, scenario, policy, seed=0):
+        self.arrivals, self.base_rtt, self.error_rate = SCENARIOS[scenario]
+        self.rng = random.Random(seed)
+        # Either (flush_limit, flush_interval) or an AdaptiveFlushPolicy
+        if isinstance(policy, tuple):
+            self.policy = None
+            self.flush_limit, self.flush_interval = policy
+        else:
+            self.policy = policy
+            self.flush_limit, self.flush_interval = policy.limits()
+
+        self.events = []
+        self.counter = itertools.count()
+        self.buffer = []  # arrival times of the buffered lines
+        self.timer = None
+        self.slots = CONCURRENCY
+        self.waiting = collections.deque()
+        self.latencies = []
+        self.requests = 0
+        self.limits = set()
+
+    def schedule(self, when, fn, *args):
+        heapq.heappush(self.events, (when, next(self.counter), fn, args))
+
+    def run(self):
+        for now in self.arrivals(self.rng):
+            self.run_until(now)
+            self.arrive(now)
+        self.run_until(float('inf'))
+        return self
+
+    def run_until(self, end):
+        while self.events and self.events[0][0] <= end:
+            when, _, fn, args = heapq.heappop(self.events)
+            fn(when, *args)
+
+    def arrive(self, now):
+        if self.policy:
+            self.policy.observe_arrival(LINE_BYTES, now)
+        self.buffer.append(now)
+        if len(self.buffer) * LINE_BYTES >= self.flush_limit:
+            self.flush(now)
+        elif self.timer is None:
+            self.timer = next(self.counter)
+            self.schedule(now + self.flush_interval, self.on_timer,
+                          self.timer)
+
+    def on_timer(self, now, timer):
+        if timer == self.timer:
+            self.flush(now)
+
+    def flush(self, now):
+        batch, self.buffer, self.timer = self.buffer, [], None
+        if self.policy:
+            self.flush_limit, self.flush_interval = self.policy.limits()
+            self.limits.add(self.flush_limit)
+        if batch:
+            self.send(now, batch)
+
+    def send(self, now, batch):
+        if not self.slots:
+            self.waiting.append(batch)
+            return
+        self.slots -= 1
+        self.requests += 1
+        rtt = self.base_rtt * self.rng.uniform(0.8, 1.2)
+        rtt += len(batch) * LINE_BYTES / BANDWIDTH
+        self.schedule(now + rtt, self.on_response, batch, rtt)
+
+    def on_response(self, now, batch, rtt):
+        self.slots += 1
+        ok = self.rng.random() >= self.error_rate
+        if self.policy:
+            self.policy.observe_request(rtt, ok)
+        if ok:
+            self.latencies.extend(now - logged for logged in batch)
+        else:
+            self.schedule(now + RETRY_DELAY_SECS, self.send, batch)
+        if self.waiting:
+            self.send(now, self.waiting.popleft())
+
+
+def adaptive_policy():
+    return AdaptiveFlushPolicy(
+        (defaults['ADAPTIVE_MIN_FLUSH_LIMIT'], defaults['FLUSH_LIMIT']),
+        (defaults['ADAPTIVE_MIN_FLUSH_INTERVAL_SECS'],
+         defaults['ADAPTIVE_MAX_FLUSH_INTERVAL_SECS']), CONCURRENCY,
+        defaults['ADAPTIVE_SMOOTHING_SECS'])
+
+
+def main():
+    policies = collections.OrderedDict([
+        ('default', lambda: (defaults['FLUSH_LIMIT'],
+                             defaults['FLUSH_INTERVAL_SECS'])),
+        ('small', lambda: (defaults['ADAPTIVE_MIN_FLUSH_LIMIT'],
+                           defaults['ADAPTIVE_MIN_FLUSH_INTERVAL_SECS'])),
+        ('adaptive', adaptive_policy),
+    ])
+    for scenario in SCENARIOS:
+        for name, make_policy in policies.items():
+            sim = Simulation(scenario, make_policy()).run()
+            latencies = sorted(sim.latencies)
+            p99 = latencies[int(len(latencies) * 0.99)]
+            print('%-8s %-8s lines=%6d requests=%5d lines/request=%7.1f '
+                  'latency mean=%.3fs p99=%.3fs flush_limit=%s' %
+                  (scenario, name, len(latencies), sim.requests,
+                   len(latencies) / sim.requests,
+                   sum(latencies) / len(latencies), p99,
+                   '%d-%d KiB' % (min(sim.limits) // 1024,
+                                  max(sim.limits) // 1024)
+                   if sim.limits else 'static'))
+
+
+if __name__ == '__main__':
+    main()
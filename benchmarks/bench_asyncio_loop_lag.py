@@ -0,0 +1,101 @@
+"""Event loop lag under high log volume, threaded vs asyncio handler.
+
+An asyncio application logs in bursts while a ticker task measures how
+late each 1ms sleep wakes up. Both handlers ship to the local ingestion
+stand-in, run in a child process so it does not compete for the GIL.
+
+    python -m benchmarks.bench_asyncio_loop_lag
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+
+from benchmarks.ingest_server import IngestServer
+from logdna import AsyncLogDNAHandler, LogDNAHandler
+
+DURATION_SECS = 3
+LINES_PER_TICK = (10, 100)
+TICK_SECS = 0.001
+
+
+async def measure(logger, lines_per_tick):
+    lags = []
+    emitted = 0
+    stop = time.perf_counter() + DURATION_SECS
+
+    async def ticker():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK_SECS)
+            lags.append(time.perf_counter() - start - TICK_SECS)
+
+    async def producer():
+        nonlocal emitted
+        while time.perf_counter() < stop:
+            for _ in range(lines_per_tick):
+                logger.info('request handled status=200 path=/api/v1/items')
+            emitted += lines_per_tick
+            await asyncio.sleep(TICK_SECS)
+
+    await asyncio.gather(ticker(), producer())
+    return sorted(lags), emitted
+
+
+def serve(conn):
+    with IngestServer() as server:
+        conn.send(server.url)
+        while conn.recv():
+            conn.send(server.lines)
+
+
+async def run(url, name, lines_per_tick):
+    options = {'url': url, 'hostname': 'benchmark', 'ip': '127.0.0.1'}
+    if name == 'asyncio':
+        handler = AsyncLogDNAHandler('benchmark', options)
+    else:
+        handler = LogDNAHandler('benchmark', options)
+    logger = logging.getLogger('bench.%s.%d' % (name, lines_per_tick))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    lags, emitted = await measure(logger, lines_per_tick)
+    if name == 'asyncio':
+        await handler.aclose()
+    else:
+        handler.close()
+    logger.removeHandler(handler)
+
+    return {
+        'emitted': emitted,
+        'p50_ms': lags[len(lags) // 2] * 1000,
+        'p99_ms': lags[int(len(lags) * 0.99)] * 1000,
+        'max_ms': lags[-1] * 1000
+    }
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child_conn, ))
+    server.start()
+    url = conn.recv()
+    delivered = 0
+    for lines_per_tick in LINES_PER_TICK:
+        for name in ('threaded', 'asyncio'):
+            result = asyncio.run(run(url, name, lines_per_tick))
+            conn.send(True)
+            lines = conn.recv()
+            print('lines/tick=%-3d %-8s emitted=%7d delivered=%7d '
+                  'lag p50=%6.3fms p99=%6.3fms max=%7.3fms' %
+                  (lines_per_tick, name, result['emitted'],
+                   lines - delivered, result['p50_ms'], result['p99_ms'],
+                   result['max_ms']))
+            delivered = lines
+    conn.send(False)
+    server.join()
+
+
+if __name__ == '__main__':
+    main()
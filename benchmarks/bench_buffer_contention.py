@@ -0,0 +1,72 @@
+"""Buffering throughput as threads are added, with and without
+buffer_shards.
+
+Each thread buffers its share of the lines straight into a LogDNAHandler
+whose requests are dropped, a line at a time (buffer_log_sync, the path
+taken when there is no ingestion queue) or in chunks (send_lines), and the
+lines buffered per second are reported, up to the flush that collects
+the last of them. Contention only shows on machines with several cores.
+
+    python -m benchmarks.bench_buffer_contention
+"""
+import logging
+import os
+import threading
+import time
+
+from logdna import LogDNAHandler
+
+LINES = 200000
+THREADS = (1, 2, 4, 8, 16, 32)
+SHARDS = (1, min(os.cpu_count() or 1, 8) * 2)
+
+
+def line_at_a_time(handler, count):
+    for i in range(count):
+        handler.buffer_log_sync({'line': 'record %d' % i, 'level': 'INFO'})
+
+
+def in_chunks(handler, count):
+    handler.send_lines('record %d' % i for i in range(count))
+
+
+MODES = (
+    ('line', line_at_a_time),
+    ('send_lines', in_chunks),
+)
+
+
+def run(mode, threads, shards):
+    handler = LogDNAHandler('benchmark', {
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1',
+        'buffer_shards': shards
+    })
+    handler.try_request = lambda *args, **kwargs: None
+    workers = [
+        threading.Thread(target=mode, args=(handler, LINES // threads))
+        for _ in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    handler.flush(timeout=60)
+    elapsed = time.perf_counter() - start
+    handler.close()
+    return LINES / elapsed
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for name, mode in MODES:
+        for threads in THREADS:
+            rates = [run(mode, threads, shards) for shards in SHARDS]
+            print('%-10s threads=%-3d %s' % (name, threads, ' '.join(
+                'shards=%-2d %8d lines/s' % (shards, rate)
+                for shards, rate in zip(SHARDS, rates))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Bytes on the wire and CPU per MB of typical log lines, per codec.
+
+    python -m benchmarks.bench_compression
+"""
+import json
+import logging
+import random
+import time
+
+from logdna import LogDNAHandler
+from logdna.buffer import LogBuffer, encode_message
+from logdna.utils import zstandard
+from benchmarks.ingest_server import IngestServer
+
+BATCHES = 20
+LINES_PER_BATCH = 5000
+
+CODECS = [(None, None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if zstandard is not None:
+    CODECS += [('zstd', 1), ('zstd', 3), ('zstd', 9)]
+
+
+def typical_line(i):
+    return {
+        'hostname': 'web-%02d' % (i % 16),
+        'timestamp': int(time.time() * 1000) + i,
+        'line': '%s GET /api/v1/items/%d %d %dms user=%s' % (
+            random.choice(['INFO', 'WARN', 'ERROR']),
+            random.randint(1, 10**6),
+            random.choice([200, 200, 200, 404, 500]),
+            random.randint(1, 900),
+            random.choice(['alice', 'bob', 'carol', 'dave'])),
+        'level': 'INFO',
+        'app': 'api',
+        'env': 'production',
+        'meta': json.dumps({
+            'name': 'api.views',
+            'pathname': '/srv/api/views.py',
+            'lineno': random.randint(1, 500),
+            'request_id': '%032x' % random.getrandbits(128)
+        })
+    }
+
+
+def run(server, batches, compression, level):
+    handler = LogDNAHandler('benchmark', {
+        'url': server.url,
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1',
+        'compression': compression,
+        'compression_level': level
+    })
+    raw = sent = 0
+    cpu = 0.0
+    for buf in batches:
+        raw += len(buf.payload())
+        start = time.process_time()
+        chunks, content_encoding = handler.stream_payload(buf)
+        body = b''.join(chunks)
+        cpu += time.process_time() - start
+        sent_before = server.bytes_received
+        handler.send_request(body, content_encoding)
+        sent += server.bytes_received - sent_before
+    handler.close()
+    return raw, sent, cpu
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    random.seed(0)
+    batches = [
+        LogBuffer(
+            encode_message(typical_line(i)) for i in range(LINES_PER_BATCH))
+        for _ in range(BATCHES)
+    ]
+    with IngestServer() as server:
+        for compression, level in CODECS:
+            raw, sent, cpu = run(server, batches, compression, level)
+            mb = raw / (1024 * 1024)
+            print('%-5s level=%-4s wire=%8.2fMB ratio=%5.2f cpu=%6.2fms/MB' %
+                  (compression or 'none', level, sent / (1024 * 1024),
+                   raw / sent, cpu * 1000 / mb))
+
+
+if __name__ == '__main__':
+    main()
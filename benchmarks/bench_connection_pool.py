@@ -0,0 +1,71 @@
+"""Handshakes per flush and flush latency, with and without pooling.
+
+    python -m benchmarks.bench_connection_pool
+"""
+import logging
+import statistics
+import time
+
+import requests
+
+from logdna import LogDNAHandler
+from logdna.buffer import LogBuffer, encode_message
+from benchmarks.ingest_server import IngestServer
+
+FLUSHES = 200
+LINES_PER_FLUSH = 100
+
+
+class UnpooledSession():
+    # Mimics the previous behaviour of calling the module-level
+    # requests.post, which opens a new connection for every flush.
+    def post(self, **kwargs):
+        return requests.post(**kwargs)
+
+    def close(self):
+        pass
+
+
+def run(server, pooled):
+    handler = LogDNAHandler('benchmark', {
+        'url': server.url,
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1'
+    })
+    if not pooled:
+        handler.session = UnpooledSession()
+    buf = LogBuffer(
+        encode_message({
+            'line': 'benchmark line %d' % i,
+            'timestamp': int(time.time() * 1000)
+        }) for i in range(LINES_PER_FLUSH))
+
+    connections = server.connections
+    latencies = []
+    for _ in range(FLUSHES):
+        start = time.perf_counter()
+        handler.send_request(buf)
+        latencies.append(time.perf_counter() - start)
+    handshakes = server.connections - connections
+    handler.close()
+
+    latencies.sort()
+    return {
+        'handshakes_per_flush': handshakes / FLUSHES,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    with IngestServer() as server:
+        for name, pooled in (('before', False), ('after', True)):
+            result = run(server, pooled)
+            print('%-6s handshakes/flush=%.2f p50=%.2fms p99=%.2fms' %
+                  (name, result['handshakes_per_flush'], result['p50_ms'],
+                   result['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""logger.info() cost on the calling thread, with and without
+defer_formatting.
+
+Logs through a logger with a LogDNAHandler whose consumer thread is
+running and whose requests are dropped, and reports the time spent in
+each logger.info() call: wall time, and CPU time of the calling thread
+alone (time.thread_time), which leaves out the consumer's work except
+for the GIL it holds. The baseline row logs to a NullHandler, for the cost
+of logging itself.
+
+    python -m benchmarks.bench_emit_deferred
+"""
+import logging
+import time
+
+from logdna import LogDNAHandler
+
+RECORDS = 50000
+
+CASES = (
+    ('plain', lambda log, i: log.info('request handled')),
+    ('args', lambda log, i: log.info('GET /items/%d took %.1f ms', i, 12.5)),
+    ('extra', lambda log, i: log.info('request handled',
+                                      extra={'user': 'u%d' % (i % 100),
+                                             'status': 200})),
+    ('mutable', lambda log, i: log.info('items %s', [i, i + 1])),
+)
+
+MODES = (
+    ('baseline', None),
+    ('eager', {}),
+    ('deferred', {'defer_formatting': True}),
+)
+
+
+def run(name, case, options):
+    if options is None:
+        handler = logging.NullHandler()
+    else:
+        handler = LogDNAHandler(
+            'benchmark',
+            dict(options,
+                 hostname='benchmark',
+                 ip='127.0.0.1',
+                 custom_fields=['user', 'status']))
+        handler.try_request = lambda *args, **kwargs: None
+    log = logging.getLogger('bench.%s' % name)
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(handler)
+
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    for i in range(RECORDS):
+        case(log, i)
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+
+    log.removeHandler(handler)
+    handler.close()
+    return elapsed / RECORDS * 1e6, cpu / RECORDS * 1e6
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for name, case in CASES:
+        for mode, options in MODES:
+            wall, cpu = run(name, case, options)
+            print('%-8s %-8s logger.info wall=%6.2fus cpu=%6.2fus' %
+                  (name, mode, wall, cpu))
+
+
+if __name__ == '__main__':
+    main()
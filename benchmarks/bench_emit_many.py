@@ -0,0 +1,83 @@
+"""Bulk logging cost: a per-record loop against emit_many() and send_lines().
+
+Hands the same records to a LogDNAHandler whose requests are dropped, one
+logger.info() or handler.handle() call at a time, all at once through
+emit_many(), and as plain lines through send_lines(), and reports the time
+spent in the calling thread per record and the time until every line has
+been buffered and handed off (flush(timeout)).
+
+    python -m benchmarks.bench_emit_many
+"""
+import logging
+import time
+
+from logdna import LogDNAHandler
+
+RECORDS = 100000
+
+
+def make_records():
+    return [
+        logging.LogRecord('bench', logging.INFO, __file__, 1, 'record %d',
+                          (i, ), None) for i in range(RECORDS)
+    ]
+
+
+def log_loop(handler, records):
+    log = logging.getLogger('bench.loop')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(handler)
+    for i in range(RECORDS):
+        log.info('record %d', i)
+    log.removeHandler(handler)
+
+
+def handle_loop(handler, records):
+    for record in records:
+        handler.handle(record)
+
+
+def emit_many(handler, records):
+    handler.emit_many(records)
+
+
+def send_lines(handler, records):
+    handler.send_lines('record %d' % i for i in range(RECORDS))
+
+
+MODES = (
+    ('logger.info', log_loop),
+    ('handle', handle_loop),
+    ('emit_many', emit_many),
+    ('send_lines', send_lines),
+)
+
+
+def run(mode, records):
+    handler = LogDNAHandler('benchmark', {
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1'
+    })
+    handler.try_request = lambda *args, **kwargs: None
+    start = time.perf_counter()
+    mode(handler, records)
+    emitted = time.perf_counter() - start
+    handler.flush(timeout=60)
+    buffered = time.perf_counter() - start
+    lines_in = handler.stats()['lines_in']
+    handler.close()
+    return emitted / RECORDS * 1e6, buffered, lines_in
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    records = make_records()
+    for name, mode in MODES:
+        per_record, buffered, lines_in = run(mode, records)
+        print('%-12s caller=%6.2fus/record buffered in %6.3fs lines=%d' %
+              (name, per_record, buffered, lines_in))
+
+
+if __name__ == '__main__':
+    main()
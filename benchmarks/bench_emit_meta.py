@@ -0,0 +1,87 @@
+"""emit() throughput with 0, 5 and 50 custom meta fields.
+
+Compares the single-pass sanitize_meta against the previous
+validate-then-encode implementation, with and without index_meta.
+
+    python -m benchmarks.bench_emit_meta
+"""
+import json
+import logging
+import time
+
+from unittest import mock
+
+from logdna import LogDNAHandler
+from logdna.utils import is_jsonable
+
+RECORDS = 20000
+FIELD_COUNTS = (0, 5, 50)
+
+
+def previous_sanitize_meta(meta, index_meta=False):
+    if not index_meta:
+        if is_jsonable(meta):
+            return json.dumps(meta)
+
+        return {
+            '__errors': 'Meta cannot be serialized into JSON-formatted string'
+        }
+
+    keys_to_sanitize = []
+    for key, value in meta.items():
+        if not is_jsonable(value):
+            keys_to_sanitize.append(key)
+    if keys_to_sanitize:
+        for key in keys_to_sanitize:
+            del meta[key]
+        meta['__errors'] = 'These keys have been sanitized: ' + ', '.join(
+            keys_to_sanitize)
+    return meta
+
+
+def make_records(fields):
+    extra = {
+        'field_%d' % i: {'id': i, 'value': 'value %d' % i}
+        for i in range(fields)
+    }
+    records = []
+    for i in range(RECORDS):
+        record = logging.LogRecord('bench', logging.INFO, __file__, i,
+                                   'line %d', (i, ), None)
+        record.__dict__.update(extra)
+        records.append(record)
+    return records, list(extra)
+
+
+def run(records, fields, index_meta):
+    handler = LogDNAHandler('benchmark', {
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1',
+        'index_meta': index_meta,
+        'custom_fields': fields
+    })
+    # Measure only the work done on the caller thread
+    handler.buffer_log = lambda message: None
+    start = time.perf_counter()
+    for record in records:
+        handler.emit(record)
+    elapsed = time.perf_counter() - start
+    handler.close()
+    return len(records) / elapsed
+
+
+def main():
+    for index_meta in (False, True):
+        for fields in FIELD_COUNTS:
+            records, names = make_records(fields)
+            with mock.patch('logdna.logdna.sanitize_meta',
+                            previous_sanitize_meta):
+                before = run(records, names, index_meta)
+            after = run(records, names, index_meta)
+            print('index_meta=%-5s fields=%-2d before=%8.0f/s '
+                  'after=%8.0f/s speedup=%.2fx' %
+                  (index_meta, fields, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""emit() cost with deduplication and rate limiting.
+
+Measures the work done on the calling thread per record, without and with
+dedup_window and rate_limit, for distinct messages (every record is
+looked up and let through) and for one message logged in a hot loop
+(every record after the first is collapsed or dropped before a message
+is built).
+
+    python -m benchmarks.bench_emit_throttle
+"""
+import logging
+import time
+
+from logdna import LogDNAHandler
+
+RECORDS = 50000
+
+CONFIGS = (
+    ('off', {}),
+    ('dedup', {'dedup_window': 60}),
+    ('rate_limit', {'rate_limit': 100}),
+    ('both', {'dedup_window': 60, 'rate_limit': 100}),
+)
+
+
+def make_records(distinct):
+    # Distinct messages differ in their template, repeated ones only in
+    # their arguments
+    records = []
+    for i in range(RECORDS):
+        if distinct:
+            msg, args = 'request %d failed: %%s' % i, ('timeout', )
+        else:
+            msg, args = 'request %s failed: %s', (i, 'timeout')
+        records.append(
+            logging.LogRecord('bench.%d' % (i % 10), logging.ERROR, __file__,
+                              1, msg, args, None))
+    return records
+
+
+def run(records, options):
+    handler = LogDNAHandler('benchmark', dict(options,
+                                              hostname='benchmark',
+                                              ip='127.0.0.1'))
+    sent = []
+    # Measure only the work done on the caller thread
+    handler.buffer_log = sent.append
+    start = time.perf_counter()
+    for record in records:
+        handler.emit(record)
+    elapsed = time.perf_counter() - start
+    handler.close()
+    return elapsed / len(records) * 1e6, len(sent)
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for name, distinct in (('distinct', True), ('repeated', False)):
+        records = make_records(distinct)
+        for config, options in CONFIGS:
+            per_record, sent = run(records, options)
+            print('%-8s %-10s emit=%6.2fus/record lines sent=%6d' %
+                  (name, config, per_record, sent))
+
+
+if __name__ == '__main__':
+    main()
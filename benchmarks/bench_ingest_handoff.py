@@ -0,0 +1,90 @@
+"""Emit-side latency and sustainable lines/s across producer threads.
+
+Compares the queue hand-off in buffer_log against the previous
+per-record thread pool submit. Flushes are replaced by a counting sink so
+only the path from emit into the buffer is measured.
+
+    python -m benchmarks.bench_ingest_handoff
+"""
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from logdna import LogDNAHandler
+
+LINES = 200000
+PRODUCERS = (1, 8, 32)
+
+
+def submit_per_record(handler):
+    # The previous buffer_log: one Future and queue put per record
+    pool = ThreadPoolExecutor()
+
+    def buffer_log(message):
+        pool.submit(handler.buffer_log_sync, message)
+
+    def close():
+        pool.shutdown(wait=True)
+
+    return buffer_log, close
+
+
+def run(producers, previous):
+    handler = LogDNAHandler('benchmark', {
+        'hostname': 'benchmark',
+        'ip': '127.0.0.1'
+    })
+    shipped = []
+    handler.try_request = lambda buf: shipped.append(len(buf))
+    close = handler.stop_log_consumer
+    if previous:
+        handler.buffer_log, close = submit_per_record(handler)
+
+    per_thread = LINES // producers
+    latencies = [[] for _ in range(producers)]
+
+    def produce(samples):
+        message = {'line': 'benchmark line', 'meta': '{}'}
+        for _ in range(per_thread):
+            start = time.perf_counter_ns()
+            handler.buffer_log(message)
+            samples.append(time.perf_counter_ns() - start)
+
+    threads = [
+        threading.Thread(target=produce, args=(samples, ))
+        for samples in latencies
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    close()
+    handler.close()
+    elapsed = time.perf_counter() - start
+
+    samples = sorted(sample for thread in latencies for sample in thread)
+    return {
+        'lines_per_sec': per_thread * producers / elapsed,
+        'p50_us': samples[len(samples) // 2] / 1000,
+        'p99_us': samples[int(len(samples) * 0.99)] / 1000,
+        'p999_us': samples[int(len(samples) * 0.999)] / 1000,
+        'shipped': sum(shipped)
+    }
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for producers in PRODUCERS:
+        for name, previous in (('before', True), ('after', False)):
+            result = run(producers, previous)
+            print('producers=%-2d %-6s lines/s=%9.0f p50=%6.2fus '
+                  'p99=%7.2fus p99.9=%8.2fus' %
+                  (producers, name, result['lines_per_sec'],
+                   result['p50_us'], result['p99_us'], result['p999_us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Threads and delivery time with many handlers, with and without a shared
+ShippingEngine.
+
+Attaches that many LogDNAHandlers, one per hostname, each logging its share
+of the records to a local IngestServer, and reports the threads running
+once every handler has flushed (leaving out the server's own) and the time
+until then.
+
+    python -m benchmarks.bench_many_handlers
+"""
+import logging
+import threading
+import time
+
+from benchmarks.ingest_server import IngestServer
+from logdna import LogDNAHandler, ShippingEngine
+
+RECORDS = 20000
+HANDLERS = (1, 10, 50, 100)
+
+
+def run(server, count, engine):
+    before = threading.active_count() - server.connections
+    handlers = [
+        LogDNAHandler(
+            'benchmark', {
+                'url': server.url,
+                'hostname': 'host%d' % i,
+                'ip': '127.0.0.1',
+                'index_meta': False,
+                'shared_engine': engine
+            }) for i in range(count)
+    ]
+    start = time.perf_counter()
+    for i in range(RECORDS):
+        handlers[i % count].handle(
+            logging.LogRecord('bench', logging.INFO, __file__, 1,
+                              'record %d', (i, ), None))
+    for handler in handlers:
+        handler.flush(timeout=60)
+    elapsed = time.perf_counter() - start
+    threads = threading.active_count() - server.connections - before
+    for handler in handlers:
+        handler.close()
+    return threads, elapsed
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for count in HANDLERS:
+        for name in ('own', 'engine'):
+            engine = ShippingEngine() if name == 'engine' else None
+            with IngestServer() as server:
+                threads, elapsed = run(server, count, engine)
+            if engine:
+                engine.shutdown()
+            print('handlers=%-4d %-7s threads=%-5d %.3fs' %
+                  (count, name, threads, elapsed))
+
+
+if __name__ == '__main__':
+    main()
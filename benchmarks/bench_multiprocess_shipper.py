@@ -0,0 +1,73 @@
+"""Connections and ingest requests for a fleet of worker processes.
+
+Each forked worker logs at a steady rate, either through its own
+LogDNAHandler or through a ForwardingLogDNAHandler to one LogShipper in
+the parent.
+
+    python -m benchmarks.bench_multiprocess_shipper
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks.ingest_server import IngestServer
+from logdna import ForwardingLogDNAHandler, LogDNAHandler, LogShipper
+
+WORKERS = 32
+LINES_PER_WORKER = 1000
+DURATION_SECS = 2
+
+options = {'hostname': 'benchmark', 'ip': '127.0.0.1'}
+
+
+def work(make_handler):
+    logger = logging.getLogger('bench.worker')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = make_handler()
+    logger.addHandler(handler)
+    pause = DURATION_SECS / LINES_PER_WORKER
+    for i in range(LINES_PER_WORKER):
+        logger.info('worker %d handled request %d', os.getpid(), i)
+        time.sleep(pause)
+    handler.close()
+
+
+def run(make_handler):
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=work, args=(make_handler, ))
+        for _ in range(WORKERS)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def main():
+    logging.getLogger('internal').disabled = True
+    for name in ('direct', 'shipper'):
+        with IngestServer() as server, tempfile.TemporaryDirectory() as tmp:
+            url_options = dict(options, url=server.url)
+            if name == 'direct':
+                elapsed = run(lambda: LogDNAHandler('benchmark', url_options))
+            else:
+                address = os.path.join(tmp, 'shipper.sock')
+                shipper = LogShipper('benchmark', address,
+                                     url_options).start()
+                elapsed = run(lambda: ForwardingLogDNAHandler(address))
+                shipper.close()
+            print('%-7s workers=%d lines=%6d connections=%4d requests=%5d '
+                  'lines/request=%7.1f elapsed=%.2fs' %
+                  (name, WORKERS, server.lines, server.connections,
+                   server.requests, server.lines / max(server.requests, 1),
+                   elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Time to import logdna and to construct a handler.
+
+Each measurement runs in a fresh interpreter, so that nothing has been
+imported yet, and the fastest of RUNS is reported to leave out noise from
+the machine. For comparison, the import is also timed with asyncio and
+requests imported along with it, as the package did before they were
+left to first use.
+
+    python -m benchmarks.bench_startup
+"""
+import json
+import os
+import subprocess
+import sys
+
+RUNS = 5
+HANDLERS = 100
+
+IMPORT = '''
+import json, time
+started = time.perf_counter()
+import logdna
+%s
+print(json.dumps(time.perf_counter() - started))
+'''
+
+CONSTRUCT = '''
+import json, time
+import logdna
+started = time.perf_counter()
+handlers = [logdna.LogDNAHandler('key') for _ in range(%d)]
+print(json.dumps((time.perf_counter() - started) / len(handlers)))
+for handler in handlers:
+    handler.close()
+'''
+
+
+def measure(script):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return min(
+        json.loads(
+            subprocess.check_output([sys.executable, '-c', script],
+                                    cwd=root)) for _ in range(RUNS))
+
+
+def main():
+    print('import logdna                      %7.1fms' %
+          (measure(IMPORT % '') * 1e3))
+    print('import logdna, asyncio, requests   %7.1fms' %
+          (measure(IMPORT % 'import asyncio, requests') * 1e3))
+    print('LogDNAHandler() x %-16d %7.3fms each' %
+          (HANDLERS, measure(CONSTRUCT % HANDLERS) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
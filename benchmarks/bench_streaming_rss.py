@@ -0,0 +1,113 @@
+"""Peak RSS of the sending process under sustained load.
+
+Compares building each flush payload in memory (before) with streaming
+it in chunks straight from the buffer (after), with 10 requests in
+flight against a slow ingestion stand-in. Each mode runs in a fresh
+process so both start from the same RSS.
+
+    python -m benchmarks.bench_streaming_rss
+"""
+import logging
+import multiprocessing
+import resource
+import threading
+import time
+
+from benchmarks.ingest_server import IngestServer
+from logdna import LogDNAHandler
+from logdna.buffer import LogBuffer, encode_message
+
+BATCHES = 50
+FLUSH_LIMIT = 2 * 1024 * 1024
+CONCURRENCY = 10
+LATENCY_SECS = 0.2
+
+
+def materialize_payload(handler):
+    # The whole payload as one bytes object and, when compressing, the
+    # compressed bytes as well
+    def stream_payload(buf):
+        return handler.compress_payload(buf.payload())
+
+    return stream_payload
+
+
+def peak_rss_mib():
+    # ru_maxrss carries over the parent's peak across exec on Linux, while
+    # VmHWM starts over with the new process image
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def send(url, streamed, compression, results):
+    logging.getLogger('internal').disabled = True
+    handler = LogDNAHandler(
+        'benchmark', {
+            'url': url,
+            'hostname': 'benchmark',
+            'ip': '127.0.0.1',
+            'compression': compression,
+            'max_concurrent_requests': CONCURRENCY
+        })
+    if not streamed:
+        handler.stream_payload = materialize_payload(handler)
+
+    # About 2 MiB per batch, the default flush limit
+    line = encode_message({
+        'line': 'x' * 200,
+        'hostname': 'benchmark',
+        'level': 'INFO',
+        'app': 'benchmark',
+        'env': '',
+        'meta': '{"name": "benchmark", "lineno": 1}',
+        'timestamp': int(time.time() * 1000)
+    })
+    baseline = peak_rss_mib()
+    slots = threading.Semaphore(CONCURRENCY)
+
+    def send_batch(batch):
+        try:
+            handler.try_request(batch)
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    for _ in range(BATCHES):
+        slots.acquire()
+        handler.request_thread_pool.submit(
+            send_batch, LogBuffer([line] * (FLUSH_LIMIT // len(line))))
+    handler.close()
+    results.put({
+        'baseline_mib': baseline,
+        'peak_mib': peak_rss_mib(),
+        'elapsed': time.perf_counter() - start
+    })
+
+
+def main():
+    context = multiprocessing.get_context('spawn')
+    with IngestServer(latency=LATENCY_SECS) as server:
+        for compression in (None, 'gzip'):
+            for name, streamed in (('before', False), ('after', True)):
+                results = context.Queue()
+                process = context.Process(target=send,
+                                          args=(server.url, streamed,
+                                                compression, results))
+                process.start()
+                result = results.get()
+                process.join()
+                print('compression=%-4s %-6s peak rss=%6.1f MiB '
+                      '(+%5.1f MiB over baseline) elapsed=%.2fs' %
+                      (compression or 'none', name, result['peak_mib'],
+                       result['peak_mib'] - result['baseline_mib'],
+                       result['elapsed']))
+
+
+if __name__ == '__main__':
+    main()
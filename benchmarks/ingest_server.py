@@ -0,0 +1,197 @@
+"""A local, in-process stand-in for the LogDNA ingestion endpoint."""
+import collections
+import gzip
+import json
+import math
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class IngestRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.record_connection()
+
+    def do_POST(self):
+        body = self.read_body()
+        decoded = self.decode_body(body)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, retry_after = self.server.next_status(decoded)
+        if status == 200:
+            hostname = parse_qs(urlsplit(self.path).query).get('hostname')
+            self.server.record_request(body, decoded,
+                                       self.headers.get('Content-Encoding'),
+                                       hostname and hostname[0])
+            self.respond(200, b'{"status":"ok"}')
+        else:
+            self.server.record_failure(status)
+            self.respond(status, b'{"error":"unavailable"}', retry_after)
+
+    def respond(self, status, payload, retry_after=None):
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def decode_body(self, body):
+        content_encoding = self.headers.get('Content-Encoding')
+        if content_encoding == 'gzip':
+            return gzip.decompress(body)
+        if content_encoding == 'zstd':
+            # Streamed frames do not record their content size up front
+            return zstandard.ZstdDecompressor().decompressobj().decompress(
+                body)
+        return body
+
+    def log_message(self, format, *args):
+        pass
+
+
+class IngestServer(ThreadingHTTPServer):
+    """
+        Accepts ingestion requests after latency seconds. Statuses queued
+        by fail_next(), with their Retry-After, are answered first. Bodies
+        longer than max_body_bytes once decoded are rejected with 413, and
+        batches with a line containing poison with 400. Past rate_limit
+        requests per second, requests are answered 429 with a Retry-After
+        header, and of the rest, error_rate of them at random are answered
+        503.
+
+        With track_delivery, delivery_latencies collects how long each
+        line took from its timestamp to being accepted, in milliseconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 rate_limit=None, track_delivery=False, seed=None,
+                 max_body_bytes=None, poison=None):
+        ThreadingHTTPServer.__init__(self, (host, port), IngestRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_body_bytes = max_body_bytes
+        self.poison = poison
+        self._random = random.Random(seed)
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.lines = 0
+        self.lines_by_host = collections.Counter()
+        self.bytes_received = 0
+        self.failures = 0
+        self.throttled = 0
+        self.delivery_latencies = [] if track_delivery else None
+        self.statuses = []
+        self.last_body = None
+        self.last_encoding = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/logs/ingest' % self.server_address[:2]
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def fail_next(self, count, status=503, retry_after=None):
+        with self._lock:
+            self.statuses.extend([(status, retry_after)] * count)
+
+    def next_status(self, decoded=b''):
+        """(status, Retry-After seconds or None) for a decoded body"""
+        with self._lock:
+            if self.statuses:
+                return self.statuses.pop(0)
+            if self.max_body_bytes and len(decoded) > self.max_body_bytes:
+                return 413, None
+            if self.poison and any(
+                    self.poison in str(line.get('line'))
+                    for line in json.loads(decoded)['ls']):
+                return 400, None
+            if self.rate_limit:
+                wait = self.take_token()
+                if wait:
+                    return 429, math.ceil(wait)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 503, None
+            return 200, None
+
+    def take_token(self):
+        # A bucket of one second's worth of requests. Returns the seconds
+        # until the next token when it is empty
+        now = time.monotonic()
+        self._tokens = min(
+            self.rate_limit,
+            self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate_limit
+
+    def record_failure(self, status):
+        with self._lock:
+            self.failures += 1
+            if status == 429:
+                self.throttled += 1
+
+    def record_request(self, body, decoded, content_encoding=None,
+                       hostname=None):
+        payload = json.loads(decoded)
+        with self._lock:
+            self.requests += 1
+            self.lines += len(payload['ls'])
+            self.lines_by_host[hostname] += len(payload['ls'])
+            self.bytes_received += len(body)
+            self.last_body = payload
+            self.last_encoding = content_encoding
+            if self.delivery_latencies is not None:
+                now = time.time() * 1000
+                self.delivery_latencies.extend(
+                    now - line['timestamp'] for line in payload['ls']
+                    if 'timestamp' in line)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
@@ -0,0 +1,235 @@
+"""End-to-end benchmarks of the shipping pipeline, as JSON.
+
+Each scenario logs through a LogDNAHandler in a fresh process, against an
+IngestServer in this one with the scenario's latency, error rate and
+request rate limit, and reports:
+
+* emit: records logged per second, and the time spent in each
+  logger.info() call on the calling thread (microseconds)
+* delivery: the time from logging a line to the server accepting it
+  (milliseconds)
+* peak_rss_mib and max_threads of the logging process
+* lines delivered and lost, with the handler's own stats(), and how
+  close(timeout) went
+
+Results are one JSON document, with the commit and platform they were
+taken on, so that runs can be compared across commits:
+
+    python -m benchmarks.suite > before.json
+    python -m benchmarks.suite --compare before.json
+    python -m benchmarks.suite steady errors --output errors.json
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.bench_streaming_rss import peak_rss_mib
+from benchmarks.ingest_server import IngestServer
+from logdna import LogDNAHandler
+
+CLOSE_TIMEOUT_SECS = 30
+
+# name: records, producer threads, records per second per producer (None
+# for as fast as possible), IngestServer options and handler options
+SCENARIOS = collections.OrderedDict([
+    ('burst', (100000, 4, None, {'latency': 0.01}, {})),
+    ('steady', (20000, 1, 5000, {'latency': 0.02}, {})),
+    ('slow', (20000, 1, 5000, {'latency': 0.5}, {})),
+    ('errors', (20000, 1, 5000, {
+        'latency': 0.02,
+        'error_rate': 0.2
+    }, {
+        'flush_limit': 64 * 1024,
+        'retry_interval_secs': 0.5
+    })),
+    ('throttled', (20000, 1, 5000, {
+        'latency': 0.02,
+        'rate_limit': 5
+    }, {
+        'flush_limit': 64 * 1024,
+        'retry_interval_secs': 0.5
+    })),
+    ('overload', (100000, 4, None, {
+        'latency': 1
+    }, {
+        'buf_retention_limit': 1024 * 1024,
+        'max_concurrent_requests': 2
+    })),
+])
+
+
+def percentiles(samples, scale=1):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {
+        'p50': samples[len(samples) // 2] * scale,
+        'p99': samples[int(len(samples) * 0.99)] * scale,
+        'max': samples[-1] * scale
+    }
+
+
+def produce(log, count, rate, samples):
+    started = time.perf_counter()
+    for i in range(count):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.perf_counter_ns()
+        log.info('record %d', i)
+        samples.append(time.perf_counter_ns() - start)
+
+
+def sample_threads(stop, counts):
+    # Leave this thread out of the count
+    while not stop.wait(0.01):
+        counts.append(threading.active_count() - 1)
+
+
+def log_scenario(url, scenario, results):
+    records, producers, rate, _, options = SCENARIOS[scenario]
+    logging.getLogger('internal').disabled = True
+    handler = LogDNAHandler(
+        'benchmark',
+        dict(options, url=url, hostname='benchmark', ip='127.0.0.1'))
+    log = logging.getLogger('benchmark')
+    log.propagate = False
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    stop = threading.Event()
+    thread_counts = [threading.active_count()]
+    sampler = threading.Thread(target=sample_threads,
+                               args=(stop, thread_counts))
+    sampler.start()
+
+    samples = [[] for _ in range(producers)]
+    threads = [
+        threading.Thread(target=produce,
+                         args=(log, records // producers, rate, produced))
+        for produced in samples
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    emitted = time.perf_counter() - started
+
+    closed = handler.close(timeout=CLOSE_TIMEOUT_SECS)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+
+    stats = handler.stats()
+    latencies = [sample for produced in samples for sample in produced]
+    results.put({
+        'records': len(latencies),
+        'emit_records_per_sec': len(latencies) / emitted,
+        'emit_us': percentiles(latencies, 1e-3),
+        'elapsed_secs': elapsed,
+        'peak_rss_mib': peak_rss_mib(),
+        'max_threads': max(thread_counts),
+        'lines_lost': sum(stats['lines_dropped'].values()) +
+        sum(stats['lines_discarded'].values()),
+        'close': closed,
+        'stats': stats
+    })
+
+
+def run(scenario):
+    _, _, _, server_options, _ = SCENARIOS[scenario]
+    context = multiprocessing.get_context('spawn')
+    with IngestServer(track_delivery=True, seed=0,
+                      **server_options) as server:
+        results = context.Queue()
+        process = context.Process(target=log_scenario,
+                                  args=(server.url, scenario, results))
+        process.start()
+        result = results.get()
+        process.join()
+        result.update({
+            'delivered': server.lines,
+            'delivery_ms': percentiles(server.delivery_latencies),
+            'requests': server.requests + server.failures,
+            'requests_failed': server.failures,
+            'requests_throttled': server.throttled
+        })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=''):
+    # {'emit_us': {'p50': 1}} -> {'emit_us.p50': 1}, numbers only
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, '%s%s.' % (prefix, key))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + str(key), value
+
+
+def compare(before, after):
+    for scenario, result in after['scenarios'].items():
+        previous = dict(flatten(before['scenarios'].get(scenario, {})))
+        for metric, value in flatten(result):
+            if metric.startswith('stats.') or metric not in previous:
+                continue
+            old = previous[metric]
+            change = (value - old) / old * 100 if old else 0
+            print('%-10s %-28s %12.2f -> %12.2f %+7.1f%%' %
+                  (scenario, metric, old, value, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios',
+                        nargs='*',
+                        help='scenarios to run, all by default: %s' %
+                        ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='print the change from the results in this file')
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario: %s' % scenario)
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scenarios': {}
+    }
+    for scenario in args.scenarios or SCENARIOS:
+        results['scenarios'][scenario] = run(scenario)
+
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(encoded + '\n')
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), results)
+    elif not args.output:
+        sys.stdout.write(encoded + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,24 @@
+import logging.handlers
+
+from .engine import ShippingEngine
 from .logdna import LogDNAHandler
-__all__ = ['LogDNAHandler']
+from .shipper import ForwardingLogDNAHandler, LogShipper
+__all__ = [
+    'LogDNAHandler', 'AsyncLogDNAHandler', 'ForwardingLogDNAHandler',
+    'LogShipper', 'ShippingEngine'
+]
+
+
+# AsyncLogDNAHandler is imported on first use, as importing asyncio takes
+# longer than the rest of the package.
+def __getattr__(name):
+    if name == 'AsyncLogDNAHandler':
+        from .aio import AsyncLogDNAHandler
+        return AsyncLogDNAHandler
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
-# Publish this class to the "logging.handlers" module so that it can be use
-# from a logging config file via logging.config.fileConfig().
-import logging.handlers
 
+# Publish these classes to the "logging.handlers" module so that they can be
+# used from a logging config file via logging.config.fileConfig().
 logging.handlers.LogDNAHandler = LogDNAHandler
+logging.handlers.ForwardingLogDNAHandler = ForwardingLogDNAHandler
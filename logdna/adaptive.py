@@ -0,0 +1,90 @@
+import math
+
+# How often the arrival rate is sampled
+ARRIVAL_WINDOW_SECS = 0.1
+# Weight of each request in the round trip time and error rate averages
+REQUEST_WEIGHT = 0.2
+# Share of the concurrent requests that batches are sized to keep busy
+TARGET_UTILIZATION = 0.5
+# How much larger batches and intervals get when every request fails
+ERROR_BACKOFF = 4
+# Granularity of flush_limit, so that it does not change on every batch
+LIMIT_STEP = 4 * 1024
+
+
+def clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+class AdaptiveFlushPolicy():
+    """
+        Picks flush_limit and flush_interval within bounds from moving
+        averages of the rate log bytes arrive at, the ingestion round trip
+        time and the request error rate.
+
+        Batches are sized so that, at the current arrival rate, sending
+        them keeps about half of the concurrent requests busy and goes no
+        more often than every min_interval: small batches while lines
+        trickle in, larger ones in bursts or when ingestion slows down. The
+        interval stays at its minimum for freshness unless round trips are
+        too long to keep up with it. Both back off while requests fail.
+
+        Observations come from several threads without a lock; an
+        occasional lost sample does not matter to the averages.
+    """
+    def __init__(self, limit_bounds, interval_bounds, concurrency,
+                 smoothing_secs):
+        self.min_limit, self.max_limit = limit_bounds
+        self.min_interval, self.max_interval = interval_bounds
+        self.concurrency = concurrency
+        self.smoothing_secs = smoothing_secs
+
+        self.arrival_rate = 0.0  # bytes per second
+        self.rtt = 0.0
+        self.error_rate = 0.0
+        self._window_start = None
+        self._window_bytes = 0
+
+    def observe_arrival(self, size, now):
+        if self._window_start is None:
+            self._window_start = now
+        self._window_bytes += size
+        elapsed = now - self._window_start
+        if elapsed >= ARRIVAL_WINDOW_SECS:
+            # Weigh the sample by how long it covers, so that a quiet spell
+            # brings the rate down at once
+            alpha = 1 - math.exp(-elapsed / self.smoothing_secs)
+            rate = self._window_bytes / elapsed
+            self.arrival_rate += alpha * (rate - self.arrival_rate)
+            self._window_start = now
+            self._window_bytes = 0
+
+    def observe_request(self, latency, ok):
+        """latency is None for requests that failed without a response"""
+        if latency is not None:
+            self.rtt += REQUEST_WEIGHT * (latency - self.rtt)
+        self.error_rate += REQUEST_WEIGHT * ((0 if ok else 1) -
+                                             self.error_rate)
+
+    def limits(self):
+        """(flush_limit, flush_interval) for what has been observed"""
+        backoff = 1 + ERROR_BACKOFF * self.error_rate
+        rate = self.arrival_rate
+        limit = max(rate * self.min_interval,
+                    rate * self.rtt /
+                    (self.concurrency * TARGET_UTILIZATION)) * backoff
+        limit = clamp(int(limit) // LIMIT_STEP * LIMIT_STEP, self.min_limit,
+                      self.max_limit)
+
+        interval = max(self.min_interval,
+                       self.rtt / self.concurrency) * backoff
+        interval = clamp(round(interval, 2), self.min_interval,
+                         self.max_interval)
+        return limit, interval
+
+    def state(self):
+        return {
+            'arrival_rate': self.arrival_rate,
+            'rtt': self.rtt,
+            'error_rate': self.error_rate
+        }
@@ -0,0 +1,487 @@
+import asyncio
+import logging
+import random
+import ssl
+import time
+
+from urllib.parse import urlencode, urlsplit
+
+from .buffer import encode_message, level_number
+from .logdna import LogDNAHandler
+
+# How long close() gives the loop to cancel the batches still being sent
+# once its timeout has run out
+CANCEL_WAIT_SECS = 0.1
+
+
+class AsyncHTTPClient():
+    """
+        A minimal HTTP/1.1 client on asyncio streams that keeps a small pool
+        of keep-alive connections to a single ingestion endpoint.
+    """
+    def __init__(self, url, max_connections, idle_timeout_secs):
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if secure else 80)
+        self.path = parts.path or '/'
+        self.host_header = parts.netloc.rsplit('@', 1)[-1]
+        self.ssl = ssl.create_default_context() if secure else None
+        self.max_connections = max_connections
+        self.idle_timeout_secs = idle_timeout_secs
+        self._idle = []
+
+    def build_request(self, params, headers, body):
+        query = urlencode([(key, value) for key, value in params.items()
+                           if value is not None],
+                          doseq=True)
+        lines = [
+            'POST %s?%s HTTP/1.1' % (self.path, query),
+            'Host: %s' % self.host_header,
+            'Content-Length: %d' % len(body),
+            'Connection: keep-alive'
+        ]
+        lines += [
+            '%s: %s' % (name, value) for name, value in headers.items()
+            if value is not None
+        ]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    async def post(self, params, headers, body):
+        """Returns (status_code, reason, headers, body)"""
+        request = self.build_request(params, headers, body)
+        conn, reused = await self._acquire()
+        try:
+            return await self._send(conn, request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The server may have dropped an idle connection; retry once
+            # on a fresh one, but not if the connection was just opened.
+            if not reused:
+                raise
+        return await self._send(await self._connect(), request)
+
+    async def _acquire(self):
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if (now - last_used < self.idle_timeout_secs
+                    and not reader.at_eof() and not writer.is_closing()):
+                return (reader, writer), True
+            writer.close()
+        return await self._connect(), False
+
+    async def _connect(self):
+        return await asyncio.open_connection(self.host, self.port,
+                                             ssl=self.ssl)
+
+    async def _send(self, conn, request):
+        reader, writer = conn
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_code, reason, headers, body = await self._read_response(
+                reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if keep_alive and len(self._idle) < self.max_connections:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        return status_code, reason, headers, body
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        parts = status_line.decode('iso-8859-1').rstrip('\r\n').split(' ', 2)
+        status_code = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('iso-8859-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            # Read to the end; the connection cannot be reused
+            headers['connection'] = 'close'
+        return status_code, reason, headers, body
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        # Skip any trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class AsyncLogDNAHandler(LogDNAHandler):
+    """
+        A LogDNAHandler for asyncio applications. Lines are batched and sent
+        on the running event loop with the same message format and response
+        handling as LogDNAHandler, without thread pools or blocking I/O.
+
+        emit() never blocks the loop and may be called from any thread.
+        Await aflush() or aclose() to wait for delivery. Redirects are not
+        followed. The spool_dir option is not supported, and the block
+        overflow policy drops the newest lines instead of waiting.
+    """
+    def __init__(self, key, options={}):
+        LogDNAHandler.__init__(self, key, dict(options, spool_dir=None))
+        self.loop = options.get('loop', None)
+        self.client = AsyncHTTPClient(self.url, self.max_concurrent_requests,
+                                      self.pool_idle_timeout_secs)
+        self._flush_handle = None
+        self._slots = None
+        self._sending = 0
+        self._tasks = set()
+
+    def make_request_thread_pool(self):
+        return None
+
+    def after_fork(self):
+        LogDNAHandler.after_fork(self)
+        # The event loop and its connections belong to the parent
+        self.loop = None
+        self.client = AsyncHTTPClient(self.url, self.max_concurrent_requests,
+                                      self.pool_idle_timeout_secs)
+        self._flush_handle = None
+        self._slots = None
+        self._sending = 0
+        self._tasks = set()
+
+    def get_loop(self):
+        if self.loop is not None and self.loop.is_closed():
+            self.loop = None
+        if self.loop is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+        return self.loop
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def emit(self, record):
+        try:
+            LogDNAHandler.emit(self, record)
+        except Exception:
+            self.handleError(record)
+
+    def emit_message(self, message):
+        loop = self.get_loop()
+        if loop is None:
+            # Hold the line until a loop is available to send it
+            self.buffer_message(message)
+        elif self.in_loop():
+            self.buffer_log_async(message)
+        else:
+            loop.call_soon_threadsafe(self.buffer_log_async, message)
+
+    def buffer_chunk(self, messages):
+        loop = self.get_loop()
+        if loop is None:
+            for message in messages:
+                self.buffer_message(message)
+        elif self.in_loop():
+            self.buffer_logs_async(messages)
+        else:
+            loop.call_soon_threadsafe(self.buffer_logs_async, messages)
+
+    def buffer_message(self, message):
+        if isinstance(message, logging.LogRecord):
+            message = self.build_captured(message)
+            if message is None:
+                return
+        line = encode_message(message)
+        level = level_number(message.get('level'))
+        self._stats.incr('lines_in')
+        if self.max_line_bytes:
+            line = self.fit_line(line)
+            if line is None:
+                return
+        if self.flush_policy:
+            self.flush_policy.observe_arrival(len(line), time.monotonic())
+        with self._lock:
+            retained = self.buf.size_with(line)
+            if (retained < self.overflow_threshold
+                    or self.make_room(line, level, retained)):
+                self.buf.append(line, level)
+            else:
+                self.shed_lines({level: 1})
+
+    def wait_for_room(self, line):
+        # Never block the loop; the block policy drops the newest lines
+        pass
+
+    def buffer_log_async(self, message):
+        self.buffer_logs_async([message])
+
+    def buffer_logs_async(self, messages):
+        for message in messages:
+            self.buffer_message(message)
+            if self.buf.size >= self.flush_limit:
+                self.flush_async()
+        if self.buf and self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(
+                self.flush_interval_secs, self.flush_async)
+
+    def flush_async(self):
+        """Start sending the buffer. Must be called on the loop"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        with self._lock:
+            buf = self.take_buffer()
+        if buf:
+            for part in self.partition_batch(buf):
+                self._stats.incr('batches')
+                self._stats.observe('batch_bytes', part.size)
+                self.start_batch(part)
+
+    def start_batch(self, buf):
+        task = self.loop.create_task(self.send_batch(buf))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def send_split(self, buf):
+        # Called on the loop, from send_request_async
+        self.start_batch(buf)
+
+    def flush(self, timeout=None):
+        """
+            Start sending the buffer. With a timeout, returns a report like
+            LogDNAHandler.flush(timeout), after waiting up to timeout seconds
+            for everything to be sent when called off the loop.
+        """
+        totals = self._stats.totals()
+        loop = self.get_loop()
+        if loop is None:
+            flushed = not self.buf
+        elif self.in_loop():
+            self.flush_async()
+            flushed = not self._tasks
+        elif timeout is not None:
+            flushed = self.wait_for_loop(self.aflush(), timeout)
+        else:
+            try:
+                loop.call_soon_threadsafe(self.flush_async)
+            except RuntimeError:
+                pass
+        if timeout is not None:
+            return self.flush_report(totals, flushed)
+
+    def wait_for_loop(self, coro, timeout):
+        # True if coro completed within timeout
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            future.result(timeout)
+            return True
+        except Exception as e:
+            self.internalLogger.debug('Error waiting for %s: %s', coro, e)
+            future.cancel()
+            return False
+
+    def batches_pending(self):
+        return len(self._tasks)
+
+    async def aflush(self):
+        """Send everything buffered so far and wait for it to complete"""
+        self.get_loop()
+        if self.throttling:
+            self.report_throttle(float('inf'))
+        self.flush_async()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def aclose(self):
+        totals = self._stats.totals()
+        await self.aflush()
+        self.client.close()
+        logging.Handler.close(self)
+        return self.flush_report(totals, True)
+
+    def close(self, timeout=None):
+        """
+            Send what is left and stop. Off the loop, waits up to timeout
+            seconds, request_timeout by default, then cancels the batches
+            still being sent and counts them as dropped. On the loop, which
+            cannot be blocked, delivery goes on in the background. Returns a
+            report like LogDNAHandler.close(timeout).
+        """
+        totals = self._stats.totals()
+        loop = self.loop
+        flushed = True
+        if loop is not None and loop.is_running():
+            if self.in_loop():
+                if self.throttling:
+                    self.report_throttle(float('inf'))
+                self.flush_async()
+                flushed = not self._tasks
+            else:
+                if timeout is None:
+                    timeout = self.request_timeout
+                flushed = self.wait_for_loop(self.aflush(), timeout)
+                if not flushed:
+                    self.wait_for_loop(self.cancel_batches(),
+                                       CANCEL_WAIT_SECS)
+        elif self.buf:
+            # Without a running loop, the lines buffered cannot be sent
+            flushed = False
+            with self._lock:
+                buf = self.take_buffer()
+            self.record_discard(len(buf), 'shutdown')
+        self.client.close()
+        logging.Handler.close(self)
+        return self.flush_report(totals, flushed)
+
+    async def cancel_batches(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def encode_payload_async(self, buf):
+        body = buf.payload()
+        if self.compression and buf.size >= self.compression_threshold:
+            # Compression is CPU bound; keep it off the loop
+            return await self.loop.run_in_executor(None,
+                                                   self.compress_payload,
+                                                   body)
+        return body, None
+
+    async def send_batch(self, buf):
+        # A batch cancelled by close() before it was sent or given up on is
+        # counted as dropped
+        settled = False
+        try:
+            settled = await self.attempt_batch(buf)
+        except asyncio.CancelledError:
+            if not settled:
+                self.record_discard(len(buf), 'shutdown')
+            raise
+
+    async def attempt_batch(self, buf):
+        if self._slots is None:
+            self._slots = asyncio.Condition()
+
+        data, content_encoding = await self.encode_payload_async(buf)
+        for attempt in range(1, self.max_retry_attempts + 1):
+            await self.wait_for_pause()
+            await self.wait_for_circuit()
+            await self.acquire_slot()
+            try:
+                if await self.send_request_async(data, content_encoding,
+                                                 len(buf), buf):
+                    return True
+            finally:
+                await self.release_slot()
+            if attempt < self.max_retry_attempts:
+                # A Retry-After pause stands in for the exponential backoff
+                delay = (self.pacer.pause_remaining(time.monotonic())
+                         or self.retry_interval_secs * (1 << (attempt - 1)))
+                delay += random.uniform(0, self.max_retry_jitter)
+                self.record_retry(attempt, delay, len(buf))
+                await asyncio.sleep(delay)
+
+        self.internalLogger.debug(
+            'Flush exceeded %s tries. Discarding flush buffer',
+            self.max_retry_attempts)
+        self.record_discard(len(buf), 'retries')
+        return True
+
+    async def acquire_slot(self):
+        # At most the pacer's limit of requests at once
+        async with self._slots:
+            await self._slots.wait_for(
+                lambda: self._sending < int(self.pacer.limit))
+            self._sending += 1
+
+    async def release_slot(self):
+        async with self._slots:
+            self._sending -= 1
+            self._slots.notify_all()
+
+    async def wait_for_pause(self):
+        # Every batch waits out a Retry-After pause, without counting an
+        # attempt
+        pause = self.pacer.pause_remaining(time.monotonic())
+        while pause:
+            await asyncio.sleep(pause +
+                                random.uniform(0, self.max_retry_jitter))
+            pause = self.pacer.pause_remaining(time.monotonic())
+
+    async def wait_for_circuit(self):
+        # While the circuit is open, batches wait in their tasks without
+        # counting an attempt, and check again when a probe is due or has
+        # had time to finish
+        while self.breaker and not self.breaker.allow(time.monotonic()):
+            await asyncio.sleep(
+                self.breaker.remaining(time.monotonic())
+                or self.flush_interval_secs)
+
+    def schedule_release(self):
+        # Batches are not parked; they wait in wait_for_circuit()
+        pass
+
+    async def send_request_async(self, data, content_encoding=None, lines=0,
+                                 buf=None):
+        """
+            Send pre-encoded log data to LogDNA server. buf is the batch it
+            was encoded from, split in halves if it is rejected
+        Returns:
+            True  - discard flush buffer
+            False - retry, keep flush buffer
+        """
+        try:
+            started = time.monotonic()
+            status_code, reason, headers, body = await asyncio.wait_for(
+                self.client.post(self.request_params(),
+                                 self.request_headers(content_encoding),
+                                 data), self.request_timeout)
+            discard = self.handle_response(
+                status_code, reason, lambda: body.decode('utf-8', 'replace'))
+            split = self.split_rejected(buf, status_code)
+            self.record_response(status_code, discard and not split,
+                                 time.monotonic() - started, len(data), lines,
+                                 headers.get('retry-after'))
+            return discard
+
+        except asyncio.TimeoutError as timeout:
+            self.internalLogger.debug('Timeout Error: %s. Retrying...',
+                                      timeout)
+            self.record_request_error('timeout')
+            return False  # retry
+
+        except (OSError, ValueError, asyncio.IncompleteReadError) as exception:
+            self.internalLogger.debug(
+                'Error sending logs %s. Discarding flush buffer', exception)
+            self.record_request_error('connection')
+            self.record_discard(lines, 'error')
+
+        return True  # discard
@@ -0,0 +1,73 @@
+import threading
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker():
+    """
+        Stops requests to an ingestion endpoint that keeps failing.
+
+        While closed, every request goes out, and threshold consecutive
+        failures open the circuit. While open, none does. Once reset_secs
+        have passed it is half open: allow() lets a single probe request
+        through, which closes the circuit if it succeeds and opens it
+        again if it fails. Thread-safe.
+    """
+    def __init__(self, threshold, reset_secs):
+        self.threshold = threshold
+        self.reset_secs = reset_secs
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self, now):
+        """Whether a request may go out now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now >= self.opened_at + self.reset_secs:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def cancel_probe(self):
+        """The request allow() let through was not sent after all"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok, now):
+        """
+            Count the outcome of a request.
+        Returns:
+            the state the circuit changed to, or None
+        """
+        with self._lock:
+            if ok:
+                self.failures = 0
+                if self.state == CLOSED:
+                    return None
+                self.state = CLOSED
+                self._probing = False
+                return CLOSED
+
+            self.failures += 1
+            if (self.state == HALF_OPEN
+                    or (self.state == CLOSED
+                        and self.failures >= self.threshold)):
+                self.state = OPEN
+                self.opened_at = now
+                self._probing = False
+                return OPEN
+            return None
+
+    def remaining(self, now):
+        """Seconds until a probe may go out; 0 unless the circuit is open"""
+        if self.state != OPEN:
+            return 0
+        return max(0, self.opened_at + self.reset_secs - now)
@@ -0,0 +1,232 @@
+import json
+import logging
+import threading
+
+from array import array
+
+PAYLOAD_PREFIX = b'{"e":"ls","ls":['
+PAYLOAD_SUFFIX = b']}'
+PAYLOAD_OVERHEAD = len(PAYLOAD_PREFIX) + len(PAYLOAD_SUFFIX)
+LEVEL_KEY = b'"level": "'
+TRUNCATED = ' [truncated]'
+
+_level_numbers = {}
+
+
+def encode_message(message):
+    return json.dumps(message).encode('utf-8')
+
+
+def level_number(name):
+    """The logging level of a level name; INFO for unknown names"""
+    try:
+        return _level_numbers[name]
+    except KeyError:
+        pass
+    number = logging.getLevelName(str(name).upper())
+    if not isinstance(number, int):
+        number = logging.INFO
+    number = max(0, min(number, 0xffff))
+    if len(_level_numbers) < 256:
+        _level_numbers[name] = number
+    return number
+
+
+def truncate_line(line, max_bytes):
+    """
+        line, encoded by encode_message, cut down to at most max_bytes by
+        shortening the text of its message. None if that is not enough.
+    """
+    try:
+        message = json.loads(line)
+        text = message['line']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(text, str):
+        return None
+
+    def encode(keep):
+        return encode_message(dict(message, line=text[:keep] + TRUNCATED))
+
+    # The longest prefix of the text that fits
+    low, high = 0, len(text)
+    fitted = encode(0)
+    if len(fitted) > max_bytes:
+        return None
+    while low < high:
+        keep = (low + high + 1) // 2
+        encoded = encode(keep)
+        if len(encoded) <= max_bytes:
+            low, fitted = keep, encoded
+        else:
+            high = keep - 1
+    return fitted
+
+
+def line_level(line):
+    """The logging level of a line encoded by encode_message"""
+    # Quotes within strings are escaped, so the first match is the key
+    start = line.find(LEVEL_KEY)
+    if start < 0:
+        return logging.INFO
+    start += len(LEVEL_KEY)
+    return level_number(line[start:line.find(b'"', start)].decode(
+        'utf-8', 'replace'))
+
+
+class LogBuffer():
+    """
+        Lines encoded to JSON once, as they are buffered, and kept comma
+        separated in a single bytearray, so that the flush payload is just
+        the buffer between PAYLOAD_PREFIX and PAYLOAD_SUFFIX. size is the
+        exact number of bytes that adds to the payload. The logging level of
+        each line is kept alongside, for the overflow policies.
+    """
+    def __init__(self, lines=()):
+        self.data = bytearray()
+        self.offsets = array('Q')
+        self.levels = array('H')
+        # The Split this buffer is a half of, if it is
+        self.split = None
+        # The payload compressed once for every attempt, see
+        # LogDNAHandler.compress_batch()
+        self.compressed = None
+        for line in lines:
+            self.append(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def size_with(self, line):
+        """The size after appending line"""
+        return len(self.data) + len(line) + (1 if self.offsets else 0)
+
+    def append(self, line, level=logging.INFO):
+        if self.offsets:
+            self.data += b','
+        self.offsets.append(len(self.data))
+        self.levels.append(level)
+        self.data += line
+
+    def spans(self):
+        # (start, end) of each line, end including the comma that follows
+        ends = self.offsets[1:].tolist() + [len(self.data) + 1]
+        return zip(self.offsets, ends)
+
+    def lines(self):
+        for start, end in self.spans():
+            yield bytes(self.data[start:end - 1])
+
+    def slice(self, start, end):
+        """A buffer of lines start to end, copied"""
+        buf = LogBuffer()
+        if start >= end:
+            return buf
+        first = self.offsets[start]
+        last = self.offsets[end] - 1 if end < len(self) else len(self.data)
+        buf.data = self.data[first:last]
+        buf.offsets = array('Q',
+                            map((-first).__add__, self.offsets[start:end]))
+        buf.levels = self.levels[start:end]
+        return buf
+
+    def halves(self):
+        middle = len(self) // 2
+        return [self.slice(0, middle), self.slice(middle, len(self))]
+
+    def partition(self, max_size):
+        """
+            The lines in buffers of at most max_size bytes each, in order.
+            A line longer than that gets a buffer of its own.
+        """
+        parts = []
+        first = 0
+        size = 0
+        for index, (start, end) in enumerate(self.spans()):
+            if index > first and size + end - start > max_size:
+                parts.append(self.slice(first, index))
+                first = index
+                size = end - start - 1
+            else:
+                size += end - start - (1 if index == first else 0)
+        if first < len(self):
+            parts.append(self.slice(first, len(self)))
+        return parts
+
+    def extend(self, other):
+        """Append the lines of another buffer, in a single copy"""
+        if not other.offsets:
+            return
+        if self.offsets:
+            self.data += b','
+        self.offsets.extend(array('Q', map(len(self.data).__add__,
+                                           other.offsets)))
+        self.levels.extend(other.levels)
+        self.data += other.data
+
+    def evict(self, size, level=None):
+        """
+            Remove the oldest lines, or the oldest lines of the given level,
+            until they add up to at least size bytes or there are none left.
+        Returns:
+            {level: number of lines removed}
+        """
+        evicted = {}
+        kept = LogBuffer()
+        freed = 0
+        with memoryview(self.data) as view:
+            for (start, end), line_level in zip(self.spans(), self.levels):
+                if freed < size and level in (None, line_level):
+                    freed += end - start
+                    evicted[line_level] = evicted.get(line_level, 0) + 1
+                else:
+                    kept.append(view[start:end - 1], line_level)
+        if evicted:
+            self.data, self.offsets, self.levels = (kept.data, kept.offsets,
+                                                    kept.levels)
+            self.compressed = None
+        return evicted
+
+    def payload(self):
+        return PAYLOAD_PREFIX + self.data + PAYLOAD_SUFFIX
+
+    def iter_payload(self, chunk_size):
+        yield PAYLOAD_PREFIX
+        with memoryview(self.data) as view:
+            for start in range(0, len(view), chunk_size):
+                yield bytes(view[start:start + chunk_size])
+        yield PAYLOAD_SUFFIX
+
+
+class BufferShard():
+    """
+        Lines staged by the threads assigned to the shard, behind a lock of
+        its own, so that threads buffering at the same time do not queue up
+        on a single lock. The handler moves the lines to its buffer a whole
+        shard at a time, by swapping in an empty one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buf = LogBuffer()
+
+    def stage(self, lines, levels):
+        """
+            Append lines.
+        Returns:
+            (size of the shard, whether it was empty before)
+        """
+        with self.lock:
+            buf = self.buf
+            empty = not buf.offsets
+            for line, level in zip(lines, levels):
+                buf.append(line, level)
+            return buf.size, empty
+
+    def take(self):
+        with self.lock:
+            buf, self.buf = self.buf, LogBuffer()
+        return buf
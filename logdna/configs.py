@@ -5,15 +5,45 @@ with open("{p}{s}VERSION".format(p=path.abspath(path.dirname(__file__)),
     version = f.read().strip('\n')
 
 defaults = {
+    'ADAPTIVE_MAX_FLUSH_INTERVAL_SECS': 2,
+    'ADAPTIVE_MIN_FLUSH_INTERVAL_SECS': 0.1,
+    'ADAPTIVE_MIN_FLUSH_LIMIT': 64 * 1024,
+    'ADAPTIVE_SMOOTHING_SECS': 0.5,
+    'COMPRESSION_THRESHOLD': 4 * 1024,
     'DEFAULT_REQUEST_TIMEOUT': 30,
+    'DRAIN_BATCH_SIZE': 1000,
+    'ENGINE_MAX_WORKERS': 16,
     'FLUSH_INTERVAL_SECS': 0.25,
     'FLUSH_LIMIT': 2 * 1024 * 1024,
     'MAX_CONCURRENT_REQUESTS': 10,
+    'MAX_REQUEST_BYTES': 10 * 1024 * 1024,
+    'MAX_RETRY_AFTER_SECS': 300,
     'MAX_RETRY_ATTEMPTS': 3,
     'MAX_RETRY_JITTER': 0.5,
     'META_FIELDS': ['args', 'name', 'pathname', 'lineno'],
     'LOGDNA_URL': 'https://logs.logdna.com/logs/ingest',
+    'OVERFLOW_EVICT_SHARE': 1 / 16,
+    'OVERFLOW_POLICY': 'drop_newest',
+    'OVERFLOW_SAMPLE_RATES': {
+        'DEBUG': 0.1,
+        'INFO': 0.5
+    },
+    'OVERFLOW_SAMPLE_WATERMARK': 0.75,
+    'OVERFLOW_TIMEOUT_SECS': 1,
+    'POOL_IDLE_TIMEOUT_SECS': 30,
     'BUF_RETENTION_LIMIT': 4 * 1024 * 1024,
+    'BUFFER_SHARD_BYTES': 64 * 1024,
+    'BUFFER_SHARDS': 1,
+    'CIRCUIT_BREAKER_RESET_SECS': 30,
+    'RATE_LIMIT_REPORT_SECS': 1,
     'RETRY_INTERVAL_SECS': 5,
+    'SHIPPER_MAX_DATAGRAM': 256 * 1024,
+    'SHIPPER_RECV_BUFFER': 4 * 1024 * 1024,
+    'SHIPPER_SEND_TIMEOUT_SECS': 0.1,
+    'SPOOL_MAX_AGE_SECS': 24 * 60 * 60,
+    'SPOOL_MAX_BYTES': 64 * 1024 * 1024,
+    'SPOOL_SEGMENT_BYTES': 4 * 1024 * 1024,
+    'STREAM_CHUNK_BYTES': 64 * 1024,
+    'THROTTLE_MAX_ENTRIES': 4096,
     'USER_AGENT': 'python/%s' % version
 }
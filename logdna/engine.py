@@ -0,0 +1,190 @@
+import collections
+import logging
+import os
+import threading
+import time
+import weakref
+
+from .configs import defaults
+from .scheduler import Scheduler
+from .workers import WorkerPool
+
+# Engines that need to be restarted in the child after os.fork(). This
+# module is imported before the handlers register their own hook, so the
+# engines are restarted before the handlers that use them.
+_engines = weakref.WeakSet()
+
+# The process-wide engine, see ShippingEngine.shared()
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    global _shared_lock
+    _shared_lock = threading.Lock()
+    for engine in list(_engines):
+        engine.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class StreamExecutor():
+    """
+        A handler's share of a WorkerPool that other handlers use
+        as well. Its tasks run in order, at most max_workers of them at
+        once, and each task goes to the back of the executor's queue, so a
+        busy handler does not hold up the others. shutdown() only waits for
+        the tasks submitted through it.
+    """
+    def __init__(self, executor, max_workers):
+        self.executor = executor
+        self.max_workers = max_workers
+        self._tasks = collections.deque()
+        self._running = 0
+        self._idle = threading.Condition()
+        self._shutdown = False
+
+    def submit(self, fn, *args):
+        with self._idle:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after ' +
+                                   'shutdown')
+            self._tasks.append((fn, args))
+            if self._running >= self.max_workers:
+                return
+            self._running += 1
+        try:
+            self.executor.submit(self._run)
+        except RuntimeError:
+            with self._idle:
+                self._tasks.pop()
+                self._running -= 1
+                self._idle.notify_all()
+            raise
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop taking tasks and, with wait, wait for those submitted"""
+        with self._idle:
+            self._shutdown = True
+            if wait:
+                return self._idle.wait_for(lambda: not self._running,
+                                           timeout)
+        return True
+
+    def _run(self):
+        while True:
+            with self._idle:
+                if not self._tasks:
+                    self._running -= 1
+                    self._idle.notify_all()
+                    return
+                fn, args = self._tasks.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logging.getLogger('internal').exception(
+                    'Error in task %s', fn)
+            del fn, args
+
+            with self._idle:
+                if not self._tasks:
+                    self._running -= 1
+                    self._idle.notify_all()
+                    return
+            try:
+                self.executor.submit(self._run)
+                return
+            except RuntimeError:
+                # The engine has been shut down: carry on in this thread
+                pass
+
+
+class ShippingEngine():
+    """
+        The threads and connections that send logs, shared by any number of
+        handlers. A handler created with the shared_engine option uses its
+        request threads, its scheduler for flushes and retries, its log
+        consumer thread and its connection pool, instead of starting its
+        own, while its key, url, hostname, tags and limits stay its own.
+        ShippingEngine.shared() is the process-wide engine.
+    """
+    def __init__(self, max_workers=defaults['ENGINE_MAX_WORKERS'],
+                 pool_idle_timeout=defaults['POOL_IDLE_TIMEOUT_SECS']):
+        self.max_workers = max_workers
+        self.pool_idle_timeout_secs = pool_idle_timeout
+        self.start()
+        _engines.add(self)
+
+    @classmethod
+    def shared(cls):
+        """The process-wide engine, created on first use"""
+        global _shared
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls()
+            return _shared
+
+    def start(self):
+        # Threads are started on first use, and again after a fork
+        self.request_thread_pool = WorkerPool(self.max_workers)
+        self.consumer_thread_pool = WorkerPool(1, 'logdna-log-consumer')
+        self.scheduler = Scheduler('logdna-engine-scheduler')
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.session_last_used = time.monotonic()
+
+    def request_executor(self, max_workers):
+        # A handler gets at most half of the request threads, so that
+        # there are always some left for the others
+        share = max(1, self.max_workers // 2)
+        return StreamExecutor(self.request_thread_pool,
+                              min(max_workers, share))
+
+    def log_consumer(self):
+        return StreamExecutor(self.consumer_thread_pool, 1)
+
+    def scheduler_client(self):
+        return self.scheduler.client()
+
+    @property
+    def session(self):
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self.create_session()
+                session = self._session
+        return session
+
+    def create_session(self):
+        # A keep-alive pool per host, sized so that every request thread
+        # can hold a connection
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reap_idle_connections(self):
+        now = time.monotonic()
+        if (self._session is not None
+                and now - self.session_last_used >=
+                self.pool_idle_timeout_secs):
+            self._session.close()
+        self.session_last_used = now
+
+    def shutdown(self, wait=True):
+        """
+            Stop the threads and close the connections. Close the handlers
+            that use the engine first.
+        """
+        self.scheduler.shutdown(wait)
+        self.consumer_thread_pool.shutdown(wait)
+        self.request_thread_pool.shutdown(wait)
+        if self._session is not None:
+            self._session.close()
@@ -1,14 +1,102 @@
+import collections
+import itertools
 import logging
-import requests
-import socket
+import os
+import queue
+import random
 import sys
 import threading
 import time
+import weakref
 
-from concurrent.futures import ThreadPoolExecutor
-
+from .adaptive import AdaptiveFlushPolicy
+from .breaker import CircuitBreaker, CLOSED, OPEN
+from .buffer import BufferShard, LogBuffer, PAYLOAD_OVERHEAD
+from .buffer import encode_message, level_number, line_level, truncate_line
 from .configs import defaults
-from .utils import sanitize_meta, get_ip, normalize_list_option
+from .engine import ShippingEngine
+from .pacing import RequestPacer
+from .scheduler import Scheduler
+from .spool import DiskSpool
+from .stats import Stats
+from .throttle import Deduplicator, RateLimiter
+from .utils import capture_record, sanitize_meta, get_hostname, get_ip
+from .utils import normalize_list_option, parse_retry_after
+from .utils import compress, zstandard, COMPRESSION_CODECS
+from .utils import iter_compressed
+from .workers import WorkerPool
+
+
+def _drain_log_queue(handler_ref, log_queue, batch_size):
+    # Like the workers of concurrent.futures, only hold a weak reference to
+    # the handler while waiting so that an unclosed handler can be collected.
+    while True:
+        messages = [log_queue.get()]
+        try:
+            while len(messages) < batch_size:
+                messages.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        handler = handler_ref()
+        # None is the stop signal sent by stop_log_consumer
+        stopping = None in messages
+        if handler is not None:
+            handler.buffer_logs_sync(
+                [m for m in messages if m is not None]
+                if stopping else messages)
+        if stopping or handler is None:
+            return
+        del handler
+
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'drop_lowest_level',
+                     'sample', 'block')
+MAX_LINE_POLICIES = ('truncate', 'drop')
+# Statuses of a batch rejected as a whole, possibly for one of its lines
+REJECTED_STATUSES = (400, 413)
+# Rejected batches are split into at most 2 ** MAX_SPLIT_DEPTH parts
+MAX_SPLIT_DEPTH = 8
+
+
+class Split():
+    """The two halves of a rejected batch, and how many were rejected"""
+    __slots__ = ('parent', 'depth', 'rejected')
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 1
+        self.rejected = 0
+
+    def request_fault(self):
+        # Both halves of a split rejected as well means the request itself
+        # is at fault rather than any line
+        split = self
+        while split:
+            if split.rejected >= 2:
+                return True
+            split = split.parent
+        return False
+
+
+def parse_spool_header(header):
+    # 'encoding lines'; batches spooled before line counts were recorded
+    # carry only the encoding
+    content_encoding, _, lines = header.decode('ascii').partition(' ')
+    return content_encoding or None, int(lines or 0)
+
+
+# Handlers that need to be reset in the child after os.fork()
+_fork_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for handler in list(_fork_handlers):
+        handler.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
 class LogDNAHandler(logging.Handler):
@@ -25,8 +113,9 @@ class LogDNAHandler(logging.Handler):
 
         # Set the Custom Variables
         self.key = key
-        self.hostname = options.get('hostname', socket.gethostname())
-        self.ip = options.get('ip', get_ip())
+        self.hostname = options.get('hostname', None) or get_hostname()
+        # Discovered on the first request rather than on startup
+        self._ip = options.get('ip', None)
         self.mac = options.get('mac', None)
         self.loglevel = options.get('level', 'info')
         self.app = options.get('app', '')
@@ -35,6 +124,7 @@ class LogDNAHandler(logging.Handler):
         self.custom_fields = normalize_list_option(options, 'custom_fields')
         self.custom_fields += defaults['META_FIELDS']
         self.log_error_response = options.get('log_error_response', False)
+        self.stats_callback = options.get('stats_callback', None)
 
         # Set the Connection Variables
         self.url = options.get('url', defaults['LOGDNA_URL'])
@@ -49,10 +139,62 @@ class LogDNAHandler(logging.Handler):
             'max_concurrent_requests', defaults['MAX_CONCURRENT_REQUESTS'])
         self.retry_interval_secs = options.get('retry_interval_secs',
                                                defaults['RETRY_INTERVAL_SECS'])
+        self.pool_idle_timeout_secs = options.get(
+            'pool_idle_timeout', defaults['POOL_IDLE_TIMEOUT_SECS'])
+        self.compression = self.normalize_compression(
+            options.get('compression', None))
+        self.compression_level = options.get('compression_level', None)
+        self.compression_threshold = options.get(
+            'compression_threshold', defaults['COMPRESSION_THRESHOLD'])
+
+        # With circuit_breaker, that many consecutive failed requests stop
+        # the handler from sending for circuit_breaker_reset seconds, after
+        # which a single probe request decides whether to resume
+        self.breaker = None
+        circuit_breaker = options.get('circuit_breaker', None)
+        if circuit_breaker:
+            self.breaker = CircuitBreaker(
+                circuit_breaker,
+                options.get('circuit_breaker_reset',
+                            defaults['CIRCUIT_BREAKER_RESET_SECS']))
+        self._release = None
+
+        # Throttled requests pause every request for as long as the server
+        # asks, and halve how many are sent at once
+        self.pacer = RequestPacer(self.max_concurrent_requests,
+                                  defaults['MAX_RETRY_AFTER_SECS'])
+
+        # With shared_engine, the request threads, scheduler, log consumer
+        # and connection pool are those of a ShippingEngine that other
+        # handlers use as well: True for the process-wide one
+        engine = options.get('shared_engine', None)
+        if engine is True:
+            engine = ShippingEngine.shared()
+        self.engine = engine or None
+
+        # Set up the Connection Pool, on the first request
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.session_last_used = time.monotonic()
 
         # Set the Flush-related Variables
-        self.buf = []
-        self.buf_size = 0
+        self.buf = LogBuffer()
+        # Full buffers waiting for a request thread, held while the circuit
+        # is open, or waiting for a retry, and the bytes of every batch
+        # that has not been sent, spooled or dropped yet
+        self.pending = collections.deque()
+        self.parked = collections.deque()
+        self.retrying = collections.deque()
+        self.queued_bytes = 0
+        self._stats = Stats()
+
+        # With buffer_shards, each thread stages its lines in one of that
+        # many shards, which are merged into the buffer once full and on
+        # every flush
+        self.buffer_shards = options.get('buffer_shards',
+                                         defaults['BUFFER_SHARDS'])
+        self.shard_bytes = defaults['BUFFER_SHARD_BYTES']
+        self.make_shards()
 
         self.include_standard_meta = options.get('include_standard_meta', None)
 
@@ -68,61 +210,886 @@ class LogDNAHandler(logging.Handler):
         self.buf_retention_limit = options.get('buf_retention_limit',
                                                defaults['BUF_RETENTION_LIMIT'])
 
+        # With adaptive_flush, flush_limit and flush_interval are tuned
+        # between these bounds as the handler runs
+        self.flush_policy = None
+        if options.get('adaptive_flush', False):
+            # The smallest limit and shortest interval are no larger than
+            # the flush_limit and flush_interval options
+            min_flush_limit = min(
+                options.get('min_flush_limit',
+                            defaults['ADAPTIVE_MIN_FLUSH_LIMIT']),
+                self.flush_limit)
+            min_flush_interval = min(
+                options.get('min_flush_interval',
+                            defaults['ADAPTIVE_MIN_FLUSH_INTERVAL_SECS']),
+                self.flush_interval_secs)
+            max_flush_interval = max(
+                options.get('max_flush_interval',
+                            defaults['ADAPTIVE_MAX_FLUSH_INTERVAL_SECS']),
+                min_flush_interval)
+            self.flush_policy = AdaptiveFlushPolicy(
+                (min_flush_limit, self.flush_limit),
+                (min_flush_interval, max_flush_interval),
+                self.max_concurrent_requests,
+                defaults['ADAPTIVE_SMOOTHING_SECS'])
+            limits = self.flush_policy.limits()
+            self.flush_limit, self.flush_interval_secs = limits
+
+        # What to do with lines that would take the buffer past
+        # buf_retention_limit. Lines shed since the last batch are counted
+        # by level, and reported in a line of their own in the next one.
+        self.overflow_policy = self.normalize_overflow_policy(
+            options.get('overflow_policy', defaults['OVERFLOW_POLICY']))
+        self.overflow_timeout = options.get('overflow_timeout',
+                                            defaults['OVERFLOW_TIMEOUT_SECS'])
+        self.overflow_sample_rates = {
+            level_number(name): rate
+            for name, rate in options.get(
+                'overflow_sample_rates',
+                defaults['OVERFLOW_SAMPLE_RATES']).items()
+        }
+        self.shed = {}
+
+        # Lines longer than max_line_bytes once encoded are truncated or
+        # dropped before they are buffered, and request bodies are kept
+        # within max_request_bytes whatever the flush_limit
+        self.max_line_bytes = options.get('max_line_bytes', None)
+        self.max_line_policy = self.normalize_max_line_policy(
+            options.get('max_line_policy', 'truncate'))
+        self.max_request_bytes = options.get('max_request_bytes',
+                                             defaults['MAX_REQUEST_BYTES'])
+
+        # Optionally collapse repeated records and rate limit each logger
+        # in emit(), before a message is even built
+        self.deduplicator = None
+        dedup_window = options.get('dedup_window', None)
+        if dedup_window:
+            self.deduplicator = Deduplicator(
+                dedup_window,
+                options.get('dedup_max_entries',
+                            defaults['THROTTLE_MAX_ENTRIES']))
+        self.rate_limiter = None
+        rate_limit = options.get('rate_limit', None)
+        if rate_limit:
+            self.rate_limiter = RateLimiter(
+                rate_limit, options.get('rate_limit_burst', rate_limit),
+                defaults['THROTTLE_MAX_ENTRIES'])
+        self.throttling = bool(self.deduplicator or self.rate_limiter)
+        self._throttle_lock = threading.Lock()
+        self._throttle_report = None
+
+        # With defer_formatting, emit() only queues a copy of the record and
+        # its message is built on the thread that buffers it
+        self.defer_formatting = options.get('defer_formatting', False)
+
+        # Set up the Ingestion Queue. Records are appended by the calling
+        # thread and drained in batches into the buffer by a single consumer
+        # thread, which is started on first use.
+        self.log_queue = queue.SimpleQueue()
+        self.log_consumer = None
+        self.drain_batch_size = defaults['DRAIN_BATCH_SIZE']
+        self._consumer_lock = threading.Lock()
+        self._drain_scheduled = False
+        # Set on the engine's consumer thread while it drains this handler
+        self._draining = threading.local()
+
         # Set up the Thread Pools
-        self.worker_thread_pool = ThreadPoolExecutor()
-        self.request_thread_pool = ThreadPoolExecutor(
-            max_workers=self.max_concurrent_requests)
+        self.request_thread_pool = self.make_request_thread_pool()
 
         self.setLevel(logging.DEBUG)
         self._lock = threading.RLock()
+        # Signalled whenever buffered lines are handed to a request, for
+        # the block overflow policy
+        self._room = threading.Condition(self._lock)
+        self._has_room = threading.Event()
+        self._has_room.set()
+
+        # A single long-lived thread runs the flush timer and the delayed
+        # retries for this handler
+        self.scheduler = self.make_scheduler()
+        self._scheduler_finalizer = weakref.finalize(self,
+                                                     self.scheduler.shutdown,
+                                                     False)
+        self.flusher = None
+
+        # Batches that are being sent or are waiting for a retry, and
+        # batches handed to the request threads that have not started yet
+        self._inflight = 0
+        self._handoffs = 0
+        self._inflight_done = threading.Condition()
+        self._closing = False
+        self._close_report = None
+        # flush(timeout) calls running, which retry at once
+        self._urgent = 0
+
+        # Set up the optional Disk Spool for batches that overflow the
+        # buffer or exhaust their retries
+        self.spool = None
+        self._replaying = False
+        spool_dir = options.get('spool_dir', None)
+        if spool_dir:
+            self.spool = DiskSpool(
+                spool_dir,
+                options.get('spool_max_bytes', defaults['SPOOL_MAX_BYTES']),
+                options.get('spool_max_age', defaults['SPOOL_MAX_AGE_SECS']),
+                defaults['SPOOL_SEGMENT_BYTES'])
+            self.schedule_replay()
+
+        _fork_handlers.add(self)
+
+    def after_fork(self):
+        # Threads do not survive a fork, and their locks may have been held
+        # at the time, so the child starts over with its own. Connections,
+        # the spool and the lines buffered before the fork stay with the
+        # parent, which will send them.
+        self._lock = threading.RLock()
+        self._room = threading.Condition(self._lock)
+        self._has_room = threading.Event()
+        self._has_room.set()
+        self._consumer_lock = threading.Lock()
+        self._inflight_done = threading.Condition()
+        self._inflight = 0
+        self._handoffs = 0
+        self._urgent = 0
+        self._replaying = False
+        self.buf = LogBuffer()
+        self.pending = collections.deque()
+        self.parked = collections.deque()
+        self.retrying = collections.deque()
+        self.queued_bytes = 0
+        self.make_shards()
+        if self.breaker:
+            self.breaker = CircuitBreaker(self.breaker.threshold,
+                                          self.breaker.reset_secs)
+        self._release = None
+        self.pacer = RequestPacer(self.max_concurrent_requests,
+                                  defaults['MAX_RETRY_AFTER_SECS'])
+        self.shed = {}
+        self._throttle_lock = threading.Lock()
+        self._throttle_report = None
+        self._stats = Stats()
+
+        if self.log_queue is not None:
+            self.log_queue = queue.SimpleQueue()
+        self.log_consumer = None
+        self._drain_scheduled = False
 
+        # The engine, if any, has been restarted already
+        self._scheduler_finalizer.detach()
+        self.scheduler = self.make_scheduler()
+        self._scheduler_finalizer = weakref.finalize(self,
+                                                     self.scheduler.shutdown,
+                                                     False)
         self.flusher = None
 
+        if self.request_thread_pool is not None:
+            self.request_thread_pool = self.make_request_thread_pool()
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.session_last_used = time.monotonic()
+
+        if self.spool:
+            self.internalLogger.debug(
+                'The spool is not shared with forked processes. ' +
+                'Disabling it in process %s', os.getpid())
+            self.spool = None
+
+    def make_request_thread_pool(self):
+        # Subclasses that send without request threads return None
+        if self.engine:
+            return self.engine.request_executor(self.max_concurrent_requests)
+        return WorkerPool(self.max_concurrent_requests)
+
+    def make_scheduler(self):
+        if self.engine:
+            return self.engine.scheduler_client()
+        return Scheduler()
+
+    def normalize_compression(self, compression):
+        if compression is None or compression is False:
+            return None
+
+        if compression not in COMPRESSION_CODECS:
+            self.internalLogger.debug(
+                'Unsupported compression: %s. Sending uncompressed',
+                compression)
+            return None
+
+        if compression == 'zstd' and zstandard is None:
+            self.internalLogger.debug(
+                'zstd compression requires the "zstandard" package. ' +
+                'Falling back to gzip')
+            return 'gzip'
+
+        return compression
+
+    def normalize_overflow_policy(self, policy):
+        if policy not in OVERFLOW_POLICIES:
+            self.internalLogger.debug(
+                'Unsupported overflow policy: %s. Dropping the newest lines',
+                policy)
+            return 'drop_newest'
+        return policy
+
+    def normalize_max_line_policy(self, policy):
+        if policy not in MAX_LINE_POLICIES:
+            self.internalLogger.debug(
+                'Unsupported max line policy: %s. Truncating long lines',
+                policy)
+            return 'truncate'
+        return policy
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip = get_ip()
+        return self._ip
+
+    @property
+    def session(self):
+        if self.engine:
+            return self.engine.session
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self.create_session()
+                session = self._session
+        return session
+
+    def create_session(self):
+        # A single keep-alive pool per handler, sized so that every request
+        # thread can hold a connection without opening a new one. requests
+        # is only imported here, as it takes longer to import than the rest
+        # of the handler.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_concurrent_requests)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reap_idle_connections(self):
+        # Idle sockets are likely to have been closed by the server or a
+        # load balancer, so drop them rather than failing on first reuse.
+        if self.engine:
+            self.engine.reap_idle_connections()
+            return
+        now = time.monotonic()
+        if (self._session is not None
+                and now - self.session_last_used >=
+                self.pool_idle_timeout_secs):
+            self._session.close()
+        self.session_last_used = now
+
+    @property
+    def next_flush_in(self):
+        """Seconds until the pending timed flush, or None if none is due"""
+        flusher = self.flusher
+        if not flusher or flusher.cancelled or flusher.done:
+            return None
+        return flusher.remaining()
+
+    def call_later(self, delay, fn):
+        """
+            Call fn on the scheduler thread after delay seconds. Returns the
+            ScheduledCall, or None once close() has shut the scheduler down.
+        """
+        try:
+            return self.scheduler.call_later(delay, fn)
+        except RuntimeError:
+            return None
+
     def start_flusher(self):
-        if not self.flusher:
-            self.flusher = threading.Timer(
-                self.flush_interval_secs, self.flush)
-            self.flusher.start()
+        if not self.flusher or self.flusher.done:
+            self.flusher = self.call_later(self.flush_interval_secs,
+                                           self.flush)
 
     def close_flusher(self):
         if self.flusher:
             self.flusher.cancel()
             self.flusher = None
 
+    def start_log_consumer(self):
+        with self._consumer_lock:
+            if not self.log_consumer and self.log_queue is not None:
+                if self.engine:
+                    # Queued records are drained on the engine's consumer
+                    # thread, see wake_log_consumer()
+                    self.log_consumer = self.engine.log_consumer()
+                    return
+                self.log_consumer = threading.Thread(
+                    target=_drain_log_queue,
+                    args=(weakref.ref(self), self.log_queue,
+                          self.drain_batch_size),
+                    name='logdna-log-consumer',
+                    daemon=True)
+                self.log_consumer.start()
+                weakref.finalize(self, self.log_queue.put, None)
+
+    def stop_log_consumer(self, timeout=None):
+        # Route any further records straight to the buffer, then wake the
+        # consumer and wait for it to drain what it has already received.
+        with self._consumer_lock:
+            log_queue, self.log_queue = self.log_queue, None
+            log_consumer, self.log_consumer = self.log_consumer, None
+        if log_queue is None:
+            return
+
+        if isinstance(log_consumer, threading.Thread):
+            log_queue.put(None)
+            log_consumer.join(timeout)
+        elif log_consumer:
+            log_consumer.shutdown(timeout=timeout)
+
+        # Pick up records that were queued after the consumer stopped
+        self.drain_log_queue(log_queue)
+
+    def drain_log_queue(self, log_queue):
+        # Buffer the queued records on this thread
+        messages = []
+        try:
+            while True:
+                messages.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if None in messages:
+            # Leave the stop signal for the consumer
+            log_queue.put(None)
+            messages = [m for m in messages if m is not None]
+        if messages:
+            self.buffer_logs_sync(messages)
+
     def buffer_log(self, message):
-        if self.worker_thread_pool:
+        log_queue = self.log_queue
+        if log_queue is None:
+            self.buffer_log_sync(message)
+            return
+
+        if not self.log_consumer:
+            self.start_log_consumer()
+        if not self._has_room.is_set():
+            # The buffer is full under the block overflow policy
+            self._has_room.wait(self.overflow_timeout)
+        log_queue.put(message)
+        if self.engine and not self._drain_scheduled:
+            self.wake_log_consumer(log_queue)
+
+    def wake_log_consumer(self, log_queue):
+        # Ask the engine's consumer thread to drain the queue, unless it has
+        # been asked already and has not started yet. A record put after it
+        # starts finds the flag clear and asks again.
+        log_consumer = self.log_consumer
+        self._drain_scheduled = True
+        try:
+            log_consumer.submit(self.drain_scheduled, log_queue)
+        except (AttributeError, RuntimeError):
+            # Stopped by close()
+            self._drain_scheduled = False
+            self.drain_log_queue(log_queue)
+
+    def drain_scheduled(self, log_queue):
+        self._drain_scheduled = False
+        self._draining.active = True
+        try:
+            self.drain_log_queue(log_queue)
+        finally:
+            self._draining.active = False
+
+    def buffer_log_sync(self, message):
+        self.buffer_logs_sync([message])
+
+    def buffer_logs_sync(self, messages):
+        # Encode before taking the lock, so it is only held to copy bytes
+        lines = []
+        levels = []
+        for message in messages:
+            if isinstance(message, logging.LogRecord):
+                message = self.build_captured(message)
+                if message is None:
+                    continue
             try:
-                self.worker_thread_pool.submit(self.buffer_log_sync, message)
-            except RuntimeError:
-                self.buffer_log_sync(message)
+                level = level_number(message.get('level'))
+                lines.append(encode_message(message))
+                levels.append(level)
             except Exception as e:
-                self.internalLogger.debug('Error in calling buffer_log: %s', e)
+                self.internalLogger.debug('Error encoding log line: %s', e)
+                self._stats.incr('lines_in')
+                self.record_drop(1, 'encoding')
+        self.buffer_encoded_logs_sync(lines, levels)
 
-    def buffer_log_sync(self, message):
+    def buffer_encoded_logs_sync(self, lines, levels=None):
+        self._stats.incr('lines_in', len(lines))
+        if levels is None:
+            levels = [line_level(line) for line in lines]
+        if (self.max_line_bytes
+                and max(map(len, lines), default=0) > self.max_line_bytes):
+            lines, levels = self.fit_lines(lines, levels)
+        if self.flush_policy:
+            self.flush_policy.observe_arrival(sum(map(len, lines)),
+                                              time.monotonic())
+        if self.shards:
+            self.stage_lines(lines, levels)
+            return
         # Attempt to acquire lock to write to buffer
         if self._lock.acquire(blocking=True):
             try:
-                msglen = len(message['line'])
-                if self.buf_size + msglen < self.buf_retention_limit:
-                    self.buf.append(message)
-                    self.buf_size += msglen
-                else:
-                    self.internalLogger.debug(
-                        'The buffer size exceeded the limit: %s',
-                        self.buf_retention_limit)
+                for line, level in zip(lines, levels):
+                    self.buffer_line(line, level)
 
-                if self.buf_size >= self.flush_limit:
-                    self.close_flusher()
-                    self.flush()
-                else:
+                if self.buf:
                     self.start_flusher()
+                else:
+                    self.close_flusher()
             except Exception as e:
-                self.internalLogger.exception(f'Error in buffer_log_sync: {e}')
+                self.internalLogger.exception(
+                    f'Error in buffer_logs_sync: {e}')
             finally:
                 self._lock.release()
 
-    def flush(self):
-        self.schedule_flush_sync()
+    def fit_lines(self, lines, levels):
+        fitted = ([], [])
+        for line, level in zip(lines, levels):
+            line = self.fit_line(line)
+            if line is not None:
+                fitted[0].append(line)
+                fitted[1].append(level)
+        return fitted
+
+    def fit_line(self, line):
+        # Lines longer than max_line_bytes are truncated, or dropped when
+        # that is the policy or truncating the text is not enough
+        if len(line) <= self.max_line_bytes:
+            return line
+        if self.max_line_policy == 'truncate':
+            truncated = truncate_line(line, self.max_line_bytes)
+            if truncated is not None:
+                self._stats.incr('lines_truncated')
+                return truncated
+        self.internalLogger.debug(
+            'Dropping a line of %d bytes, longer than max_line_bytes',
+            len(line))
+        self.record_drop(1, 'size')
+        return None
+
+    def make_shards(self):
+        self.shards = None
+        if self.buffer_shards > 1:
+            self.shards = [BufferShard() for _ in range(self.buffer_shards)]
+        self._thread_shard = threading.local()
+        self._shard_numbers = itertools.count()
+
+    def shard(self):
+        # Threads are assigned shards in turn, on their first line
+        try:
+            return self._thread_shard.shard
+        except AttributeError:
+            shard = self.shards[next(self._shard_numbers) % len(self.shards)]
+            self._thread_shard.shard = shard
+            return shard
+
+    def stage_lines(self, lines, levels):
+        shard = self.shard()
+        size, was_empty = shard.stage(lines, levels)
+        if size >= self.shard_bytes:
+            with self._lock:
+                self.merge_buffer(shard.take())
+                if self.buf:
+                    self.start_flusher()
+        elif was_empty:
+            # Make sure a flush is due to collect the shard
+            with self._lock:
+                self.start_flusher()
+
+    def collect_shards(self):
+        # Called with the buffer lock held, before the buffer is taken
+        if self.shards:
+            for shard in self.shards:
+                self.merge_buffer(shard.take())
+
+    def merge_buffer(self, buf):
+        # Called with the buffer lock held. Lines that fit under both
+        # flush_limit and the overflow threshold are copied over at once,
+        # and otherwise buffered one by one like any other.
+        if not buf:
+            return
+        size = self.buf.size_with(buf.data)
+        if (size < self.flush_limit
+                and size + self.queued_bytes < self.overflow_threshold):
+            self.buf.extend(buf)
+            return
+        for line, level in zip(buf.lines(), buf.levels):
+            self.buffer_line(line, level)
+
+    def buffer_line(self, line, level=logging.INFO):
+        # Called with the buffer lock held. Full buffers are handed off as
+        # soon as they reach flush_limit, so each batch overshoots it by
+        # less than one line.
+        retained = self.buf.size_with(line) + self.queued_bytes
+        if self.spool and retained >= self.buf_retention_limit:
+            self.spool_buffer()
+            retained = self.retained_with(line)
+        if (retained >= self.overflow_threshold
+                and not self.make_room(line, level, retained)):
+            self.shed_lines({level: 1})
+            return
+
+        self.buf.append(line, level)
+        if self.buf.size >= self.flush_limit:
+            self.send_buffer(self.take_buffer())
+
+    @property
+    def overflow_threshold(self):
+        """Retained bytes past which the overflow policy applies"""
+        if self.overflow_policy == 'sample':
+            return int(self.buf_retention_limit *
+                       defaults['OVERFLOW_SAMPLE_WATERMARK'])
+        return self.buf_retention_limit
+
+    def retained_with(self, line):
+        # Bytes held by the handler once line is buffered
+        return self.buf.size_with(line) + self.queued_bytes
+
+    def make_room(self, line, level, retained):
+        # Called with the buffer lock held when line would take the buffer
+        # past the overflow threshold. True if line can be buffered.
+        policy = self.overflow_policy
+        if policy == 'sample':
+            return (retained < self.buf_retention_limit and
+                    random.random() < self.overflow_sample_rates.get(level, 1))
+        if policy == 'block':
+            self.wait_for_room(line)
+        elif policy == 'drop_oldest':
+            self.evict(retained, None)
+        elif policy == 'drop_lowest_level':
+            self.evict_below(line, level)
+        return self.retained_with(line) < self.buf_retention_limit
+
+    def wait_for_room(self, line):
+        # Called with the buffer lock held. Wait once for a request to take
+        # buffered lines, and shed lines without waiting until one does.
+        if self._has_room.is_set():
+            self._has_room.clear()
+            if getattr(self._draining, 'active', False):
+                # The engine's consumer thread drains the queues of every
+                # handler and must not wait for this one: the threads
+                # logging wait instead, see buffer_log()
+                return
+            self._room.wait_for(
+                lambda: self.retained_with(line) < self.buf_retention_limit,
+                self.overflow_timeout)
+
+    def notify_room(self):
+        # Called with the buffer lock held, when lines have left the buffer
+        self._has_room.set()
+        self._room.notify_all()
+
+    def evict(self, retained, level):
+        # Called with the buffer lock held. Remove the oldest lines, or the
+        # oldest of level, from the batches waiting to be sent and then the
+        # buffer. Each eviction copies what is left of a batch, so free at
+        # least a share of the retention limit at a time.
+        size = max(
+            retained - self.buf_retention_limit + 1,
+            int(self.buf_retention_limit * defaults['OVERFLOW_EVICT_SHARE']))
+        for buf in self.queued_batches() + [self.buf]:
+            before = buf.size
+            evicted = buf.evict(size, level)
+            if evicted:
+                freed = before - buf.size
+                if buf is not self.buf:
+                    self.queued_bytes -= freed
+                self.shed_lines(evicted)
+                size -= freed
+            if size <= 0:
+                return
+
+    def evict_below(self, line, level):
+        # Called with the buffer lock held. Shed the lowest level buffered,
+        # then the next, for as long as it is below level.
+        while True:
+            retained = self.retained_with(line)
+            if retained < self.buf_retention_limit:
+                return
+            lowest = min((min(buf.levels)
+                          for buf in self.queued_batches() + [self.buf]
+                          if buf),
+                         default=None)
+            if lowest is None or lowest >= level:
+                return
+            self.evict(retained, lowest)
+
+    def queued_batches(self):
+        # Called with the buffer lock held. The batches lines can still be
+        # shed from, oldest first; not those being sent.
+        return list(self.parked) + list(self.retrying) + list(self.pending)
+
+    def shed_lines(self, lines):
+        # Called with the buffer lock held. lines is {level: count}
+        self.internalLogger.debug(
+            'The buffer size exceeded the limit: %s. Shedding lines (%s)',
+            self.buf_retention_limit, self.overflow_policy)
+        for level, count in lines.items():
+            self.shed[level] = self.shed.get(level, 0) + count
+            self.record_shed(count, logging.getLevelName(level))
+
+    def take_buffer(self):
+        # Called with the buffer lock held
+        buf, self.buf = self.buf, LogBuffer()
+        if self.shed:
+            self.append_shed_summary(buf)
+        self.adapt()
+        return buf
+
+    def append_shed_summary(self, buf):
+        # Report the lines shed since the last batch in this one
+        shed, self.shed = self.shed, {}
+        counts = {
+            logging.getLevelName(level): lines
+            for level, lines in sorted(shed.items())
+        }
+        message = self.build_notice(
+            '%d lines dropped by the %s overflow policy (%s)' %
+            (sum(counts.values()), self.overflow_policy, ', '.join(
+                '%s: %d' % count for count in counts.items())),
+            {'lines_dropped': counts})
+        buf.append(encode_message(message), logging.WARNING)
+
+    def build_notice(self, line, meta):
+        # A line of the handler's own about the lines it has dropped
+        return {
+            'hostname': self.hostname,
+            'timestamp': int(time.time() * 1000),
+            'line': line,
+            'level': 'WARNING',
+            'app': self.app or 'logdna',
+            'env': self.env,
+            'meta': sanitize_meta(meta, self.index_meta)
+        }
+
+    def adapt(self):
+        # Called with the buffer lock held, between batches
+        if not self.flush_policy:
+            return
+        limits = self.flush_policy.limits()
+        if limits != (self.flush_limit, self.flush_interval_secs):
+            self.flush_limit, self.flush_interval_secs = limits
+            self.notify('adapt', flush_limit=self.flush_limit,
+                        flush_interval=self.flush_interval_secs)
+
+    def send_buffer(self, buf):
+        # Called with the buffer lock held
+        request_thread_pool = self.request_thread_pool
+        if request_thread_pool:
+            # Batches wait in pending rather than in the pool's queue, so
+            # that overflow policies can still shed lines from them
+            self.pending.append(buf)
+            self.queued_bytes += buf.size
+            self.begin_handoff()
+            try:
+                request_thread_pool.submit(self.send_pending)
+                return
+            except RuntimeError:
+                self.pending.pop()
+                self.queued_bytes -= buf.size
+                self.end_handoff()
+        self.try_request(buf)
+
+    def send_pending(self):
+        with self._lock:
+            if not self.pending:
+                # Taken by close() when its timeout ran out
+                return
+            buf = self.pending.popleft()
+            self.queued_bytes -= buf.size
+            self.notify_room()
+        try:
+            if buf:
+                self.try_request(buf)
+        finally:
+            self.end_handoff()
+
+    def spool_buffer(self):
+        # Called with the buffer lock held, when the buffer is full
+        if self.buf and self.spool_payload(self.buf, None):
+            self.buf = LogBuffer()
+
+    def spool_payload(self, data, content_encoding):
+        lines = len(data)
+        try:
+            # Keep the encoding and line count with the batch so it is
+            # replayed as is
+            header = '%s %d\n' % (content_encoding or '', lines)
+            self.spool.append(header.encode('ascii') + data.payload())
+            self._stats.incr('lines_spooled', lines)
+            self.notify('spool', lines=lines)
+            return True
+        except Exception as e:
+            self.internalLogger.debug('Error writing to the spool: %s', e)
+            return False
+
+    def schedule_replay(self):
+        with self._inflight_done:
+            if self._replaying or not self.spool.pending():
+                return
+            self._replaying = True
+            self._inflight += 1
+
+        try:
+            self.request_thread_pool.submit(self.replay_spool)
+        except Exception as e:
+            self.internalLogger.debug('Error in calling replay_spool: %s', e)
+            self.end_replay()
+
+    def end_replay(self):
+        with self._inflight_done:
+            self._replaying = False
+        self.end_request()
+
+    def replay_spool(self):
+        # Spooled batches go out oldest first, one at a time, and replay
+        # stops at the first one that needs a retry.
+        try:
+            while not self._closing:
+                entry = self.spool.peek()
+                if entry is None:
+                    break
+                if self.pacer.pause_remaining(time.monotonic()):
+                    break
+                if not self.replay_entry(entry):
+                    break
+        except Exception as e:
+            self.internalLogger.debug('Error in replay_spool: %s', e)
+        finally:
+            self.end_replay()
+
+    def replay_entry(self, entry):
+        # True if the spooled batch was sent. The request slot is taken
+        # first, as allow() may hand out the only probe of a half open
+        # circuit, which must then be sent or given back.
+        token, payload = entry
+        header, data = payload.split(b'\n', 1)
+        content_encoding, lines = parse_spool_header(header)
+        # Replay is started again once a request has been sent
+        if not self.pacer.acquire():
+            return False
+        probe = bool(self.breaker)
+        try:
+            if probe and not self.breaker.allow(time.monotonic()):
+                return False
+            sent = self.send_request(data, content_encoding, lines)
+            probe = False
+        except Exception:
+            if probe:
+                self.breaker.cancel_probe()
+            raise
+        finally:
+            self.pacer.release()
+        if sent:
+            self.spool.commit(token)
+        return sent
+
+    def flush(self, timeout=None):
+        """
+            Without a timeout, start sending the buffer and return None.
+
+            With one, also buffer the records still queued, send the batches
+            waiting for a retry without waiting for their delay, and wait up
+            to timeout seconds for everything to be sent, in parallel.
+            Returns a report of what happened meanwhile, see flush_report().
+        """
+        if timeout is None:
+            self.schedule_flush_sync()
+            return None
+
+        totals = self._stats.totals()
+        flushed = self.flush_until(time.monotonic() + timeout)
+        return self.flush_report(totals, flushed)
+
+    def flush_until(self, deadline):
+        with self._inflight_done:
+            self._urgent += 1
+        try:
+            log_queue = self.log_queue
+            if log_queue is not None:
+                self.drain_log_queue(log_queue)
+            with self._lock:
+                self.collect_shards()
+                if self.buf:
+                    self.send_buffer(self.take_buffer())
+                    self.notify_room()
+                self.close_flusher()
+            for call in self.scheduler.take(self.schedule_retry):
+                self.schedule_retry(*call.args)
+            # Batches parked while the circuit is open are not sent early
+            return (self.wait_for_requests(max(0, deadline - time.monotonic()))
+                    and not self.parked)
+        finally:
+            with self._inflight_done:
+                self._urgent -= 1
+
+    def flush_report(self, totals, flushed):
+        """
+            The lines sent, spooled and dropped since totals were taken,
+            whether every batch was settled in time, and how many are still
+            being sent or retried.
+        """
+        now = self._stats.totals()
+        report = {
+            'flushed': flushed,
+            'lines_sent': 0,
+            'lines_spooled': 0,
+            'lines_dropped': 0,
+            'batches_pending': self.batches_pending()
+        }
+        for key, value in now.items():
+            if isinstance(key, tuple):
+                if key[0] in ('lines_dropped', 'lines_discarded'):
+                    report['lines_dropped'] += value - totals.get(key, 0)
+            elif key in ('lines_sent', 'lines_spooled'):
+                report[key] = value - totals.get(key, 0)
+        return report
+
+    def batches_pending(self):
+        return self._inflight + self._handoffs + len(self.parked)
+
+    def abandon_batches(self):
+        # Called by close() once its timeout has run out, or with the
+        # circuit open. The batches that are not being sent right now are
+        # spooled or dropped.
+        self.scheduler.take(self.release_parked)
+        with self._lock:
+            self._release = None
+            handoffs = len(self.pending)
+            batches = [(buf, None)
+                       for buf in list(self.parked) + list(self.pending)]
+            self.parked.clear()
+            self.pending.clear()
+            self.queued_bytes -= sum(buf.size for buf, _ in batches)
+            self.notify_room()
+        for _ in range(handoffs):
+            self.end_handoff()
+        retries = [call.args for call in
+                   self.scheduler.take(self.schedule_retry)]
+        retries += [args for _, args in self.pacer.take()]
+        batches += [args[:2] for args in retries]
+
+        for data, content_encoding in batches:
+            if not data:
+                continue
+            if self.spool and self.spool_payload(data, content_encoding):
+                self.internalLogger.debug(
+                    'Closing before the batch was sent. Spooling it to disk')
+            else:
+                self.internalLogger.debug(
+                    'Closing before the batch was sent. Discarding it')
+                self.record_discard(len(data), 'shutdown')
+        for args in retries:
+            self.end_request(args[0])
 
     def schedule_flush_sync(self, should_block=False):
         if self.request_thread_pool:
@@ -136,169 +1103,587 @@ class LogDNAHandler(logging.Handler):
                     'Error in calling try_lock_and_do_flush_request: %s', e)
 
     def try_lock_and_do_flush_request(self, should_block=False):
-        local_buf = []
+        local_buf = None
         if self._lock.acquire(blocking=should_block):
-            if not self.buf:
-                self.close_flusher()
-                self._lock.release()
-                return
-
-            local_buf = self.buf.copy()
-            self.buf.clear()
-            self.buf_size = 0
-            if local_buf:
-                self.close_flusher()
+            self.collect_shards()
+            if self.buf:
+                local_buf = self.take_buffer()
+                self.notify_room()
+            self.close_flusher()
             self._lock.release()
 
         if local_buf:
             self.try_request(local_buf)
 
+    def stream_payload(self, buf):
+        """
+            Send the flush payload in chunks straight from the buffer, so
+            that only a chunk of it is copied at a time, or the payload
+            compressed by compress_batch().
+        Returns:
+            (chunks or compressed bytes, content_encoding)
+        """
+        if buf.compressed is not None:
+            return buf.compressed, self.compression
+        return buf.iter_payload(defaults['STREAM_CHUNK_BYTES']), None
+
+    def compress_batch(self, buf):
+        # Compress the payload once, a chunk at a time, before the first
+        # attempt takes a request slot, and send the same bytes on retries
+        if (self.compression and isinstance(buf, LogBuffer)
+                and buf.compressed is None
+                and buf.size >= self.compression_threshold):
+            chunks = buf.iter_payload(defaults['STREAM_CHUNK_BYTES'])
+            buf.compressed = b''.join(
+                iter_compressed(chunks, self.compression,
+                                self.compression_level))
+
+    def compress_payload(self, body):
+        if not self.compression or len(body) < self.compression_threshold:
+            return body, None
+
+        return compress(body, self.compression,
+                        self.compression_level), self.compression
+
+    def begin_request(self, buf=None):
+        # A batch's bytes count against buf_retention_limit until it is
+        # sent, spooled or dropped, retries included
+        if buf is not None:
+            with self._lock:
+                self.queued_bytes += buf.size
+        with self._inflight_done:
+            self._inflight += 1
+
+    def end_request(self, buf=None):
+        if buf is not None:
+            with self._lock:
+                self.take_retrying(buf)
+                self.queued_bytes -= buf.size
+                self.notify_room()
+        with self._inflight_done:
+            self._inflight -= 1
+            self._inflight_done.notify_all()
+
+    def begin_handoff(self):
+        with self._inflight_done:
+            self._handoffs += 1
+
+    def end_handoff(self):
+        with self._inflight_done:
+            self._handoffs -= 1
+            self._inflight_done.notify_all()
+
+    def wait_for_requests(self, timeout=None):
+        """Wait for in-flight and retrying batches. False on timeout"""
+        with self._inflight_done:
+            return self._inflight_done.wait_for(
+                lambda: self._inflight == 0 and self._handoffs == 0, timeout)
+
     def try_request(self, buf):
-        data = {'e': 'ls', 'ls': buf}
-        retries = 0
-        while retries < self.max_retry_attempts:
-            retries += 1
-            if self.send_request(data):
-                break
-
-            sleep_time = self.retry_interval_secs * (1 << (retries - 1))
-            sleep_time += self.max_retry_jitter
-            time.sleep(sleep_time)
-
-        if retries >= self.max_retry_attempts:
+        if not isinstance(buf, LogBuffer):
+            buf = LogBuffer(encode_message(message) for message in buf)
+        for part in self.partition_batch(buf):
+            self._stats.incr('batches')
+            self._stats.observe('batch_bytes', part.size)
+            self.begin_request(part)
+            self.attempt_request(part, None, 1)
+
+    def partition_batch(self, buf):
+        # Batches go out in requests of at most max_request_bytes
+        if buf.size + PAYLOAD_OVERHEAD <= self.max_request_bytes:
+            return [buf]
+        return buf.partition(self.max_request_bytes - PAYLOAD_OVERHEAD)
+
+    def split_rejected(self, buf, status_code):
+        """
+            A batch rejected as a whole may have been rejected for a few of
+            its lines. Send each half of it on its own, so that only those
+            lines are discarded in the end. Splitting stops MAX_SPLIT_DEPTH
+            halvings down, or once both halves of a split are rejected too.
+            True if the batch was split.
+        """
+        if (status_code not in REJECTED_STATUSES
+                or not isinstance(buf, LogBuffer)):
+            return False
+        split = buf.split
+        if split:
+            with self._lock:
+                split.rejected += 1
+            if split.depth >= MAX_SPLIT_DEPTH or split.request_fault():
+                return False
+        if len(buf) < 2:
+            return False
+        self.internalLogger.debug(
+            'A batch of %d lines was rejected. Sending each half of it',
+            len(buf))
+        self._stats.incr('batches_split')
+        halves = Split(split)
+        for half in buf.halves():
+            half.split = halves
+            self.send_split(half)
+        return True
+
+    def send_split(self, buf):
+        # From the scheduler, as the request slot of the rejected batch is
+        # still held
+        self.begin_request(buf)
+        self.retry_later(0, buf, None, 1)
+
+    def take_retrying(self, buf):
+        # Called with the buffer lock held
+        if self.retrying:
+            try:
+                self.retrying.remove(buf)
+            except ValueError:
+                pass
+
+    def attempt_request(self, data, content_encoding, attempt):
+        try:
+            # Lines can no longer be shed from the batch once it is sent
+            with self._lock:
+                self.take_retrying(data)
+            if self.hold_attempt(data, content_encoding, attempt):
+                return
+            self.compress_batch(data)
+            # Without a free slot, the batch is sent once a request frees
+            # one, rather than holding up a request thread until then
+            if not self.pacer.acquire(self.schedule_send, data,
+                                      content_encoding, attempt):
+                return
+        except Exception as e:
+            self.fail_request(data, e)
+            return
+        self.send_attempt(data, content_encoding, attempt)
+
+    def send_attempt(self, data, content_encoding, attempt):
+        # With a slot taken from the pacer
+        try:
+            try:
+                sent = self.send_request(data, content_encoding)
+            finally:
+                self.pacer.release()
+            if sent:
+                self.end_request(data)
+                if self.spool:
+                    self.schedule_replay()
+                return
+
+            if attempt >= self.max_retry_attempts:
+                self.give_up_request(data, content_encoding)
+                return
+
+            # A Retry-After pause stands in for the exponential backoff
+            delay = self.pacer.pause_remaining(time.monotonic())
+            if not delay and not self._urgent:
+                delay = self.retry_interval_secs * (1 << (attempt - 1))
+            if delay:
+                delay += random.uniform(0, self.max_retry_jitter)
+            self.record_retry(attempt, delay, len(data))
+            self.retry_later(delay, data, content_encoding, attempt + 1)
+        except Exception as e:
+            self.fail_request(data, e)
+
+    def fail_request(self, data, e):
+        self.internalLogger.debug(
+            'Error in attempt_request: %s. Discarding flush buffer', e)
+        self.record_discard(len(data), 'error')
+        self.record_circuit(False)
+        self.end_request(data)
+
+    def park(self, data, content_encoding):
+        # The circuit is open: spool the batch, or hold it against
+        # buf_retention_limit until the circuit closes, without a request
+        if self.spool and self.spool_payload(data, content_encoding):
+            self.internalLogger.debug(
+                'The circuit is open. Spooling flush buffer to disk')
+        else:
+            with self._lock:
+                self.parked.append(data)
+                self.queued_bytes += data.size
+                self.schedule_release()
+        self.end_request(data)
+
+    def schedule_release(self):
+        # Called with the buffer lock held. Parked batches are sent again
+        # once the circuit closes, and one of them probes it once it is due
+        # to half open; while a probe is under way, its outcome decides.
+        if self.breaker.state == CLOSED:
+            self.release_parked()
+        elif self.breaker.state == OPEN and self._release is None:
+            self._release = self.call_later(
+                self.breaker.remaining(time.monotonic()), self.release_parked)
+
+    def release_parked(self):
+        # Parked batches start over with a fresh set of attempts
+        with self._lock:
+            self._release = None
+            batches = [buf for buf in self.parked if buf]
+            self.queued_bytes -= sum(buf.size for buf in self.parked)
+            self.parked.clear()
+            for buf in batches:
+                self.begin_request(buf)
+            self.notify_room()
+        for buf in batches:
+            self.schedule_retry(buf, None, 1)
+        if self.spool:
+            self.schedule_replay()
+
+    def record_circuit(self, ok):
+        if not self.breaker:
+            return
+        state = self.breaker.record(ok, time.monotonic())
+        if state is None:
+            return
+        self.internalLogger.debug('The ingestion circuit is now %s', state)
+        self._stats.incr(('circuit_transitions', state))
+        self.notify('circuit', state=state)
+        with self._lock:
+            self.schedule_release()
+
+    def hold_attempt(self, data, content_encoding, attempt):
+        # True if the attempt is put off without a request: retried once a
+        # Retry-After pause is over, without counting it as an attempt, or
+        # parked while the circuit is open. allow() lets a probe through,
+        # so it comes last.
+        pause = self.pacer.pause_remaining(time.monotonic())
+        if pause:
+            self.retry_later(pause + random.uniform(0, self.max_retry_jitter),
+                             data, content_encoding, attempt)
+            return True
+        if self.breaker and not self.breaker.allow(time.monotonic()):
+            self.park(data, content_encoding)
+            return True
+        return False
+
+    def retry_later(self, delay, data, content_encoding, attempt):
+        # Wait for the retry on the scheduler rather than sleeping, so the
+        # request thread is free to send other batches meanwhile. Lines can
+        # be shed from the batch until then.
+        with self._lock:
+            self.retrying.append(data)
+        try:
+            self.scheduler.call_later(delay, self.schedule_retry, data,
+                                      content_encoding, attempt)
+        except RuntimeError:
+            # The handler was closed with a timeout that has run out
+            self.give_up_request(data, content_encoding)
+
+    def give_up_request(self, data, content_encoding):
+        if self.spool and self.spool_payload(data, content_encoding):
+            self.internalLogger.debug(
+                'Flush exceeded %s tries. Spooling flush buffer to disk',
+                self.max_retry_attempts)
+        else:
             self.internalLogger.debug(
                 'Flush exceeded %s tries. Discarding flush buffer',
                 self.max_retry_attempts)
+            self.record_discard(len(data), 'retries')
+        self.end_request(data)
+
+    def schedule_retry(self, data, content_encoding, attempt):
+        self.run_request(self.attempt_request, data, content_encoding,
+                         attempt)
+
+    def schedule_send(self, data, content_encoding, attempt):
+        # The pacer has taken a slot for a batch that was waiting for one
+        self.run_request(self.send_attempt, data, content_encoding, attempt)
 
-    def send_request(self, data):  # noqa: max-complexity: 13
+    def run_request(self, fn, *args):
+        # Once close() has shut down the handler's request threads, a
+        # handler on an engine goes on sending on the engine's rather than
+        # on the scheduler thread, which the engine shares with other
+        # handlers
+        executors = [self.request_thread_pool]
+        if self.engine:
+            executors.append(self.engine.request_thread_pool)
+        for request_thread_pool in executors:
+            if request_thread_pool:
+                try:
+                    request_thread_pool.submit(fn, *args)
+                    return
+                except RuntimeError:
+                    pass
+        fn(*args)
+
+    def request_params(self):
+        return {
+            'hostname': self.hostname,
+            'ip': self.ip,
+            'mac': self.mac,
+            'tags': self.tags,
+            'now': int(time.time() * 1000)
+        }
+
+    def request_headers(self, content_encoding=None):
+        headers = {
+            'user-agent': self.user_agent,
+            'apikey': self.key,
+            'content-type': 'application/json; charset=UTF-8'
+        }
+        if content_encoding:
+            headers['content-encoding'] = content_encoding
+        return headers
+
+    def send_request(self, data, content_encoding=None, lines=None):
         """
-            Send log data to LogDNA server
+            Send log data to LogDNA server. data is either a LogBuffer,
+            streamed with chunked transfer encoding, or an already encoded
+            (and possibly compressed) JSON payload of the given number of
+            lines
         Returns:
             True  - discard flush buffer
             False - retry, keep flush buffer
         """
+        sent = [0]  # Bytes of the request body, counted as it is streamed
+        buf = data
+        session = self.session
+        import requests
         try:
-            headers = {
-                'user-agent': self.user_agent,
-                'apikey': self.key
-            }
-            response = requests.post(url=self.url,
-                                     json=data,
-                                     params={
-                                         'hostname': self.hostname,
-                                         'ip': self.ip,
-                                         'mac': self.mac,
-                                         'tags': self.tags,
-                                         'now': int(time.time() * 1000)
-                                     },
-                                     stream=True,
-                                     allow_redirects=True,
-                                     timeout=self.request_timeout,
-                                     headers=headers)
-
-            status_code = response.status_code
-            '''
-                response code:
-                    1XX                       unexpected status
-                    200                       expected status, OK
-                    2XX                       unexpected status
-                    301 302 303               unexpected status,
-                                              per "allow_redirects=True"
-                    3XX                       unexpected status
-                    401, 403                  expected client error,
-                                              invalid ingestion key
-                    429                       expected server error,
-                                              "client error", transient
-                    4XX                       unexpected client error
-                    500 502 503 504 507       expected server error, transient
-                    5XX                       unexpected server error
-                handling:
-                    expected status           discard flush buffer
-                    unexpected status         log + discard flush buffer
-                    expected client error     log + discard flush buffer
-                    unexpected client error   log + discard flush buffer
-                    expected server error     log + retry
-                    unexpected server error   log + discard flush buffer
-            '''
-            if status_code == 200:
-                return True  # discard
-
-            if isinstance(response.reason, bytes):
-                # We attempt to decode utf-8 first because some servers
-                # choose to localize their reason strings. If the string
-                # isn't utf-8, we fall back to iso-8859-1 for all other
-                # encodings. (See PR #3538)
-                try:
-                    reason = response.reason.decode('utf-8')
-                except UnicodeDecodeError:
-                    reason = response.reason.decode('iso-8859-1')
+            if isinstance(data, bytes):
+                sent[0] = len(data)
             else:
-                reason = response.reason
-
-            if 200 < status_code <= 399:
-                self.internalLogger.debug('Unexpected response: %s. ' +
-                                          'Discarding flush buffer',
-                                          reason)
-                if self.log_error_response:
-                    self.internalLogger.debug(
-                        'Error Response: %s', response.text)
-                return True  # discard
-
-            if status_code in [401, 403]:
-                self.internalLogger.debug(
-                    'Please provide a valid ingestion key. ' +
-                    'Discarding flush buffer')
-                if self.log_error_response:
-                    self.internalLogger.debug(
-                        'Error Response: %s', response.text)
-                return True  # discard
-
-            if status_code == 429:
-                self.internalLogger.debug('Client Error: %s. Retrying...',
-                                          reason)
-                if self.log_error_response:
-                    self.internalLogger.debug(
-                        'Error Response: %s', response.text)
-                return False  # retry
-
-            if 400 <= status_code <= 499:
-                self.internalLogger.debug('Client Error: %s. ' +
-                                          'Discarding flush buffer',
-                                          reason)
-                if self.log_error_response:
-                    self.internalLogger.debug(
-                        'Error Response: %s', response.text)
-                return True  # discard
-
-            if status_code in [500, 502, 503, 504, 507]:
-                self.internalLogger.debug('Server Error: %s. Retrying...',
-                                          reason)
-                if self.log_error_response:
-                    self.internalLogger.debug(
-                        'Error Response: %s', response.text)
-                return False  # retry
-
-            self.internalLogger.debug('The request failed: %s.' +
-                                      'Discarding flush buffer',
-                                      reason)
+                lines = len(data)
+                data, content_encoding = self.stream_payload(data)
+                if isinstance(data, bytes):
+                    sent[0] = len(data)
+                else:
+                    data = self.count_bytes(data, sent)
+            self.reap_idle_connections()
+            started = time.monotonic()
+            response = session.post(
+                url=self.url,
+                data=data,
+                params=self.request_params(),
+                stream=True,
+                allow_redirects=True,
+                timeout=self.request_timeout,
+                headers=self.request_headers(content_encoding))
+
+            # Consume the body so the connection goes back to the pool
+            response.content
+            latency = time.monotonic() - started
+
+            discard = self.handle_response(response.status_code,
+                                           self.response_reason(response),
+                                           lambda: response.text)
+            split = self.split_rejected(buf, response.status_code)
+            self.record_response(response.status_code, discard and not split,
+                                 latency, sent[0], lines or 0,
+                                 response.headers.get('retry-after'))
+            return discard
 
         except requests.exceptions.Timeout as timeout:
             self.internalLogger.debug('Timeout Error: %s. Retrying...',
                                       timeout)
+            self.record_request_error('timeout')
             return False  # retry
 
         except requests.exceptions.RequestException as exception:
             self.internalLogger.debug(
                 'Error sending logs %s. Discarding flush buffer', exception)
+            self.record_request_error('connection')
+            self.record_discard(lines or 0, 'error')
 
         return True  # discard
 
-    def emit(self, record):
+    def count_bytes(self, chunks, sent):
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+
+    def response_reason(self, response):
+        if isinstance(response.reason, bytes):
+            # We attempt to decode utf-8 first because some servers
+            # choose to localize their reason strings. If the string
+            # isn't utf-8, we fall back to iso-8859-1 for all other
+            # encodings. (See PR #3538)
+            try:
+                return response.reason.decode('utf-8')
+            except UnicodeDecodeError:
+                return response.reason.decode('iso-8859-1')
+        return response.reason
+
+    def handle_response(self, status_code,  # noqa: max-complexity: 13
+                        reason, response_text):
+        """
+            Decide what to do with a flush buffer from the ingestion
+            response. response_text is called for the body only when
+            log_error_response is set.
+        Returns:
+            True  - discard flush buffer
+            False - retry, keep flush buffer
+        """
+        '''
+            response code:
+                1XX                       unexpected status
+                200                       expected status, OK
+                2XX                       unexpected status
+                301 302 303               unexpected status,
+                                          per "allow_redirects=True"
+                3XX                       unexpected status
+                401, 403                  expected client error,
+                                          invalid ingestion key
+                429                       expected server error,
+                                          "client error", transient
+                4XX                       unexpected client error
+                500 502 503 504 507       expected server error, transient
+                5XX                       unexpected server error
+            handling:
+                expected status           discard flush buffer
+                unexpected status         log + discard flush buffer
+                expected client error     log + discard flush buffer
+                unexpected client error   log + discard flush buffer
+                expected server error     log + retry
+                unexpected server error   log + discard flush buffer
+        '''
+        if status_code == 200:
+            return True  # discard
+
+        if 200 < status_code <= 399:
+            self.internalLogger.debug('Unexpected response: %s. ' +
+                                      'Discarding flush buffer',
+                                      reason)
+            if self.log_error_response:
+                self.internalLogger.debug(
+                    'Error Response: %s', response_text())
+            return True  # discard
+
+        if status_code in [401, 403]:
+            self.internalLogger.debug(
+                'Please provide a valid ingestion key. ' +
+                'Discarding flush buffer')
+            if self.log_error_response:
+                self.internalLogger.debug(
+                    'Error Response: %s', response_text())
+            return True  # discard
+
+        if status_code == 429:
+            self.internalLogger.debug('Client Error: %s. Retrying...',
+                                      reason)
+            if self.log_error_response:
+                self.internalLogger.debug(
+                    'Error Response: %s', response_text())
+            return False  # retry
+
+        if 400 <= status_code <= 499:
+            self.internalLogger.debug('Client Error: %s. ' +
+                                      'Discarding flush buffer',
+                                      reason)
+            if self.log_error_response:
+                self.internalLogger.debug(
+                    'Error Response: %s', response_text())
+            return True  # discard
+
+        if status_code in [500, 502, 503, 504, 507]:
+            self.internalLogger.debug('Server Error: %s. Retrying...',
+                                      reason)
+            if self.log_error_response:
+                self.internalLogger.debug(
+                    'Error Response: %s', response_text())
+            return False  # retry
+
+        self.internalLogger.debug('The request failed: %s.' +
+                                  'Discarding flush buffer',
+                                  reason)
+        return True  # discard
+
+    def stats(self):
+        """
+            A snapshot of the handler's counters (see README), along with
+            the current depth of the ingestion queue, the buffer, the
+            requests in flight and the spool
+        """
+        snapshot = self._stats.snapshot()
+        log_queue = self.log_queue
+        snapshot['queue_depth'] = log_queue.qsize() if log_queue else 0
+        staged = [shard.buf for shard in self.shards or ()]
+        snapshot['buffered_lines'] = len(self.buf) + sum(map(len, staged))
+        snapshot['buffered_bytes'] = (self.buf.size + self.queued_bytes +
+                                      sum(buf.size for buf in staged))
+        snapshot['inflight_requests'] = self._inflight
+        snapshot['flush_limit'] = self.flush_limit
+        snapshot['flush_interval'] = self.flush_interval_secs
+        if self.flush_policy:
+            snapshot.update(self.flush_policy.state())
+        snapshot['concurrency_limit'] = int(self.pacer.limit)
+        snapshot['paused_secs'] = self.pacer.pause_remaining(time.monotonic())
+        if self.breaker:
+            snapshot['circuit_state'] = self.breaker.state
+            snapshot['circuit_failures'] = self.breaker.failures
+            snapshot['parked_batches'] = len(self.parked)
+        if self.spool:
+            snapshot['spool_bytes'] = self.spool.size
+            snapshot['spool_dropped_batches'] = self.spool.dropped_batches
+        return snapshot
+
+    def notify(self, event, **fields):
+        if self.stats_callback:
+            try:
+                self.stats_callback(event, fields)
+            except Exception as e:
+                self.internalLogger.debug('Error in stats_callback: %s', e)
+
+    def record_drop(self, lines, reason):
+        self._stats.incr(('lines_dropped', reason), lines)
+        self.notify('drop', lines=lines, reason=reason)
+
+    def record_discard(self, lines, reason):
+        self._stats.incr(('lines_discarded', reason), lines)
+        self.notify('discard', lines=lines, reason=reason)
+
+    def record_shed(self, lines, level):
+        self._stats.incr(('lines_dropped', 'retention'), lines)
+        self._stats.incr(('lines_shed', level), lines)
+        self.notify('drop', lines=lines, reason='retention', level=level)
+
+    def record_retry(self, attempt, delay, lines):
+        self._stats.incr('retries')
+        self.notify('retry', attempt=attempt, delay=delay, lines=lines)
+
+    def record_request_error(self, kind):
+        self._stats.incr(('request_errors', kind))
+        self.record_circuit(False)
+        if self.flush_policy:
+            self.flush_policy.observe_request(None, False)
+
+    def record_response(self, status_code, discard, latency, size, lines,
+                        retry_after=None):
+        stats = self._stats
+        stats.incr('requests')
+        stats.incr(('status_codes', status_code))
+        stats.observe('request_latency', latency)
+        if self.flush_policy:
+            self.flush_policy.observe_request(latency,
+                                              200 <= status_code < 300)
+        if 200 <= status_code < 300:
+            stats.incr('batches_sent')
+            stats.incr('lines_sent', lines)
+            stats.incr('bytes_sent', size)
+        elif discard:
+            self.record_discard(lines, 'status')
+        self.notify('request', status_code=status_code, latency=latency,
+                    bytes=size, lines=lines)
+        # Any answer short of a server error shows ingestion is up
+        self.record_circuit(status_code < 500)
+        self.record_pacing(status_code, retry_after)
+
+    def record_pacing(self, status_code, retry_after):
+        if 200 <= status_code < 300:
+            self.pacer.succeeded()
+        elif status_code in (429, 503):
+            retry_after = parse_retry_after(retry_after)
+            self.pacer.throttled(retry_after, time.monotonic())
+            self.notify('backoff',
+                        status_code=status_code,
+                        retry_after=retry_after,
+                        concurrency=int(self.pacer.limit))
+
+    def build_message(self, record, meta=None, timestamp=None):
         msg = self.format(record)
         record = record.__dict__
         message = {
             'hostname': self.hostname,
-            'timestamp': int(time.time() * 1000),
+            'timestamp': timestamp or int(time.time() * 1000),
             'line': msg,
             'level': record['levelname'] or self.loglevel,
             'app': self.app or record['module'],
@@ -312,6 +1697,8 @@ class LogDNAHandler(logging.Handler):
                     message['meta'][key] = list(record[key])
                 elif record[key] is not None:
                     message['meta'][key] = record[key]
+        if meta:
+            message['meta'].update(meta)
 
         message['meta'] = sanitize_meta(message['meta'], self.index_meta)
 
@@ -323,20 +1710,207 @@ class LogDNAHandler(logging.Handler):
             if key in opts:
                 message[key] = opts[key]
 
+        return message
+
+    def build_captured(self, record):
+        # Build the message of a record queued by emit() with
+        # defer_formatting, timestamped with when it was logged. Errors are
+        # reported like those raised in emit() by other handlers.
+        try:
+            return self.build_message(record,
+                                      timestamp=int(record.created * 1000))
+        except Exception:
+            self._stats.incr('lines_in')
+            self.record_drop(1, 'format')
+            self.handleError(record)
+            return None
+
+    def emit(self, record):
+        if self.throttling and not self.admit(record):
+            return
+        if self.defer_formatting:
+            self.emit_message(capture_record(record))
+        else:
+            self.emit_message(self.build_message(record))
+
+    def emit_message(self, message):
         self.buffer_log(message)
 
-    def close(self):
-        # Close the flusher
+    def emit_many(self, records):
+        """
+            Buffer an iterable of LogRecords, as if each had been logged to
+            this handler: the handler's level and filters, deduplication and
+            rate limiting apply. They go straight to the buffer, a chunk at
+            a time, instead of one at a time through the ingestion queue.
+        """
+        self.buffer_many(self.build_messages(records))
+
+    def build_messages(self, records):
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            if self.throttling and not self.admit(record):
+                continue
+            try:
+                yield self.build_message(record)
+            except Exception:
+                self.handleError(record)
+
+    def send_lines(self, lines, options={}):
+        """
+            Buffer an iterable of lines, a chunk at a time. The level, app,
+            env, meta and index_meta in options apply to all of them, as
+            the options of a single line do, and each is timestamped when
+            it is buffered.
+        """
+        template = {
+            'hostname': self.hostname,
+            'level': options.get('level', self.loglevel),
+            'app': options.get('app', self.app),
+            'env': options.get('env', self.env),
+            'meta': sanitize_meta(dict(options.get('meta', None) or {}),
+                                  options.get('index_meta', self.index_meta))
+        }
+        self.buffer_many(
+            dict(template, line=line, timestamp=int(time.time() * 1000))
+            for line in lines)
+
+    def buffer_many(self, messages):
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= self.drain_batch_size:
+                self.buffer_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.buffer_chunk(chunk)
+
+    def buffer_chunk(self, messages):
+        # Encoded outside the lock, then buffered under a single hold of it
+        if not self._has_room.is_set():
+            # The buffer is full under the block overflow policy
+            self._has_room.wait(self.overflow_timeout)
+        self.buffer_logs_sync(messages)
+
+    def admit(self, record):
+        # Called from emit when deduplication or rate limiting is on
+        now = time.monotonic()
+        reason = None
+        with self._throttle_lock:
+            if self.deduplicator and not self.deduplicator.admit(
+                    record, now):
+                reason = 'duplicate'
+            elif self.rate_limiter and not self.rate_limiter.admit(
+                    record.name, now):
+                reason = 'rate_limit'
+            if reason:
+                self.schedule_throttle_report()
+            repeated = (self.deduplicator.take_repeated()
+                        if self.deduplicator else None)
+
+        if repeated:
+            self.report_throttled(repeated, None)
+        if reason == 'duplicate':
+            self._stats.incr('lines_deduplicated')
+        elif reason:
+            self.record_drop(1, reason)
+        return reason is None
+
+    def schedule_throttle_report(self):
+        # Called with the throttle lock held
+        if self._throttle_report is None:
+            self._throttle_report = self.call_later(
+                self.deduplicator.window if self.deduplicator else
+                defaults['RATE_LIMIT_REPORT_SECS'], self.report_throttle)
+
+    def report_throttle(self, now=None):
+        # Send the repeat counts of the deduplication windows that have
+        # ended, and the number of lines each rate limited logger dropped
+        with self._throttle_lock:
+            self._throttle_report = None
+            repeated = dropped = None
+            if self.deduplicator:
+                self.deduplicator.expire(
+                    time.monotonic() if now is None else now)
+                repeated = self.deduplicator.take_repeated()
+                if self.deduplicator.suppressed:
+                    self.schedule_throttle_report()
+            if self.rate_limiter:
+                dropped = self.rate_limiter.take_dropped()
+        self.report_throttled(repeated, dropped)
+
+    def report_throttled(self, repeated, dropped):
+        for record, repeats in repeated or ():
+            try:
+                self.emit_message(
+                    self.build_message(record, {'repeated': repeats}))
+            except Exception as e:
+                self.internalLogger.debug('Error reporting repeats: %s', e)
+        for name, lines in sorted((dropped or {}).items()):
+            self.emit_message(
+                self.build_notice(
+                    '%d lines from logger %s dropped by the rate limit' %
+                    (lines, name), {
+                        'logger': name,
+                        'lines_dropped': lines
+                    }))
+
+    def close(self, timeout=None):
+        """
+            Send what is left and stop. Without a timeout, waits until every
+            batch has been sent or given up on. With one, returns within
+            about timeout seconds: batches that have not been sent by then
+            are spooled, or dropped, apart from requests already under way,
+            which are left to finish in the background. Returns a report
+            like flush(timeout).
+        """
+        # logging.shutdown() closes every handler again at exit, which must
+        # not wait for the requests left to finish in the background
+        if self._close_report is not None:
+            return self._close_report
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        totals = self._stats.totals()
+
+        # Close the flusher. Spooled batches that have not been replayed yet
+        # stay on disk for the next start.
+        self._closing = True
+        self._has_room.set()
         self.close_flusher()
 
-        # First gracefully shut down any threads that are still attempting
-        # to add log messages to the buffer. This ensures that we don't lose
-        # any log messages that are in the process of being added to the
-        # buffer.
-        if self.worker_thread_pool:
-            self.worker_thread_pool.shutdown(wait=True)
-            self.worker_thread_pool = None
+        # Report what deduplication and rate limiting have held back
+        if self.throttling:
+            self.report_throttle(float('inf'))
+
+        # First drain the ingestion queue into the buffer. This ensures that
+        # we don't lose any log messages that are in the process of being
+        # added to the buffer.
+        self.stop_log_consumer(timeout)
+
+        if deadline is None:
+            # Batches parked while the circuit is open are not waited for
+            flushed = self.flush_and_wait() and not self.parked
+        else:
+            flushed = self.flush_until(deadline)
+            if self.request_thread_pool:
+                self.request_thread_pool.shutdown(wait=False)
+                self.request_thread_pool = None
+        if not flushed:
+            self.abandon_batches()
+        self.scheduler.shutdown(wait=deadline is None)
+        if self.spool:
+            self.spool.close()
 
+        # Release any keep-alive connections held by the pool.
+        if self._session is not None:
+            self._session.close()
+
+        logging.Handler.close(self)
+        self._close_report = self.flush_report(totals, flushed)
+        return self._close_report
+
+    def flush_and_wait(self):
         # Manually force a flush of any remaining log messages in the buffer.
         # We block here to ensure that the flush completes prior to the
         # application exiting and because the probability of this
@@ -345,11 +1919,13 @@ class LogDNAHandler(logging.Handler):
         self.schedule_flush_sync(should_block=True)
 
         # Finally, shut down the thread pool that was used to send the log
-        # messages to the server. We can assume at this point that all log
-        # messages that were in the buffer prior to the worker threads
-        # shutting down have been sent to the server.
+        # messages to the server, then wait for any batches still waiting
+        # on a retry; those now run on the scheduler thread, or on the
+        # engine's request threads, see run_request(). We can assume
+        # at this point that all log messages that were in the buffer prior
+        # to the worker threads shutting down have been sent to the server.
         if self.request_thread_pool:
             self.request_thread_pool.shutdown(wait=True)
             self.request_thread_pool = None
 
-        logging.Handler.close(self)
+        return self.wait_for_requests()
@@ -0,0 +1,79 @@
+import collections
+import threading
+
+
+class RequestPacer():
+    """
+        Paces the requests to an ingestion endpoint that throttles them.
+
+        A Retry-After pause holds back every request until it is over, not
+        only the batch that was throttled. The number of requests sent at
+        once follows AIMD: each throttled response halves it, down to one,
+        and it grows back by one for every limit's worth of successful
+        requests. Requests wait for a slot in order, without holding up a
+        thread. Thread-safe.
+    """
+    def __init__(self, max_concurrency, max_pause):
+        self.max_concurrency = max_concurrency
+        self.max_pause = max_pause
+        self.limit = float(max_concurrency)
+        self.paused_until = 0
+        self.sending = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def pause_remaining(self, now):
+        return max(0, self.paused_until - now)
+
+    def throttled(self, retry_after, now):
+        """A request was throttled; retry_after is in seconds or None"""
+        with self._lock:
+            self.limit = max(1.0, self.limit / 2)
+            if retry_after is not None:
+                self.paused_until = max(
+                    self.paused_until, now + min(retry_after, self.max_pause))
+
+    def succeeded(self):
+        with self._lock:
+            if self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1 / self.limit)
+            granted = self._grant()
+        for fn, args in granted:
+            fn(*args)
+
+    def acquire(self, fn=None, *args):
+        """
+            Take a slot to send a request within the limit, True if there
+            was one free. If not, fn(*args) is called once a slot is taken
+            for it, from the thread that freed it.
+        """
+        with self._lock:
+            if not self._waiters and self.sending < int(self.limit):
+                self.sending += 1
+                return True
+            if fn is not None:
+                self._waiters.append((fn, args))
+            return False
+
+    def release(self):
+        with self._lock:
+            self.sending -= 1
+            granted = self._grant()
+        for fn, args in granted:
+            fn(*args)
+
+    def take(self):
+        """Stop waiting for slots and return the (fn, args) waiting"""
+        with self._lock:
+            waiters = list(self._waiters)
+            self._waiters.clear()
+        return waiters
+
+    def _grant(self):
+        # Called with the lock held
+        granted = []
+        while self._waiters and self.sending < int(self.limit):
+            self.sending += 1
+            granted.append(self._waiters.popleft())
+        return granted
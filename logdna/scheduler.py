@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ScheduledCall():
+    __slots__ = ('when', 'fn', 'args', 'owner', 'cancelled', 'done')
+
+    def __init__(self, when, fn, args, owner=None):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.owner = owner
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def remaining(self):
+        return max(0.0, self.when - time.monotonic())
+
+
+class Scheduler():
+    """
+        Runs callbacks after a delay on a single long-lived thread, instead
+        of starting a threading.Timer (and so a new thread) for every call.
+        Callbacks should be short; anything slow belongs in a thread pool.
+    """
+    def __init__(self, name='logdna-scheduler'):
+        self.name = name
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._current = None
+
+    def call_later(self, delay, fn, *args, owner=None):
+        call = ScheduledCall(time.monotonic() + delay, fn, args, owner)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('cannot schedule new calls after shutdown')
+
+            heapq.heappush(self._queue, (call.when, next(self._counter), call))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name=self.name,
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        return call
+
+    def take(self, fn):
+        """Cancel the calls to fn that have not started, and return them"""
+        taken = []
+        with self._condition:
+            for _, _, call in self._queue:
+                if call.fn == fn and not call.cancelled:
+                    call.cancel()
+                    taken.append(call)
+        return taken
+
+    def cancel_owned(self, owner, wait=False):
+        """
+            Cancel the calls scheduled for owner and, with wait, wait for
+            the one that is running
+        """
+        with self._condition:
+            for _, _, call in self._queue:
+                if call.owner is owner:
+                    call.cancel()
+            if wait and self._thread is not threading.current_thread():
+                self._condition.wait_for(
+                    lambda: self._current is None or self._current.owner is
+                    not owner)
+
+    def client(self):
+        return SchedulerClient(self)
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._condition.notify_all()
+            thread = self._thread
+        if wait and thread and thread is not threading.current_thread():
+            thread.join()
+
+    def _next_call(self):
+        with self._condition:
+            while not self._stopped:
+                while self._queue and self._queue[0][2].cancelled:
+                    heapq.heappop(self._queue)
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                delay = self._queue[0][0] - time.monotonic()
+                if delay <= 0:
+                    self._current = heapq.heappop(self._queue)[2]
+                    return self._current
+                self._condition.wait(delay)
+        return None
+
+    def _run(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+
+            call.done = True
+            try:
+                call.fn(*call.args)
+            except Exception:
+                logging.getLogger('internal').exception(
+                    'Error in scheduled call %s', call.fn)
+            with self._condition:
+                self._current = None
+                self._condition.notify_all()
+            # Don't keep the callback (and its handler) alive while waiting
+            del call
+
+
+class SchedulerClient():
+    """
+        A handler's share of a Scheduler that other handlers use as well.
+        Shutting it down only cancels the calls scheduled through it, and
+        the thread keeps running for the others.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._stopped = False
+
+    def call_later(self, delay, fn, *args):
+        if self._stopped:
+            raise RuntimeError('cannot schedule new calls after shutdown')
+        return self.scheduler.call_later(delay, fn, *args, owner=self)
+
+    def take(self, fn):
+        return self.scheduler.take(fn)
+
+    def shutdown(self, wait=True):
+        self._stopped = True
+        self.scheduler.cancel_owned(self, wait)
@@ -0,0 +1,241 @@
+import errno
+import logging
+import os
+import socket
+import threading
+
+from .buffer import encode_message
+from .configs import defaults
+from .logdna import LogDNAHandler
+
+
+class LogShipper():
+    """
+        Receives log lines from ForwardingLogDNAHandlers in other processes
+        on a Unix datagram socket and sends them with a single
+        LogDNAHandler, so that many worker processes share one set of
+        connections and send fewer, larger batches.
+
+        Run it on a thread with start(), e.g. in the master process of a
+        pre-fork server, or call serve_forever() in a dedicated process.
+    """
+    def __init__(self, key, address, options={}):
+        self.address = address
+        self.handler = LogDNAHandler(key, options)
+        self.receiver = None
+        self.sock = None
+        self._stopped = False
+
+    def bind(self):
+        if self.sock:
+            return
+
+        # A socket file left behind by a previous shipper cannot be reused
+        try:
+            os.unlink(self.address)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            defaults['SHIPPER_RECV_BUFFER'])
+        except OSError:
+            pass
+        sock.bind(self.address)
+        self.sock = sock
+
+    def start(self):
+        """Receive on a background thread of this process"""
+        self.bind()
+        self.receiver = threading.Thread(target=self.serve_forever,
+                                         name='logdna-shipper',
+                                         daemon=True)
+        self.receiver.start()
+        return self
+
+    def serve_forever(self):
+        self.bind()
+        data = bytearray(defaults['SHIPPER_MAX_DATAGRAM'])
+        while True:
+            lines, stopping = self.receive_batch(data)
+            if lines:
+                self.handler.buffer_encoded_logs_sync(lines)
+            if stopping and self._stopped:
+                return
+
+    def receive_batch(self, data):
+        # Wait for one datagram, then take whatever else has arrived so
+        # the handler's buffer lock is taken once per batch.
+        size = self.receive(data)
+        lines = []
+        stopping = False
+        while True:
+            if size == 0:
+                # An empty datagram is the stop signal sent by close()
+                stopping = True
+            elif size and data[0] == ord('{'):
+                # Workers send lines already encoded for the buffer
+                lines.append(bytes(data[:size]))
+            elif size:
+                self.handler.internalLogger.debug(
+                    'Discarding malformed line from a worker')
+                self.handler.record_drop(1, 'malformed')
+            if len(lines) >= self.handler.drain_batch_size:
+                return lines, stopping
+            try:
+                size = self.receive(data, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return lines, stopping
+
+    def receive(self, data, flags=0):
+        # The size of the datagram received into data, or None if it was
+        # cut short to fit, rather than parse part of a line
+        size, _, msg_flags, _ = self.sock.recvmsg_into([data], 0, flags)
+        if msg_flags & socket.MSG_TRUNC:
+            self.handler.internalLogger.debug(
+                'Discarding a line from a worker longer than %d bytes',
+                len(data))
+            self.handler.record_drop(1, 'truncated')
+            return None
+        return size
+
+    def stats(self):
+        """The stats() of the handler that sends for the workers"""
+        return self.handler.stats()
+
+    def close(self):
+        self._stopped = True
+        if self.receiver:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wake:
+                wake.sendto(b'', self.address)
+            self.receiver.join()
+            self.receiver = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+        self.handler.close()
+
+
+class ForwardingLogDNAHandler(LogDNAHandler):
+    """
+        Sends log lines to a LogShipper over a Unix datagram socket instead
+        of to LogDNA. Lines are built in this process, so options such as
+        app, env and custom_fields apply as usual, while the ingestion key,
+        tags and connection options are those of the shipper.
+
+        Nothing is buffered or sent from this process. Lines are dropped
+        when the shipper is not running or cannot keep up within
+        send_timeout.
+    """
+    def __init__(self, address, options={}):
+        LogDNAHandler.__init__(self, None, dict(options, spool_dir=None))
+        # Lines are sent from the calling thread, so there is nothing to
+        # defer formatting to
+        self.defer_formatting = False
+        # Each line is sent in a datagram of its own, so longer lines are
+        # truncated or dropped like those over max_line_bytes
+        self.max_line_bytes = min(self.max_line_bytes
+                                  or defaults['SHIPPER_MAX_DATAGRAM'],
+                                  defaults['SHIPPER_MAX_DATAGRAM'])
+        self.address = address
+        self.send_timeout = options.get('send_timeout',
+                                        defaults['SHIPPER_SEND_TIMEOUT_SECS'])
+        self.sock = None
+
+    def make_request_thread_pool(self):
+        return None
+
+    def after_fork(self):
+        LogDNAHandler.after_fork(self)
+        # Every process connects its own socket
+        self.sock = None
+
+    def connect(self):
+        with self._lock:
+            if self.sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.settimeout(self.send_timeout)
+                # Room for a datagram of the largest size
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    defaults['SHIPPER_MAX_DATAGRAM'])
+                except OSError:
+                    pass
+                try:
+                    sock.connect(self.address)
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+            return self.sock
+
+    def disconnect(self, sock):
+        with self._lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+
+    def send(self, data):
+        # lines_sent and bytes_sent count lines handed to the shipper
+        self._stats.incr('lines_in')
+        sock = None
+        try:
+            sock = self.sock or self.connect()
+            sock.send(data)
+            self._stats.incr('lines_sent')
+            self._stats.incr('bytes_sent', len(data))
+        except socket.timeout:
+            self.internalLogger.debug(
+                'The shipper at %s is not keeping up. Discarding line',
+                self.address)
+            self.record_drop(1, 'shipper_timeout')
+        except OSError as e:
+            if e.errno == errno.EMSGSIZE:
+                # Larger than the system allows for a datagram
+                self.internalLogger.debug(
+                    'Discarding a line of %d bytes, too long to forward',
+                    len(data))
+                self.record_drop(1, 'size')
+                return
+            self.internalLogger.debug(
+                'Error forwarding to the shipper at %s: %s', self.address, e)
+            self.record_drop(1, 'shipper_unavailable')
+            if sock:
+                self.disconnect(sock)
+
+    def emit(self, record):
+        try:
+            LogDNAHandler.emit(self, record)
+        except Exception:
+            self.handleError(record)
+
+    def emit_message(self, message):
+        line = self.fit_line(encode_message(message))
+        if line is None:
+            self._stats.incr('lines_in')
+        else:
+            self.send(line)
+
+    def buffer_chunk(self, messages):
+        for message in messages:
+            self.emit_message(message)
+
+    def flush(self, timeout=None):
+        # Lines are handed to the shipper as they are logged
+        if timeout is not None:
+            return self.flush_report(self._stats.totals(), True)
+
+    def close(self, timeout=None):
+        totals = self._stats.totals()
+        if self.throttling:
+            self.report_throttle(float('inf'))
+        self.scheduler.shutdown()
+        sock, self.sock = self.sock, None
+        if sock:
+            sock.close()
+        logging.Handler.close(self)
+        return self.flush_report(totals, True)
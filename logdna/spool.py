@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Every spooled batch is framed as: payload length, crc32 of payload, payload
+FRAME_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.spool'
+OFFSET_FILE = 'replay.offset'
+
+
+class DiskSpool():
+    """
+        Append-only segment files holding batches that could not be kept in
+        memory or delivered, replayed oldest first.
+
+        Segments are only ever appended to. On start, a torn frame at the
+        end of a segment (from a crash mid-write) is truncated away, and
+        replay resumes from the last committed offset, so at most the batch
+        that was being replayed at the time of a crash is sent twice.
+    """
+    def __init__(self, directory, max_bytes, max_age_secs, segment_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.segment_bytes = segment_bytes
+        self.dropped_batches = 0
+
+        self._lock = threading.Lock()
+        self._segments = []  # [seq, size, frames], oldest first
+        self._writer = None
+        self._read_offset = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory,
+                            '%020d%s' % (seq, SEGMENT_SUFFIX))
+
+    def recover(self):
+        with self._lock:
+            for name in sorted(os.listdir(self.directory)):
+                if not name.endswith(SEGMENT_SUFFIX):
+                    continue
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                size, frames = self._scan(self.segment_path(seq))
+                if frames:
+                    self._segments.append([seq, size, frames])
+                else:
+                    os.remove(self.segment_path(seq))
+            self._read_offset = self._load_offset()
+
+    def _scan(self, path):
+        # Find the end of the last complete, uncorrupted frame and drop
+        # anything after it.
+        size = frames = 0
+        with open(path, 'r+b') as f:
+            length = os.fstat(f.fileno()).st_size
+            if length:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    while size + FRAME_HEADER.size <= length:
+                        n, crc = FRAME_HEADER.unpack_from(m, size)
+                        end = size + FRAME_HEADER.size + n
+                        if end > length or zlib.crc32(
+                                m[size + FRAME_HEADER.size:end]) != crc:
+                            break
+                        size = end
+                        frames += 1
+            if size != length:
+                f.truncate(size)
+        return size, frames
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                seq, offset = (int(value) for value in f.read().split())
+        except (OSError, ValueError):
+            return 0
+        if self._segments and self._segments[0][0] == seq:
+            return min(offset, self._segments[0][1])
+        return 0
+
+    def _save_offset(self):
+        seq = self._segments[0][0] if self._segments else 0
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d' % (seq, self._read_offset))
+        os.replace(path + '.tmp', path)
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(s[1] for s in self._segments) - self._read_offset
+
+    def pending(self):
+        with self._lock:
+            return bool(self._segments)
+
+    def append(self, payload):
+        frame = FRAME_HEADER.pack(len(payload), zlib.crc32(payload))
+        with self._lock:
+            if (not self._writer
+                    or self._segments[-1][1] >= self.segment_bytes):
+                self._roll()
+            self._writer.write(frame + payload)
+            self._writer.flush()
+            self._segments[-1][1] += len(frame) + len(payload)
+            self._segments[-1][2] += 1
+            self._enforce_limits()
+
+    def _roll(self):
+        if self._writer:
+            self._writer.close()
+        seq = self._segments[-1][0] + 1 if self._segments else 1
+        self._writer = open(self.segment_path(seq), 'ab')
+        self._segments.append([seq, 0, 0])
+
+    def _enforce_limits(self):
+        now = time.time()
+        while self._segments:
+            seq, size, frames = self._segments[0]
+            total = sum(s[1] for s in self._segments) - self._read_offset
+            age = now - os.path.getmtime(self.segment_path(seq))
+            expired = age > self.max_age_secs
+            oversized = total > self.max_bytes and len(self._segments) > 1
+            if not (expired or oversized):
+                break
+            self.dropped_batches += frames
+            self._remove_oldest()
+
+    def _remove_oldest(self):
+        seq = self._segments.pop(0)[0]
+        if self._writer and not self._segments:
+            self._writer.close()
+            self._writer = None
+        os.remove(self.segment_path(seq))
+        self._read_offset = 0
+        self._save_offset()
+
+    def peek(self):
+        """
+            Returns (token, payload) for the oldest batch, or None when the
+            spool is empty. Pass token to commit() once it has been sent.
+        """
+        with self._lock:
+            self._enforce_limits()
+            if not self._segments:
+                return None
+
+            seq, size, _ = self._segments[0]
+            if self._read_offset >= size:
+                return None
+            with open(self.segment_path(seq), 'rb') as f:
+                with mmap.mmap(f.fileno(), size,
+                               access=mmap.ACCESS_READ) as m:
+                    n, _ = FRAME_HEADER.unpack_from(m, self._read_offset)
+                    start = self._read_offset + FRAME_HEADER.size
+                    return (seq, start + n), m[start:start + n]
+
+    def commit(self, token):
+        seq, offset = token
+        with self._lock:
+            if not self._segments or self._segments[0][0] != seq:
+                return
+            self._read_offset = offset
+            if offset >= self._segments[0][1]:
+                self._remove_oldest()
+            else:
+                self._save_offset()
+
+    def close(self):
+        with self._lock:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
@@ -0,0 +1,96 @@
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets; the last one catches the rest
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, float('inf'))
+BATCH_BYTES_BUCKETS = tuple(1024 * 4**i for i in range(8)) + (float('inf'), )
+
+# Counters that are always present in a snapshot, even when still zero
+COUNTERS = ('lines_in', 'lines_sent', 'lines_spooled', 'lines_deduplicated',
+            'bytes_sent', 'batches', 'batches_sent', 'requests', 'retries')
+GROUPS = ('lines_dropped', 'lines_discarded', 'lines_shed', 'status_codes',
+          'request_errors')
+HISTOGRAMS = {
+    'batch_bytes': BATCH_BYTES_BUCKETS,
+    'request_latency': LATENCY_BUCKETS
+}
+
+
+def merge(totals, counters):
+    for key, value in counters.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+class Stats():
+    """
+        Counters for the sending pipeline. Each thread updates a dict of
+        its own without taking a lock, and snapshot() adds them up, so
+        counting stays cheap on the paths that handle every line.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, counters)
+        # Counters of threads that have exited
+        self._retired = {}
+
+    def _counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), counters))
+            return counters
+
+    def incr(self, key, value=1):
+        """Add to a counter. (group, label) keys are grouped by snapshot"""
+        counters = self._counters()
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        """Record value in the HISTOGRAMS bucket it falls into"""
+        buckets = HISTOGRAMS[name]
+        counters = self._counters()
+        key = (name, buckets[bisect.bisect_left(buckets, value)])
+        counters[key] = counters.get(key, 0) + 1
+        key = name + '_sum'
+        counters[key] = counters.get(key, 0) + value
+
+    def totals(self):
+        with self._lock:
+            live = []
+            for thread, counters in self._shards:
+                if thread.is_alive():
+                    live.append((thread, counters))
+                else:
+                    merge(self._retired, counters)
+            self._shards = live
+            totals = dict(self._retired)
+            # dict.copy() is atomic, while the owner may be adding keys
+            shards = [counters.copy() for _, counters in live]
+
+        for counters in shards:
+            merge(totals, counters)
+        return totals
+
+    def snapshot(self):
+        """
+            All counters as a dict. (group, label) counters are nested
+            under group, histograms are {bucket upper bound: count}.
+        """
+        snapshot = dict.fromkeys(COUNTERS, 0)
+        for group in GROUPS:
+            snapshot[group] = {}
+        for name, buckets in HISTOGRAMS.items():
+            snapshot[name] = dict.fromkeys(buckets, 0)
+            snapshot[name + '_sum'] = 0
+
+        for key, value in self.totals().items():
+            if isinstance(key, tuple):
+                group, label = key
+                snapshot.setdefault(group, {})[label] = value
+            else:
+                snapshot[key] = value
+        return snapshot
@@ -0,0 +1,105 @@
+import collections
+
+
+class Deduplicator():
+    """
+        Collapses repeats of a record within window seconds. Records are
+        keyed by their unformatted msg, logger name and level: the first
+        of each window goes through and later ones are only counted. The
+        last of them is kept, to be sent with the count once the window
+        ends, in take_repeated().
+
+        Windows are kept in the order they started, which is also the
+        order they end in, in a table of at most max_entries; when it is
+        full the oldest window ends early. Not thread-safe.
+    """
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        # Repeats counted in windows that have not ended yet
+        self.suppressed = 0
+        self._windows = collections.OrderedDict()  # key: [ends, repeats, last]
+        self._repeated = []
+
+    def admit(self, record, now):
+        """False if record repeats one sent within the window"""
+        msg = record.msg
+        if not isinstance(msg, str):
+            return True
+
+        key = (msg, record.name, record.levelno)
+        window = self._windows.get(key)
+        if window is not None:
+            if now < window[0]:
+                window[1] += 1
+                window[2] = record
+                self.suppressed += 1
+                return False
+            self._end(key)
+        elif len(self._windows) >= self.max_entries:
+            self._end(next(iter(self._windows)))
+
+        self._windows[key] = [now + self.window, 0, None]
+        return True
+
+    def _end(self, key):
+        _, repeats, last = self._windows.pop(key)
+        if repeats:
+            self.suppressed -= repeats
+            self._repeated.append((last, repeats))
+
+    def expire(self, now):
+        """End the windows that are over by now"""
+        while self._windows:
+            key, window = next(iter(self._windows.items()))
+            if window[0] > now:
+                return
+            self._end(key)
+
+    def take_repeated(self):
+        """[(last record, repeats)] of the windows ended since the last call"""
+        repeated = self._repeated
+        if repeated:
+            self._repeated = []
+        return repeated
+
+
+class RateLimiter():
+    """
+        A token bucket per logger name, refilled at rate lines per second
+        up to burst lines. Buckets are kept for the max_entries loggers
+        used most recently; a logger seen again after its bucket was
+        evicted starts with a full one. Not thread-safe.
+    """
+    def __init__(self, rate, burst, max_entries):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets = collections.OrderedDict()  # name: [tokens, updated]
+        self._dropped = {}
+
+    def admit(self, name, now):
+        """False if the logger has used up its bucket"""
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            if len(self._buckets) >= self.max_entries:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[name] = [self.burst, now]
+        else:
+            self._buckets.move_to_end(name)
+            bucket[0] = min(self.burst,
+                            bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        self._dropped[name] = self._dropped.get(name, 0) + 1
+        return False
+
+    def take_dropped(self):
+        """{logger name: lines dropped} since the last call"""
+        dropped = self._dropped
+        if dropped:
+            self._dropped = {}
+        return dropped
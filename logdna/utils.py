@@ -1,5 +1,22 @@
+import copy
+import email.utils
+import functools
+import gzip
 import json
+import logging
 import socket
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSION_CODECS = ('gzip', 'zstd')
+
+# Argument types that cannot change between capture and formatting
+IMMUTABLE_ARG_TYPES = frozenset((str, int, float, bool, bytes, type(None)))
 
 
 def is_jsonable(obj):
@@ -19,25 +36,108 @@ def normalize_list_option(options, key):
     return value
 
 
+def capture_record(record):
+    """
+        A copy of record that can be formatted later on another thread.
+        The message and its arguments are kept when they are immutable, and
+        a dict of arguments, which also holds per-line options, is copied
+        deeply; otherwise the message is rendered now, as if it had been
+        logged without arguments.
+    """
+    captured = logging.LogRecord.__new__(type(record))
+    captured.__dict__.update(record.__dict__)
+    args = record.args
+    if type(record.msg) not in IMMUTABLE_ARG_TYPES:
+        render = True
+    elif isinstance(args, dict):
+        render = False
+        try:
+            captured.args = copy.deepcopy(args)
+        except Exception:
+            render = True
+    else:
+        render = not all(type(value) in IMMUTABLE_ARG_TYPES
+                         for value in args or ())
+    if render:
+        captured.msg = record.getMessage()
+        captured.args = ()
+    return captured
+
+
 def sanitize_meta(meta, index_meta=False):
-    if not index_meta:
-        if is_jsonable(meta):
-            return json.dumps(meta)
-
-        return {
-            '__errors': 'Meta cannot be serialized into JSON-formatted string'
-        }
-
-    keys_to_sanitize = []
-    for key, value in meta.items():
-        if not is_jsonable(value):
-            keys_to_sanitize.append(key)
-    if keys_to_sanitize:
+    # Validate and encode in a single json.dumps; only when that fails do
+    # we walk the keys to find and drop the ones that cannot be serialized.
+    try:
+        encoded = json.dumps(meta)
+    except (TypeError, OverflowError, ValueError):
+        encoded = None
+        keys_to_sanitize = [
+            key for key, value in meta.items()
+            if not is_jsonable({key: value})
+        ]
+        if not keys_to_sanitize:
+            return {
+                '__errors':
+                'Meta cannot be serialized into JSON-formatted string'
+            }
         for key in keys_to_sanitize:
             del meta[key]
         meta['__errors'] = 'These keys have been sanitized: ' + ', '.join(
-            keys_to_sanitize)
-    return meta
+            str(key) for key in keys_to_sanitize)
+
+    if index_meta:
+        return meta
+
+    return encoded if encoded is not None else json.dumps(meta)
+
+
+def parse_retry_after(value):
+    """
+        Seconds to wait from a Retry-After header, given in seconds or as
+        an HTTP date; None if it is missing or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+def compress(body, compression, level=None):
+    if compression == 'zstd':
+        level = 3 if level is None else level
+        return zstandard.ZstdCompressor(level=level).compress(body)
+
+    level = 6 if level is None else level
+    return gzip.compress(body, compresslevel=level)
+
+
+def iter_compressed(chunks, compression, level=None):
+    if compression == 'zstd':
+        level = 3 if level is None else level
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        level = 6 if level is None else level
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@functools.lru_cache(maxsize=None)
+def get_hostname():
+    return socket.gethostname()
 
 
 def get_ip():
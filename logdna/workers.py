@@ -0,0 +1,73 @@
+import itertools
+import logging
+import queue
+import threading
+import weakref
+
+
+def _work(tasks, idle):
+    # Like the workers of concurrent.futures, hold no reference to the pool
+    # while waiting, so that an unclosed pool can be collected
+    while True:
+        task = tasks.get()
+        if task is None:
+            # Leave the stop signal for the other workers
+            tasks.put(None)
+            return
+        fn, args = task
+        try:
+            fn(*args)
+        except Exception:
+            logging.getLogger('internal').exception('Error in task %s', fn)
+        del task, fn, args
+        idle.release()
+
+
+class WorkerPool():
+    """
+        Runs tasks on up to max_workers threads, started as they are needed,
+        like a ThreadPoolExecutor without futures. Its threads are daemon
+        threads: since Python 3.9 the interpreter waits at exit for those of
+        a ThreadPoolExecutor, and so for any request still under way after
+        close(timeout) has returned.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, max_workers, name='logdna-request'):
+        self.max_workers = max_workers
+        self.name = '%s-%d' % (name, next(self._counter))
+        self._tasks = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+        weakref.finalize(self, self._tasks.put, None)
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after ' +
+                                   'shutdown')
+            self._tasks.put((fn, args))
+            if (self._idle.acquire(timeout=0)
+                    or len(self._threads) >= self.max_workers):
+                return
+            thread = threading.Thread(target=_work,
+                                      args=(self._tasks, self._idle),
+                                      name='%s_%d' %
+                                      (self.name, len(self._threads)),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, wait=True):
+        """Stop taking tasks and, with wait, wait for those submitted"""
+        with self._lock:
+            if not self._shutdown:
+                self._shutdown = True
+                self._tasks.put(None)
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                if thread is not threading.current_thread():
+                    thread.join()
@@ -0,0 +1,69 @@
+import unittest
+
+from logdna.adaptive import AdaptiveFlushPolicy
+
+MIN_LIMIT = 64 * 1024
+MAX_LIMIT = 2 * 1024 * 1024
+
+
+def make_policy():
+    return AdaptiveFlushPolicy((MIN_LIMIT, MAX_LIMIT), (0.1, 2), 10, 0.5)
+
+
+def arrive(policy, rate, start, secs):
+    # rate bytes per second, in 10ms steps
+    for step in range(int(secs * 100)):
+        policy.observe_arrival(rate / 100, start + step / 100)
+    return start + secs
+
+
+class AdaptiveFlushPolicyTest(unittest.TestCase):
+    def test_starts_small_and_fresh(self):
+        self.assertEqual(make_policy().limits(), (MIN_LIMIT, 0.1))
+
+    def test_trickle_keeps_small_batches(self):
+        policy = make_policy()
+        arrive(policy, 10 * 1024, 0, 5)
+        policy.observe_request(0.05, True)
+        self.assertEqual(policy.limits(), (MIN_LIMIT, 0.1))
+
+    def test_burst_grows_batches(self):
+        policy = make_policy()
+        now = arrive(policy, 10 * 1024 * 1024, 0, 3)
+        for _ in range(10):
+            policy.observe_request(0.1, True)
+        limit, interval = policy.limits()
+        self.assertGreater(limit, 512 * 1024)
+        self.assertLessEqual(limit, MAX_LIMIT)
+        self.assertEqual(interval, 0.1)
+
+        # The rate drops as soon as the burst is over
+        policy.observe_arrival(100, now + 2)
+        self.assertEqual(policy.limits(), (MIN_LIMIT, 0.1))
+
+    def test_slow_ingestion_spaces_requests(self):
+        policy = make_policy()
+        arrive(policy, 1024 * 1024, 0, 3)
+        fast = policy.limits()
+        for _ in range(20):
+            policy.observe_request(5, True)
+        slow = policy.limits()
+        self.assertGreater(slow[0], fast[0])
+        self.assertGreater(slow[1], fast[1])
+
+    def test_errors_back_off(self):
+        policy = make_policy()
+        arrive(policy, 1024 * 1024, 0, 3)
+        for _ in range(10):
+            policy.observe_request(0.1, True)
+        healthy = policy.limits()
+        for _ in range(10):
+            policy.observe_request(None, False)
+        failing = policy.limits()
+        self.assertGreater(failing[0], healthy[0])
+        self.assertGreater(failing[1], healthy[1])
+        self.assertGreater(policy.state()['error_rate'], 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+from benchmarks.ingest_server import IngestServer
+from logdna import AsyncLogDNAHandler
+from logdna.buffer import encode_message
+
+now = int(time.time())
+
+
+class AsyncLogDNAHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = IngestServer().start()
+        self.options = {
+            'url': self.server.url,
+            'hostname': 'localhost',
+            'index_meta': False,
+            'retry_interval_secs': 0.05,
+            'max_retry_jitter': 0.01
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def record(self, line):
+        return logging.LogRecord('test', logging.INFO, 'test', 1, line, (),
+                                 None)
+
+    def test_emit_and_aflush_delivers(self):
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            for i in range(100):
+                handler.emit(self.record('line %d' % i))
+            await handler.aflush()
+            self.assertEqual(self.server.lines, 100)
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.requests, 1)
+
+    def test_shares_message_format(self):
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            handler.emit(self.record('hello'))
+            await handler.aclose()
+
+        asyncio.run(run())
+        line = self.server.last_body['ls'][0]
+        self.assertEqual(line['line'], 'hello')
+        self.assertEqual(line['level'], 'INFO')
+        self.assertEqual(line['hostname'], 'localhost')
+
+    def test_reuses_connection(self):
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            for i in range(5):
+                handler.emit(self.record('line %d' % i))
+                await handler.aflush()
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_flush_interval(self):
+        options = dict(self.options, flush_interval=0.05)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, options)
+            handler.emit(self.record('hello'))
+            self.assertEqual(self.server.lines, 0)
+            await asyncio.sleep(0.5)
+            self.assertEqual(self.server.lines, 1)
+            await handler.aclose()
+
+        asyncio.run(run())
+
+    def test_flush_limit(self):
+        options = dict(self.options, flush_interval=10)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, options)
+            line = encode_message(handler.build_message(self.record('12345')))
+            handler.flush_limit = 2 * len(line)
+            for i in range(3):
+                handler.emit(self.record('12345'))
+            await asyncio.sleep(0.5)
+            self.assertEqual(self.server.lines, 2)
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.lines, 3)
+
+    def test_retries_on_server_error(self):
+        self.server.fail_next(2)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            handler.emit(self.record('hello'))
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.failures, 2)
+        self.assertEqual(self.server.lines, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        options = dict(self.options, max_retry_attempts=2)
+        self.server.fail_next(5)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, options)
+            handler.emit(self.record('hello'))
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.failures, 2)
+        self.assertEqual(self.server.lines, 0)
+
+    def test_discards_on_client_error(self):
+        self.server.fail_next(1, status=403)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            handler.emit(self.record('hello'))
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.failures, 1)
+        self.assertEqual(self.server.requests, 0)
+
+    def test_splits_rejected_batch(self):
+        self.server.poison = 'poison'
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            for i in range(8):
+                handler.emit(self.record('poison' if i == 3 else str(i)))
+            await handler.aclose()
+            self.assertEqual(handler.stats()['lines_discarded'],
+                             {'status': 1})
+
+        asyncio.run(run())
+        self.assertEqual(self.server.lines, 7)
+
+    def test_compressed(self):
+        options = dict(self.options,
+                       compression='gzip',
+                       compression_threshold=0)
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, options)
+            handler.emit(self.record('hello'))
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.lines, 1)
+        self.assertEqual(self.server.last_encoding, 'gzip')
+        self.assertEqual(self.server.last_body['ls'][0]['line'], 'hello')
+
+    def test_emit_from_other_thread(self):
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            handler.get_loop()
+            thread = threading.Thread(
+                target=lambda: [
+                    handler.emit(self.record(str(i))) for i in range(10)
+                ])
+            thread.start()
+            thread.join()
+            await asyncio.sleep(0)
+            await handler.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.lines, 10)
+
+    def test_close_reports(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            handler = AsyncLogDNAHandler(None, self.options)
+
+            async def emit():
+                handler.get_loop()
+                for i in range(10):
+                    handler.emit(self.record(str(i)))
+
+            asyncio.run_coroutine_threadsafe(emit(), loop).result(5)
+            report = handler.flush(5)
+            self.assertTrue(report['flushed'])
+            self.assertEqual(report['lines_sent'], 10)
+
+            # Batches still being sent when the timeout runs out are dropped
+            self.server.latency = 3
+            asyncio.run_coroutine_threadsafe(emit(), loop).result(5)
+            started = time.monotonic()
+            report = handler.close(0.2)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertFalse(report['flushed'])
+            self.assertEqual(report['lines_dropped'], 10)
+            self.assertEqual(report['batches_pending'], 0)
+            self.assertEqual(handler.stats()['lines_discarded'],
+                             {'shutdown': 10})
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def test_no_worker_threads(self):
+        def worker_threads():
+            return [
+                thread for thread in threading.enumerate()
+                if thread.name.startswith(('ThreadPoolExecutor', 'logdna'))
+            ]
+
+        before = worker_threads()
+
+        async def run():
+            handler = AsyncLogDNAHandler(None, self.options)
+            for i in range(50):
+                handler.emit(self.record(str(i)))
+            await handler.aflush()
+            self.assertEqual(worker_threads(), before)
+            await handler.aclose()
+
+        asyncio.run(run())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_fork(self):
+        handler = AsyncLogDNAHandler(
+            None, dict(self.options, dedup_window=0.1))
+        # A throttle report is due in the parent at the time of the fork
+        handler.emit(self.record('parent'))
+        handler.emit(self.record('parent'))
+
+        def child():
+            messages = []
+            handler.emit_message = messages.append
+            for _ in range(3):
+                handler.emit(self.record('child'))
+            deadline = time.monotonic() + 5
+            # The child's own scheduler reports the repeats
+            while not any(
+                    json.loads(m['meta']).get('repeated') == 2
+                    for m in messages) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert time.monotonic() < deadline, messages
+
+        process = multiprocessing.get_context('fork').Process(target=child)
+        process.start()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+        self.assertEqual(process.exitcode, 0)
+        handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
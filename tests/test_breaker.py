@@ -0,0 +1,57 @@
+import unittest
+
+from logdna.breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(3, 10)
+        self.assertIsNone(breaker.record(False, 0))
+        self.assertIsNone(breaker.record(False, 0))
+        # A success in between starts the count over
+        self.assertIsNone(breaker.record(True, 0))
+        self.assertIsNone(breaker.record(False, 0))
+        self.assertIsNone(breaker.record(False, 0))
+        self.assertTrue(breaker.allow(1))
+        self.assertEqual(breaker.record(False, 1), OPEN)
+
+        self.assertFalse(breaker.allow(2))
+        self.assertEqual(breaker.remaining(2), 9)
+
+    def test_cancel_probe(self):
+        breaker = CircuitBreaker(1, 10)
+        breaker.record(False, 0)
+        self.assertTrue(breaker.allow(10))
+        self.assertFalse(breaker.allow(10))
+        # A probe that was not sent can be handed out again
+        breaker.cancel_probe()
+        self.assertTrue(breaker.allow(10))
+        self.assertEqual(breaker.state, HALF_OPEN)
+
+    def test_single_probe_closes(self):
+        breaker = CircuitBreaker(1, 10)
+        self.assertEqual(breaker.record(False, 0), OPEN)
+        self.assertFalse(breaker.allow(9))
+
+        # One probe once the reset time has passed, and no other request
+        # until it is done
+        self.assertTrue(breaker.allow(10))
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(breaker.remaining(10), 0)
+        self.assertFalse(breaker.allow(11))
+        self.assertEqual(breaker.record(True, 12), CLOSED)
+        self.assertTrue(breaker.allow(12))
+        self.assertEqual(breaker.failures, 0)
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker(2, 10)
+        breaker.record(False, 0)
+        breaker.record(False, 0)
+        self.assertTrue(breaker.allow(10))
+        self.assertEqual(breaker.record(False, 11), OPEN)
+        self.assertFalse(breaker.allow(20))
+        self.assertTrue(breaker.allow(21))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import json
+import logging
+import unittest
+
+from logdna.buffer import LogBuffer, encode_message, line_level
+from logdna.buffer import truncate_line
+
+
+class LogBufferTest(unittest.TestCase):
+    def test_empty(self):
+        buf = LogBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.size, 0)
+        self.assertEqual(json.loads(buf.payload()), {'e': 'ls', 'ls': []})
+        self.assertEqual(list(buf.lines()), [])
+
+    def test_size_is_exact(self):
+        messages = [{
+            'line': 'ünïcødé ✓ %d' % i,
+            'meta': json.dumps({'key': 'välue' * i})
+        } for i in range(50)]
+        buf = LogBuffer()
+        for message in messages:
+            line = encode_message(message)
+            expected = buf.size_with(line)
+            buf.append(line)
+            self.assertEqual(buf.size, expected)
+
+        payload = buf.payload()
+        self.assertEqual(len(payload), buf.size + len(b'{"e":"ls","ls":[]}'))
+        self.assertEqual(json.loads(payload), {'e': 'ls', 'ls': messages})
+
+    def test_lines(self):
+        lines = [encode_message({'line': str(i)}) for i in range(10)]
+        buf = LogBuffer(lines)
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(list(buf.lines()), lines)
+
+    def test_extend(self):
+        lines = [encode_message({'line': str(i)}) for i in range(10)]
+        buf = LogBuffer(lines[:4])
+        other = LogBuffer()
+        for line in lines[4:]:
+            other.append(line, logging.ERROR)
+        buf.extend(other)
+        buf.extend(LogBuffer())
+        self.assertEqual(list(buf.lines()), lines)
+        self.assertEqual(list(buf.levels),
+                         [logging.INFO] * 4 + [logging.ERROR] * 6)
+        self.assertEqual(buf.size, len(buf.payload()) - 18)
+
+        empty = LogBuffer()
+        empty.extend(buf)
+        self.assertEqual(list(empty.lines()), lines)
+
+    def test_slice(self):
+        lines = [encode_message({'line': str(i)}) for i in range(10)]
+        buf = LogBuffer()
+        for i, line in enumerate(lines):
+            buf.append(line, logging.ERROR if i % 2 else logging.INFO)
+        for start, end in ((0, 10), (0, 1), (3, 7), (9, 10), (5, 5)):
+            part = buf.slice(start, end)
+            self.assertEqual(list(part.lines()), lines[start:end])
+            self.assertEqual(list(part.levels), list(buf.levels[start:end]))
+            self.assertEqual(part.size, len(part.payload()) - 18)
+
+        first, second = buf.halves()
+        self.assertEqual(list(first.lines()) + list(second.lines()), lines)
+        self.assertEqual(len(first), 5)
+
+    def test_partition(self):
+        lines = [encode_message({'line': 'x' * (i * 10)}) for i in range(20)]
+        buf = LogBuffer(lines)
+        parts = buf.partition(500)
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(
+            [line for part in parts for line in part.lines()], lines)
+        for part in parts:
+            self.assertLessEqual(part.size, 500)
+            self.assertEqual(part.size, len(part.payload()) - 18)
+
+        # A line longer than the limit gets a part of its own
+        long_line = encode_message({'line': 'y' * 1000})
+        parts = LogBuffer(lines[:2] + [long_line] + lines[2:4]).partition(500)
+        self.assertEqual([len(part) for part in parts], [2, 1, 2])
+        self.assertEqual(list(parts[1].lines()), [long_line])
+
+    def test_truncate_line(self):
+        line = encode_message({'line': 'ünïcødé' * 100, 'app': 'app'})
+        truncated = truncate_line(line, 200)
+        self.assertLessEqual(len(truncated), 200)
+        self.assertGreater(len(truncated), 180)
+        message = json.loads(truncated)
+        self.assertTrue(message['line'].endswith(' [truncated]'))
+        self.assertTrue(('ünïcødé' * 100).startswith(
+            message['line'][:-len(' [truncated]')]))
+        self.assertEqual(message['app'], 'app')
+        self.assertIsNone(truncate_line(line, 20))
+
+    def test_iter_payload(self):
+        buf = LogBuffer(
+            encode_message({'line': 'x' * 100}) for _ in range(100))
+        chunks = list(buf.iter_payload(1000))
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 1000)
+        self.assertEqual(b''.join(chunks), buf.payload())
+
+    def test_evict(self):
+        buf = LogBuffer()
+        for i in range(10):
+            level = logging.DEBUG if i % 2 else logging.INFO
+            buf.append(encode_message({'line': str(i)}), level)
+
+        self.assertEqual(buf.evict(1, logging.DEBUG), {logging.DEBUG: 1})
+        self.assertEqual(buf.evict(30), {logging.INFO: 2, logging.DEBUG: 1})
+        lines = [json.loads(line)['line'] for line in buf.lines()]
+        self.assertEqual(lines, ['4', '5', '6', '7', '8', '9'])
+        self.assertEqual(list(buf.levels), [logging.INFO, logging.DEBUG] * 3)
+        self.assertEqual(buf.size, len(buf.payload()) - 18)
+        self.assertEqual(buf.evict(1, logging.ERROR), {})
+
+    def test_line_level(self):
+        for message, level in (({
+                'line': '"level": "DEBUG"',
+                'level': 'ERROR'
+        }, logging.ERROR), ({
+                'level': 'warning'
+        }, logging.WARNING), ({
+                'level': 'custom'
+        }, logging.INFO), ({}, logging.INFO)):
+            self.assertEqual(line_level(encode_message(message)), level)
+
+
+if __name__ == '__main__':
+    unittest.main()
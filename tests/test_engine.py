@@ -0,0 +1,294 @@
+import logging
+import multiprocessing
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.ingest_server import IngestServer
+from logdna import LogDNAHandler, ShippingEngine
+from logdna.engine import StreamExecutor
+
+now = int(time.time())
+
+
+class StreamExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_in_order_within_max_workers(self):
+        stream = StreamExecutor(self.executor, 1)
+        calls = []
+        for i in range(50):
+            stream.submit(calls.append, i)
+        self.assertTrue(stream.shutdown(timeout=5))
+        self.assertEqual(calls, list(range(50)))
+
+        stream = StreamExecutor(self.executor, 2)
+        running = []
+        most = [0]
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(1)
+                most[0] = max(most[0], len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        for _ in range(20):
+            stream.submit(task)
+        self.assertTrue(stream.shutdown(timeout=5))
+        self.assertEqual(most[0], 2)
+
+    def test_busy_stream_does_not_hold_up_others(self):
+        busy = StreamExecutor(self.executor, 4)
+        release = threading.Event()
+        for _ in range(20):
+            busy.submit(release.wait, 5)
+
+        done = threading.Event()
+        StreamExecutor(self.executor, 1).submit(done.set)
+        self.assertFalse(done.wait(0.1))
+        release.set()
+        # Queued behind the tasks running at the time, not all twenty
+        self.assertTrue(done.wait(1))
+        self.assertTrue(busy.shutdown(timeout=5))
+
+    def test_shutdown(self):
+        stream = StreamExecutor(self.executor, 1)
+        release = threading.Event()
+        stream.submit(release.wait, 5)
+        self.assertFalse(stream.shutdown(timeout=0.05))
+        with self.assertRaises(RuntimeError):
+            stream.submit(print)
+        release.set()
+        self.assertTrue(stream.shutdown())
+
+    def test_error_does_not_stop_stream(self):
+        stream = StreamExecutor(self.executor, 1)
+        done = threading.Event()
+        stream.submit(lambda: 1 / 0)
+        stream.submit(done.set)
+        self.assertTrue(done.wait(1))
+
+
+class ShippingEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = IngestServer().start()
+        self.engine = ShippingEngine(max_workers=4)
+
+    def tearDown(self):
+        self.engine.shutdown()
+        self.server.stop()
+
+    def test_shared(self):
+        self.assertIs(ShippingEngine.shared(), ShippingEngine.shared())
+        handler = LogDNAHandler('key', {
+            'url': self.server.url,
+            'hostname': 'shared',
+            'shared_engine': True
+        })
+        self.assertIs(handler.engine, ShippingEngine.shared())
+        handler.close()
+
+    def threads(self):
+        # Leaving out the server's thread for each connection
+        return threading.active_count() - self.server.connections
+
+    def test_many_handlers(self):
+        before = self.threads()
+        handlers = [
+            LogDNAHandler(
+                'key%d' % i, {
+                    'url': self.server.url,
+                    'hostname': 'host%d' % i,
+                    'tags': 'handler%d' % i,
+                    'index_meta': False,
+                    'flush_interval': 0.05,
+                    'shared_engine': self.engine
+                }) for i in range(50)
+        ]
+        for i, handler in enumerate(handlers):
+            for j in range(20):
+                handler.handle(
+                    logging.LogRecord('test', logging.INFO, 'test', 1,
+                                      'line %d of %d' % (j, i), (), None))
+        self.assertTrue(
+            all(handler.flush(timeout=10)['flushed'] for handler in handlers))
+
+        # The engine's request threads, consumer thread and scheduler
+        # thread, however many handlers there are
+        self.assertLessEqual(self.threads() - before, 4 + 1 + 1)
+        self.assertEqual(self.server.lines, 1000)
+        self.assertEqual(self.server.lines_by_host,
+                         {'host%d' % i: 20
+                          for i in range(50)})
+        # Over the engine's keep-alive connections
+        self.assertLessEqual(self.server.connections, 4)
+
+        for handler in handlers:
+            handler.close()
+        self.assertLessEqual(self.threads() - before, 4 + 1 + 1)
+
+    def test_close_leaves_engine_running(self):
+        first, second = (LogDNAHandler(
+            'key', {
+                'url': self.server.url,
+                'hostname': name,
+                'flush_interval': 10,
+                'shared_engine': self.engine
+            }) for name in ('first', 'second'))
+        first.buffer_log_sync({'line': 'first', 'timestamp': now})
+        second.buffer_log_sync({'line': 'second', 'timestamp': now})
+        first.close()
+        self.assertEqual(self.server.lines_by_host, {'first': 1})
+        # The second handler's flush timer was not cancelled with the first
+        self.assertIsNotNone(second.next_flush_in)
+
+        second.buffer_log_sync({'line': 'again', 'timestamp': now})
+        second.close()
+        self.assertEqual(self.server.lines_by_host, {
+            'first': 1,
+            'second': 2
+        })
+
+    def test_throttled_handler_does_not_hold_up_others(self):
+        with IngestServer(latency=1) as slow:
+            throttled = LogDNAHandler(
+                'key', {
+                    'url': slow.url,
+                    'hostname': 'throttled',
+                    'flush_interval': 10,
+                    'shared_engine': self.engine
+                })
+            # As after throttled responses: one request at a time, and the
+            # batches waiting for it do not take up request threads
+            for _ in range(4):
+                throttled.pacer.throttled(None, time.monotonic())
+            for i in range(8):
+                throttled.buffer_log_sync({'line': 'line %d' % i,
+                                           'timestamp': now})
+                throttled.flush()
+
+            handler = LogDNAHandler(
+                'key', {
+                    'url': self.server.url,
+                    'hostname': 'fast',
+                    'flush_interval': 10,
+                    'shared_engine': self.engine
+                })
+            handler.buffer_log_sync({'line': 'fast', 'timestamp': now})
+            self.assertTrue(handler.flush(timeout=0.5)['flushed'])
+            self.assertEqual(self.server.lines_by_host, {'fast': 1})
+            handler.close()
+            throttled.close(timeout=0.1)
+
+    def test_retries_after_close_leave_scheduler_free(self):
+        handler = LogDNAHandler(
+            'key', {
+                'url': self.server.url,
+                'hostname': 'retried',
+                'flush_interval': 10,
+                'retry_interval_secs': 0.05,
+                'shared_engine': self.engine
+            })
+        threads = []
+        send_request = handler.send_request
+
+        def record_thread(*args):
+            threads.append(threading.current_thread().name)
+            return send_request(*args)
+
+        handler.send_request = record_thread
+        self.server.fail_next(2)
+        handler.buffer_log_sync({'line': 'retried', 'timestamp': now})
+        handler.close()
+        self.assertEqual(self.server.lines, 1)
+        self.assertEqual(len(threads), 3)
+        # Not on the scheduler thread the engine shares with other handlers
+        self.assertFalse(
+            any(name.startswith(self.engine.scheduler.name)
+                for name in threads))
+
+    def test_block_policy_leaves_consumer_free(self):
+        with IngestServer(latency=1) as slow:
+            blocked = LogDNAHandler(
+                'key', {
+                    'url': slow.url,
+                    'hostname': 'blocked',
+                    'flush_interval': 10,
+                    'max_concurrent_requests': 1,
+                    'buf_retention_limit': 4096,
+                    'overflow_policy': 'block',
+                    'overflow_timeout': 5,
+                    'shared_engine': self.engine
+                })
+
+            def log_blocked():
+                for i in range(100):
+                    blocked.handle(
+                        logging.LogRecord('test', logging.INFO, 'test', 1,
+                                          'x' * 200, (), None))
+
+            thread = threading.Thread(target=log_blocked)
+            thread.start()
+            while blocked._has_room.is_set() and thread.is_alive():
+                time.sleep(0.01)
+
+            # The engine's consumer thread still drains the other handlers
+            handler = LogDNAHandler(
+                'key', {
+                    'url': self.server.url,
+                    'hostname': 'fast',
+                    'flush_interval': 0.05,
+                    'shared_engine': self.engine
+                })
+            handler.handle(
+                logging.LogRecord('test', logging.INFO, 'test', 1, 'fast',
+                                  (), None))
+            deadline = time.monotonic() + 1
+            while not self.server.lines and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.server.lines_by_host, {'fast': 1})
+            handler.close()
+            thread.join()
+            blocked.close(timeout=0.1)
+
+    def test_fork(self):
+        handler = LogDNAHandler(
+            'key', {
+                'url': self.server.url,
+                'hostname': 'parent',
+                'flush_interval': 10,
+                'shared_engine': self.engine
+            })
+        handler.buffer_log_sync({'line': 'parent', 'timestamp': now})
+
+        def child():
+            # The engine's threads are started again in the child
+            handler.hostname = 'child'
+            handler.buffer_log_sync({'line': 'child', 'timestamp': now})
+            handler.close()
+
+        process = multiprocessing.get_context('fork').Process(target=child)
+        process.start()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.server.lines_by_host, {'child': 1})
+        handler.close()
+        self.assertEqual(self.server.lines_by_host, {
+            'child': 1,
+            'parent': 1
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,21 @@
+import gzip
+import json
 import logging
+import multiprocessing
+import subprocess
+import sys
 import unittest
 import requests
+import tempfile
+import threading
 import time
 import os
 
 from logdna import LogDNAHandler
-from concurrent.futures import ThreadPoolExecutor
+from logdna.buffer import LogBuffer, encode_message
+from benchmarks.ingest_server import IngestServer
 from logdna.configs import defaults
+from logdna.workers import WorkerPool
 from unittest import mock
 from unittest.mock import patch
 
@@ -50,6 +59,15 @@ sample_options = {
 }
 
 
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
 class MockThreadPoolExecutor():
     def __init__(self, **kwargs):
         pass
@@ -102,8 +120,8 @@ class LogDNAHandlerTest(unittest.TestCase):
                          sample_options['retry_interval_secs'])
 
         # Set the Flush-related Variables
-        self.assertEqual(handler.buf, [])
-        self.assertEqual(handler.buf_size, 0)
+        self.assertEqual(len(handler.buf), 0)
+        self.assertEqual(handler.buf.size, 0)
         self.assertIsNone(handler.flusher)
         self.assertTrue(handler.index_meta)
         self.assertEqual(handler.flush_limit, defaults['FLUSH_LIMIT'])
@@ -112,26 +130,52 @@ class LogDNAHandlerTest(unittest.TestCase):
         self.assertEqual(handler.buf_retention_limit,
                          defaults['BUF_RETENTION_LIMIT'])
 
-        # Set up the Thread Pools
-        self.assertIsInstance(
-            handler.worker_thread_pool, ThreadPoolExecutor)
-        self.assertIsInstance(
-            handler.request_thread_pool, ThreadPoolExecutor)
+        # Set up the Ingestion Queue and Thread Pools
+        self.assertIsNotNone(handler.log_queue)
+        self.assertIsNone(handler.log_consumer)
+        self.assertIsInstance(handler.request_thread_pool, WorkerPool)
         self.assertEqual(handler.level, logging.DEBUG)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_flusher(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 200
             r.reason = 'OK'
             post_mock.return_value = r
             handler.emit(sample_record)
-            self.assertIsNotNone(handler.flusher)
+            self.assertTrue(wait_for(lambda: handler.flusher is not None))
             handler.close_flusher()
             self.assertIsNone(handler.flusher)
 
+    def test_next_flush_in(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.flush = unittest.mock.Mock()
+        self.assertIsNone(handler.next_flush_in)
+        handler.start_flusher()
+        self.assertGreater(handler.next_flush_in, 0)
+        self.assertLessEqual(handler.next_flush_in,
+                             handler.flush_interval_secs)
+        self.assertTrue(wait_for(lambda: handler.flush.called))
+        self.assertIsNone(handler.next_flush_in)
+        handler.close()
+
+    def test_flusher_reuses_scheduler_thread(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.flush_interval_secs = 0
+        handler.flush = unittest.mock.Mock()
+        handler.start_flusher()
+        self.assertTrue(wait_for(lambda: handler.flush.call_count == 1))
+        before = threading.active_count()
+        for count in range(2, 10):
+            handler.close_flusher()
+            handler.start_flusher()
+            self.assertTrue(
+                wait_for(lambda: handler.flush.call_count == count))
+        self.assertEqual(threading.active_count(), before)
+        handler.close()
+
     def test_emit(self):
         handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
         handler.buffer_log = unittest.mock.Mock()
@@ -139,24 +183,126 @@ class LogDNAHandlerTest(unittest.TestCase):
         sample_message['timestamp'] = unittest.mock.ANY
         handler.buffer_log.assert_called_once_with(sample_message)
 
+    def test_emit_deferred(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(sample_options, defer_formatting=True))
+        handler.buffer_log = unittest.mock.Mock()
+        handler.handleError = unittest.mock.Mock()
+        items = [1, 2]
+        handler.emit(sample_record)
+        handler.emit(
+            logging.LogRecord('test', logging.INFO, 'test', 1, 'items %s',
+                              (items, ), None))
+        handler.emit(
+            logging.LogRecord('test', logging.INFO, 'test', 1, 'count %d',
+                              ('many', ), None))
+        items.append(3)
+
+        # Only a copy of each record is queued
+        captured = [call[0][0] for call in handler.buffer_log.call_args_list]
+        self.assertIsNot(captured[0], sample_record)
+        self.assertEqual(
+            handler.build_captured(captured[0]),
+            dict(sample_message,
+                 timestamp=int(sample_record.created * 1000)))
+
+        # Arguments that may change are rendered at once, and messages that
+        # fail to format are reported on the buffering thread
+        handler.buffer_logs_sync(captured[1:])
+        self.assertEqual(self.buffered_lines(handler.buf), ['items [1, 2]'])
+        handler.handleError.assert_called_once_with(captured[2])
+        self.assertEqual(handler.stats()['lines_dropped'], {'format': 1})
+        handler.close()
+
+    def test_emit_deferred_dict_args(self):
+        # Per-line options in a dict of arguments holding a mutable value
+        record = logging.LogRecord('test', logging.INFO, 'test', 1,
+                                   'invoice %(items)s', None, None)
+        record.args = {'app': 'billing', 'level': 'WARN', 'items': [1]}
+        handlers = [
+            LogDNAHandler(LOGDNA_API_KEY,
+                          dict(sample_options, defer_formatting=deferred))
+            for deferred in (False, True)
+        ]
+        for handler in handlers:
+            handler.buffer_log = unittest.mock.Mock()
+            handler.emit(record)
+        immediate, deferred = (handler.buffer_log.call_args[0][0]
+                               for handler in handlers)
+        # As the line would be buffered before the argument changes
+        immediate = json.loads(json.dumps(immediate))
+        record.args['items'].append(2)
+
+        deferred = handlers[1].build_captured(deferred)
+        self.assertEqual(dict(deferred, timestamp=None),
+                         dict(immediate, timestamp=None))
+        self.assertEqual(deferred['app'], 'billing')
+        self.assertEqual(deferred['level'], 'WARN')
+        self.assertEqual(deferred['line'], 'invoice [1]')
+        for handler in handlers:
+            handler.close()
+
+    def test_emit_many(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.setLevel(logging.INFO)
+        handler.request_thread_pool = MockThreadPoolExecutor()
+        handler.try_request = unittest.mock.Mock()
+        handler.buffer_encoded_logs_sync = unittest.mock.Mock(
+            wraps=handler.buffer_encoded_logs_sync)
+        handler.flush_limit = 2000
+        handler.drain_batch_size = 100
+        records = (logging.LogRecord('test', level, 'test', 1, 'record %d',
+                                     (i, ), None) for i in range(1000)
+                   for level in (logging.DEBUG, logging.INFO))
+        handler.emit_many(records)
+
+        # One hold of the buffer lock per chunk, bypassing the queue, and
+        # batches handed off at the flush limit as the records arrive
+        self.assertEqual(handler.buffer_encoded_logs_sync.call_count, 10)
+        self.assertIsNone(handler.log_consumer)
+        bufs = [call[0][0] for call in handler.try_request.call_args_list]
+        self.assertGreater(len(bufs), 10)
+        for buf in bufs:
+            self.assertLess(buf.size, handler.flush_limit + 200)
+        lines = [line for buf in bufs for line in self.buffered_lines(buf)]
+        lines += self.buffered_lines(handler.buf)
+        self.assertEqual(lines, ['record %d' % i for i in range(1000)])
+        handler.close()
+
+    def test_send_lines(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.send_lines(iter(['first', 'second']), {
+            'level': 'warn',
+            'app': 'batch',
+            'meta': {
+                'job': 1
+            }
+        })
+        messages = [json.loads(line) for line in handler.buf.lines()]
+        self.assertEqual([m['line'] for m in messages], ['first', 'second'])
+        for message in messages:
+            self.assertEqual(message['hostname'], 'localhost')
+            self.assertEqual(message['level'], 'warn')
+            self.assertEqual(message['app'], 'batch')
+            self.assertEqual(message['env'], '')
+            self.assertEqual(message['meta'], {'job': 1})
+            self.assertGreaterEqual(message['timestamp'], now * 1000)
+        handler.close()
+
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_lock_and_do_flush_request(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 200
             r.reason = 'OK'
             post_mock.return_value = r
-            sample_message['timestamp'] = unittest.mock.ANY
-            handler.buf = [sample_message]
+            handler.buf = [dict(sample_message, timestamp=now)]
             test_buf = handler.buf.copy()
             handler.try_lock_and_do_flush_request()
             post_mock.assert_called_with(
                 url=handler.url,
-                json={
-                    'e': 'ls',
-                    'ls': test_buf
-                },
+                data=mock.ANY,
                 params={
                     'hostname': handler.hostname,
                     'ip': handler.ip,
@@ -169,12 +315,18 @@ class LogDNAHandlerTest(unittest.TestCase):
                 timeout=handler.request_timeout,
                 headers={
                     'user-agent': handler.user_agent,
-                    'apikey': LOGDNA_API_KEY})
+                    'apikey': LOGDNA_API_KEY,
+                    'content-type': 'application/json; charset=UTF-8'})
             self.assertTrue(post_mock.call_count, 1)
+            _, kwargs = post_mock.call_args
+            self.assertEqual(json.loads(b''.join(kwargs['data'])), {
+                'e': 'ls',
+                'ls': test_buf
+            })
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_500(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 500
@@ -183,11 +335,12 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 3)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 3)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_502(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 502
@@ -196,11 +349,12 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 3)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 3)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_504(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 504
@@ -209,11 +363,12 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 3)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 3)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_429(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 429
@@ -222,11 +377,12 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 3)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 3)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_403(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 403
@@ -235,11 +391,12 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 1)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 1)
 
     @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
     def test_try_request_403_log_response(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 403
@@ -249,7 +406,72 @@ class LogDNAHandlerTest(unittest.TestCase):
             sample_message['timestamp'] = unittest.mock.ANY
             handler.buf = [sample_message]
             handler.try_request([])
-            self.assertTrue(post_mock.call_count, 1)
+            self.assertTrue(handler.wait_for_requests(10))
+            self.assertEqual(post_mock.call_count, 1)
+
+    def test_stream_payload(self):
+        message = dict(sample_message, timestamp=now)
+        data = {'e': 'ls', 'ls': [message] * 1000}
+        buf = LogBuffer([encode_message(message)] * 1000)
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        chunks, content_encoding = handler.stream_payload(buf)
+        chunks = list(chunks)
+        self.assertIsNone(content_encoding)
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(json.loads(b''.join(chunks)), data)
+
+        options = dict(sample_options, compression='gzip')
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        handler.compression_threshold = buf.size + 1
+        handler.compress_batch(buf)
+        chunks, content_encoding = handler.stream_payload(buf)
+        self.assertIsNone(content_encoding)
+        self.assertEqual(json.loads(b''.join(chunks)), data)
+
+        # Compressed once, for every attempt
+        handler.compression_threshold = buf.size
+        handler.compress_batch(buf)
+        body, content_encoding = handler.stream_payload(buf)
+        self.assertEqual(content_encoding, 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body)), data)
+        with patch('logdna.logdna.iter_compressed') as iter_compressed:
+            handler.compress_batch(buf)
+            self.assertIs(handler.stream_payload(buf)[0], body)
+            iter_compressed.assert_not_called()
+
+        # Until lines are shed from it
+        buf.evict(1)
+        self.assertIsNone(buf.compressed)
+        handler.compression_threshold = 0
+        handler.compress_batch(buf)
+        body, _ = handler.stream_payload(buf)
+        self.assertEqual(len(json.loads(gzip.decompress(body))['ls']), 999)
+
+    def test_compression_option(self):
+        options = dict(sample_options, compression='brotli')
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        self.assertIsNone(handler.compression)
+
+        with patch('logdna.logdna.zstandard', None):
+            options = dict(sample_options, compression='zstd')
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            self.assertEqual(handler.compression, 'gzip')
+
+    @mock.patch('time.time', unittest.mock.MagicMock(return_value=now))
+    def test_send_request_compressed(self):
+        with patch('requests.Session.post') as post_mock:
+            handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+            r = requests.Response()
+            r.status_code = 200
+            r.reason = 'OK'
+            post_mock.return_value = r
+            self.assertTrue(handler.send_request(b'payload', 'gzip'))
+            _, kwargs = post_mock.call_args
+            self.assertEqual(kwargs['data'], b'payload')
+            self.assertNotIn('json', kwargs)
+            self.assertEqual(kwargs['headers']['content-encoding'], 'gzip')
+            self.assertEqual(kwargs['headers']['content-type'],
+                             'application/json; charset=UTF-8')
 
     def test_close(self):
         handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
@@ -261,9 +483,30 @@ class LogDNAHandlerTest(unittest.TestCase):
         handler.close_flusher.assert_called_once_with()
         handler.schedule_flush_sync.assert_called_once_with(
             should_block=True)
-        self.assertIsNone(handler.worker_thread_pool)
+        self.assertIsNone(handler.log_queue)
+        self.assertIsNone(handler.log_consumer)
         self.assertIsNone(handler.request_thread_pool)
 
+    def test_session(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        self.assertIsInstance(handler.session, requests.Session)
+        adapter = handler.session.get_adapter(handler.url)
+        self.assertEqual(adapter._pool_maxsize,
+                         handler.max_concurrent_requests)
+        handler.session.close = unittest.mock.Mock()
+        handler.close()
+        handler.session.close.assert_called_once_with()
+
+    def test_reap_idle_connections(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.session.close = unittest.mock.Mock()
+        handler.reap_idle_connections()
+        handler.session.close.assert_not_called()
+        handler.session_last_used -= handler.pool_idle_timeout_secs
+        handler.reap_idle_connections()
+        handler.session.close.assert_called_once_with()
+        handler.close()
+
     # These should be separate objects, since there is already
     # a variable in the base class named self.lock. We want
     # to make sure that a separate lock is created for the
@@ -279,30 +522,335 @@ class LogDNAHandlerTest(unittest.TestCase):
 
     def test_flush(self):
         handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
-        handler.worker_thread_pool = MockThreadPoolExecutor()
         handler.request_thread_pool = MockThreadPoolExecutor()
-        handler.buf = [sample_message]
-        handler.buf_size += len(handler.buf)
+        line = encode_message(dict(sample_message, timestamp=now))
+        handler.buf.append(line)
         handler.try_request = unittest.mock.Mock()
         handler.flush()
-        handler.try_request.assert_called_once_with([sample_message])
+        handler.try_request.assert_called_once()
+        self.assertEqual(list(handler.try_request.call_args[0][0].lines()),
+                         [line])
+        self.assertEqual(len(handler.buf), 0)
 
     def test_buffer_log(self):
-        with patch('requests.post') as post_mock:
+        with patch('requests.Session.post') as post_mock:
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             r = requests.Response()
             r.status_code = 200
             r.reason = 'OK'
             post_mock.return_value = r
-            handler.worker_thread_pool = MockThreadPoolExecutor()
             handler.request_thread_pool = MockThreadPoolExecutor()
-            handler.flush = unittest.mock.Mock()
+            handler.try_request = unittest.mock.Mock()
             sample_message['timestamp'] = now
-            handler.flush_limit = 0
+            line = encode_message(sample_message)
             handler.buffer_log(sample_message)
-            handler.flush.assert_called_once_with()
-            self.assertEqual(handler.buf, [sample_message])
-            self.assertEqual(handler.buf_size, len(sample_message['line']))
+            handler.stop_log_consumer()
+            handler.try_request.assert_not_called()
+            self.assertEqual(list(handler.buf.lines()), [line])
+            self.assertEqual(handler.buf.size, len(line))
+
+            # A full buffer is sent as soon as the line that fills it
+            handler.flush_limit = 2 * len(line)
+            handler.buffer_log(sample_message)
+            handler.try_request.assert_called_once()
+            buf = handler.try_request.call_args[0][0]
+            self.assertEqual(list(buf.lines()), [line, line])
+            self.assertEqual(len(handler.buf), 0)
+
+    def test_max_line_bytes(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(sample_options, max_line_bytes=200))
+        handler.request_thread_pool = MockThreadPoolExecutor()
+        handler.try_request = unittest.mock.Mock()
+        handler.buffer_logs_sync([{
+            'line': 'x' * size,
+            'timestamp': now
+        } for size in (10, 1000, 20)])
+        lines = [json.loads(line) for line in handler.buf.lines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0]['line'], 'x' * 10)
+        self.assertTrue(lines[1]['line'].startswith('xxx'))
+        self.assertTrue(lines[1]['line'].endswith(' [truncated]'))
+        for line in handler.buf.lines():
+            self.assertLessEqual(len(line), 200)
+        self.assertEqual(handler.stats()['lines_truncated'], 1)
+
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(sample_options, max_line_bytes=200, max_line_policy='drop'))
+        handler.request_thread_pool = MockThreadPoolExecutor()
+        handler.try_request = unittest.mock.Mock()
+        handler.buffer_logs_sync([{
+            'line': 'x' * size,
+            'timestamp': now
+        } for size in (10, 1000, 20)])
+        lines = [json.loads(line)['line'] for line in handler.buf.lines()]
+        self.assertEqual(lines, ['x' * 10, 'x' * 20])
+        self.assertEqual(handler.stats()['lines_dropped'], {'size': 1})
+
+    def limit_test_messages(self):
+        # Non-ASCII and meta heavy lines of varying size
+        return [{
+            'line': 'ünïcødé ✓ ' * (i % 37),
+            'app': 'app',
+            'env': 'env',
+            'meta': json.dumps({'key%d' % j: 'välue' for j in range(i % 23)}),
+            'timestamp': now
+        } for i in range(1000)]
+
+    def test_flush_limit_holds_within_one_line(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.request_thread_pool = MockThreadPoolExecutor()
+        handler.try_request = unittest.mock.Mock()
+        handler.flush_limit = 10000
+        messages = self.limit_test_messages()
+        longest = max(len(encode_message(m)) for m in messages)
+        for start in range(0, len(messages), 100):
+            handler.buffer_logs_sync(messages[start:start + 100])
+
+        bufs = [call[0][0] for call in handler.try_request.call_args_list]
+        self.assertGreater(len(bufs), 10)
+        for buf in bufs:
+            self.assertGreaterEqual(buf.size, handler.flush_limit)
+            self.assertLess(buf.size, handler.flush_limit + longest + 1)
+            self.assertEqual(len(buf.payload()), buf.size + 18)
+
+        sent = [json.loads(line) for buf in bufs for line in buf.lines()]
+        kept = [json.loads(line) for line in handler.buf.lines()]
+        self.assertEqual(sent + kept, messages)
+
+    def test_buffer_shards(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(sample_options, buffer_shards=4))
+        handler.request_thread_pool = MockThreadPoolExecutor()
+        handler.try_request = unittest.mock.Mock()
+        handler.flush_limit = 100000
+        handler.shard_bytes = 5000
+
+        def produce(thread):
+            for start in range(0, 2000, 100):
+                handler.send_lines('%d %d' % (thread, i)
+                                   for i in range(start, start + 100))
+
+        threads = [
+            threading.Thread(target=produce, args=(thread, ))
+            for thread in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Full batches are handed off as shards are merged, and the lines
+        # still staged are counted until a flush collects them
+        sent = handler.try_request.call_count
+        self.assertGreater(sent, 1)
+        self.assertEqual(
+            sum(len(call[0][0]) for call in handler.try_request.call_args_list)
+            + handler.stats()['buffered_lines'], 16000)
+        handler.try_lock_and_do_flush_request()
+        self.assertEqual(handler.try_request.call_count, sent + 1)
+        self.assertEqual(handler.stats()['buffered_lines'], 0)
+        bufs = [call[0][0] for call in handler.try_request.call_args_list]
+        for buf in bufs:
+            self.assertLess(buf.size, handler.flush_limit + 200)
+            self.assertEqual(len(buf.payload()), buf.size + 18)
+
+        # Each thread's lines stay in order
+        lines = [line for buf in bufs for line in self.buffered_lines(buf)]
+        self.assertEqual(len(lines), 16000)
+        for thread in range(8):
+            self.assertEqual(
+                [line for line in lines if line.startswith('%d ' % thread)],
+                ['%d %d' % (thread, i) for i in range(2000)])
+        handler.close()
+
+    def test_retention_limit_holds_within_one_line(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.try_request = unittest.mock.Mock()
+        handler.buf_retention_limit = 10000
+        messages = self.limit_test_messages()
+        longest = max(len(encode_message(m)) for m in messages)
+        handler.buffer_logs_sync(messages)
+
+        handler.try_request.assert_not_called()
+        self.assertLess(handler.buf.size, handler.buf_retention_limit)
+        self.assertGreater(handler.buf.size,
+                           handler.buf_retention_limit - longest - 1)
+
+        # Full buffers waiting for a request thread count towards the limit
+        handler.buf = LogBuffer()
+        handler.queued_bytes = handler.buf_retention_limit // 2
+        handler.buffer_logs_sync(messages)
+        self.assertLess(handler.buf.size, handler.buf_retention_limit // 2)
+
+    def test_dedup_window(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(sample_options, dedup_window=0.2))
+        handler.buffer_log = unittest.mock.Mock()
+        for i in range(1000):
+            handler.emit(
+                logging.LogRecord('test', logging.ERROR, 'test', 1,
+                                  'failed %d', (i, ), None))
+        handler.emit(sample_record)
+        messages = [call[0][0] for call in handler.buffer_log.call_args_list]
+        self.assertEqual([m['line'] for m in messages],
+                         ['failed 0', 'Something to test'])
+        self.assertEqual(handler.stats()['lines_deduplicated'], 999)
+
+        # The count follows with the last repeat once the window ends
+        self.assertTrue(wait_for(lambda: handler.buffer_log.call_count > 2))
+        repeat = handler.buffer_log.call_args[0][0]
+        self.assertEqual(repeat['line'], 'failed 999')
+        self.assertEqual(repeat['meta']['repeated'], 999)
+        handler.close()
+        self.assertEqual(handler.buffer_log.call_count, 3)
+
+    def test_rate_limit(self):
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(sample_options, rate_limit=10, rate_limit_burst=20))
+        handler.buffer_log = unittest.mock.Mock()
+        for name, count in (('noisy', 100), ('quiet', 5)):
+            for i in range(count):
+                handler.emit(
+                    logging.LogRecord(name, logging.INFO, 'test', 1, 'line',
+                                      (), None))
+        self.assertEqual(handler.buffer_log.call_count, 25)
+        self.assertEqual(handler.stats()['lines_dropped'],
+                         {'rate_limit': 80})
+        handler.close()
+
+        notice = handler.buffer_log.call_args[0][0]
+        self.assertEqual(notice['level'], 'WARNING')
+        self.assertEqual(
+            notice['line'],
+            '80 lines from logger noisy dropped by the rate limit')
+        self.assertEqual(notice['meta'], {
+            'logger': 'noisy',
+            'lines_dropped': 80
+        })
+
+    def level_messages(self, level, start, end):
+        return [{
+            'line': '%s %d' % (level, i),
+            'level': level,
+            'timestamp': now
+        } for i in range(start, end)]
+
+    def overflow_handler(self, policy, **options):
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(sample_options,
+                 overflow_policy=policy,
+                 buf_retention_limit=4000,
+                 flush_interval=10,
+                 **options))
+        handler.try_request = unittest.mock.Mock()
+        return handler
+
+    def buffered_lines(self, buf):
+        return [json.loads(line)['line'] for line in buf.lines()]
+
+    def test_overflow_drop_oldest(self):
+        handler = self.overflow_handler('drop_oldest')
+        handler.buffer_logs_sync(self.level_messages('INFO', 0, 1000))
+        self.assertLess(handler.buf.size, handler.buf_retention_limit)
+        lines = self.buffered_lines(handler.buf)
+        self.assertEqual(lines[-1], 'INFO 999')
+        self.assertNotIn('INFO 0', lines)
+        self.assertEqual(handler.shed, {logging.INFO: 1000 - len(lines)})
+
+        # The next batch reports what was shed
+        summary = json.loads(list(handler.take_buffer().lines())[-1])
+        self.assertEqual(summary['level'], 'WARNING')
+        self.assertEqual(
+            summary['line'], '%d lines dropped by the drop_oldest overflow '
+            'policy (INFO: %d)' % (1000 - len(lines), 1000 - len(lines)))
+        self.assertEqual(summary['meta']['lines_dropped'],
+                         {'INFO': 1000 - len(lines)})
+        self.assertEqual(handler.shed, {})
+        self.assertNotIn('WARNING', self.buffered_lines(handler.take_buffer()))
+
+    def test_overflow_drop_lowest_level(self):
+        handler = self.overflow_handler('drop_lowest_level')
+        handler.buffer_logs_sync(self.level_messages('DEBUG', 0, 200))
+        handler.buffer_logs_sync(self.level_messages('INFO', 0, 100))
+        handler.buffer_logs_sync(self.level_messages('ERROR', 0, 50))
+        lines = self.buffered_lines(handler.buf)
+        self.assertEqual([line for line in lines if 'ERROR' in line],
+                         ['ERROR %d' % i for i in range(50)])
+        self.assertTrue(any('INFO' in line for line in lines))
+        self.assertFalse(any('DEBUG' in line for line in lines))
+        self.assertEqual(handler.shed[logging.DEBUG], 200)
+
+        # Once the buffer is full again, lines no more important than any
+        # buffered are the ones dropped
+        handler.buffer_logs_sync(self.level_messages('DEBUG', 200, 300))
+        lines = self.buffered_lines(handler.buf)
+        self.assertEqual(len([line for line in lines if 'ERROR' in line]), 50)
+        self.assertEqual(
+            handler.shed[logging.DEBUG] +
+            len([line for line in lines if 'DEBUG' in line]), 300)
+        self.assertGreater(handler.shed[logging.DEBUG], 250)
+
+    def test_overflow_drop_lowest_level_from_pending_batches(self):
+        handler = self.overflow_handler('drop_lowest_level',
+                                        flush_limit=1000)
+        handler.request_thread_pool = unittest.mock.Mock()
+        handler.buffer_logs_sync(self.level_messages('DEBUG', 0, 200))
+        self.assertGreater(len(handler.pending), 1)
+        handler.buffer_logs_sync(self.level_messages('ERROR', 0, 50))
+        lines = [
+            line for buf in list(handler.pending) + [handler.buf]
+            for line in self.buffered_lines(buf)
+        ]
+        debug = [line for line in lines if line.startswith('DEBUG ')]
+        self.assertEqual(len([line for line in lines if 'ERROR' in line]), 50)
+        self.assertEqual(handler.stats()['lines_shed']['DEBUG'],
+                         200 - len(debug))
+        self.assertEqual(handler.queued_bytes,
+                         sum(buf.size for buf in handler.pending))
+
+    def test_overflow_sample(self):
+        handler = self.overflow_handler('sample',
+                                        overflow_sample_rates={'DEBUG': 0})
+        handler.buffer_logs_sync(self.level_messages('DEBUG', 0, 200))
+        watermark = handler.buf_retention_limit * 0.75
+        self.assertLess(handler.buf.size, watermark)
+        self.assertGreater(handler.buf.size, watermark - 100)
+
+        handler.buffer_logs_sync(self.level_messages('ERROR', 0, 200))
+        self.assertLess(handler.buf.size, handler.buf_retention_limit)
+        self.assertGreater(handler.buf.size, watermark)
+        self.assertIn(logging.DEBUG, handler.shed)
+        self.assertIn(logging.ERROR, handler.shed)
+
+    def test_overflow_block(self):
+        handler = self.overflow_handler('block', overflow_timeout=0.2)
+        started = time.monotonic()
+        handler.buffer_logs_sync(self.level_messages('INFO', 0, 1000))
+        elapsed = time.monotonic() - started
+        # Waits once for room, then sheds without waiting
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+        self.assertGreater(handler.shed[logging.INFO], 0)
+        self.assertFalse(handler._has_room.is_set())
+
+        # Lines sent make room again
+        handler.try_lock_and_do_flush_request()
+        self.assertTrue(handler._has_room.is_set())
+
+        # A flush while waiting lets the line in
+        handler.shed = {}
+        handler.buffer_logs_sync(self.level_messages('INFO', 0, 50))
+        handler.overflow_timeout = 5
+        flusher = threading.Timer(0.2, handler.try_lock_and_do_flush_request)
+        flusher.start()
+        handler.buffer_logs_sync(self.level_messages('INFO', 50, 100))
+        flusher.join()
+        self.assertEqual(handler.shed, {})
+        self.assertEqual(self.buffered_lines(handler.buf)[-1], 'INFO 99')
 
     # Attempts to reproduce the specific scenario that resulted in
     # https://mezmo.atlassian.net/browse/LOG-15414 where log messages
@@ -321,8 +869,9 @@ class LogDNAHandlerTest(unittest.TestCase):
         num_logs = 10**5
         received = list()
 
-        def append_received(json=None, **kwargs):
-            ids = [int(log['line']) for log in json['ls']]
+        def append_received(data=None, **kwargs):
+            lines = json.loads(b''.join(data))['ls']
+            ids = [int(log['line']) for log in lines]
             for id in ids:
                 received.append(id)
             r = requests.Response()
@@ -344,7 +893,7 @@ class LogDNAHandlerTest(unittest.TestCase):
                 func='',
                 sinfo='')
 
-        with patch('requests.post', side_effect=append_received):
+        with patch('requests.Session.post', side_effect=append_received):
             handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
             for i in range(num_logs):
                 handler.emit(get_sample_record(i))
@@ -353,11 +902,586 @@ class LogDNAHandlerTest(unittest.TestCase):
         self.assertEqual(len(received), num_logs)
         self.assertEqual(set(received), set(range(num_logs)))
 
+    def test_buffer_log_batches(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.flush = unittest.mock.Mock()
+        handler.start_flusher = unittest.mock.Mock()
+        handler.buffer_logs_sync = unittest.mock.Mock()
+        messages = [dict(sample_message, line=str(i)) for i in range(10)]
+        for message in messages:
+            handler.log_queue.put(message)
+        handler.buffer_log(messages[0])
+        self.assertIsNotNone(handler.log_consumer)
+        handler.stop_log_consumer()
+
+        # Records are drained in order and in batches, not one at a time
+        buffered = [
+            message for call in handler.buffer_logs_sync.call_args_list
+            for message in call[0][0]
+        ]
+        self.assertEqual(buffered, messages + messages[:1])
+        self.assertLess(handler.buffer_logs_sync.call_count, len(buffered))
+        self.assertIsNone(handler.log_consumer)
+
+    def test_buffer_log_after_close(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
+        handler.close()
+        handler.buffer_log_sync = unittest.mock.Mock()
+        handler.buffer_log(sample_message)
+        handler.buffer_log_sync.assert_called_once_with(sample_message)
+
     def test_when_handlerShutDown_then_handlerDoesNotHang(self):
         handler = LogDNAHandler(LOGDNA_API_KEY, sample_options)
         self.assertIsNotNone(handler)
         # Do nothing. This test should pass by virtue of not hanging.
 
 
+class LogDNAHandlerIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.server = IngestServer().start()
+        self.options = dict(sample_options,
+                            url=self.server.url,
+                            index_meta=False,
+                            max_concurrent_requests=1,
+                            retry_interval_secs=0.2,
+                            max_retry_jitter=0.05)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def lines(self, start, end):
+        return [{'line': str(i), 'timestamp': now} for i in range(start, end)]
+
+    def test_retry_does_not_hold_request_thread(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, self.options)
+        self.server.fail_next(2)
+        handler.try_request(self.lines(0, 5))
+        self.assertEqual(self.server.failures, 1)
+
+        # The only request thread is free while the first batch waits
+        done = threading.Event()
+        handler.request_thread_pool.submit(
+            lambda: (handler.try_request(self.lines(5, 10)), done.set()))
+        self.assertTrue(done.wait(0.2))
+
+        self.assertTrue(handler.wait_for_requests(5))
+        self.assertEqual(self.server.failures, 2)
+        self.assertEqual(self.server.lines, 10)
+        handler.close()
+
+    def test_retry_gives_up_after_max_attempts(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, self.options)
+        self.server.fail_next(handler.max_retry_attempts)
+        handler.try_request(self.lines(0, 5))
+        handler.close()
+        self.assertEqual(self.server.failures, handler.max_retry_attempts)
+        self.assertEqual(self.server.lines, 0)
+
+    def test_spool_exhausted_retries(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            options = dict(self.options, spool_dir=spool_dir)
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            self.server.fail_next(handler.max_retry_attempts)
+            handler.try_request(self.lines(0, 5))
+            self.assertTrue(handler.wait_for_requests(5))
+            self.assertEqual(self.server.lines, 0)
+            self.assertTrue(handler.spool.pending())
+
+            # Ingestion has recovered, so the spooled batch follows
+            handler.try_request(self.lines(5, 10))
+            self.assertTrue(handler.wait_for_requests(5))
+            self.assertEqual(self.server.lines, 10)
+            self.assertFalse(handler.spool.pending())
+            stats = handler.stats()
+            self.assertEqual(stats['lines_spooled'], 5)
+            self.assertEqual(stats['lines_sent'], 10)
+            handler.close()
+
+    def test_spool_buffer_overflow(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            options = dict(self.options,
+                           spool_dir=spool_dir,
+                           buf_retention_limit=200)
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            handler.buffer_logs_sync(self.lines(100, 200))
+            self.assertTrue(handler.spool.pending())
+            self.assertLess(handler.buf.size, 200)
+
+            handler.try_lock_and_do_flush_request(True)
+            self.assertTrue(handler.wait_for_requests(5))
+            self.assertEqual(self.server.lines, 100)
+            handler.close()
+
+    def test_retention_limit_holds_batches_retrying(self):
+        self.server.fail_next(10000)
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(self.options,
+                 max_concurrent_requests=2,
+                 max_retry_attempts=100,
+                 buf_retention_limit=20000,
+                 flush_limit=2000))
+        most = 0
+        for start in range(0, 3000, 100):
+            handler.buffer_logs_sync([{
+                'line': 'x' * 50 + str(i),
+                'timestamp': now
+            } for i in range(start, start + 100)])
+            most = max(most, handler.stats()['buffered_bytes'])
+            time.sleep(0.01)
+
+        # Batches waiting for a retry are counted, and lines are shed. Only
+        # the line reporting the lines shed goes past the limit.
+        self.assertLess(most, 20000 + 500)
+        self.assertGreater(len(handler.retrying), 1)
+        self.assertTrue(handler.stats()['lines_shed'])
+        self.server.statuses.clear()
+        handler.close()
+        stats = handler.stats()
+        self.assertEqual(stats['buffered_bytes'], 0)
+        # Every line was sent or shed, along with the reports of those shed
+        self.assertGreaterEqual(
+            self.server.lines + sum(stats['lines_shed'].values()), 3000)
+
+    def test_spool_replay_on_start(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            options = dict(self.options, spool_dir=spool_dir)
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            self.server.fail_next(handler.max_retry_attempts)
+            handler.try_request(self.lines(0, 5))
+            handler.close()
+            self.assertEqual(self.server.lines, 0)
+
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            self.assertTrue(wait_for(lambda: self.server.lines == 5))
+            self.assertTrue(handler.wait_for_requests(5))
+            self.assertFalse(handler.spool.pending())
+            handler.close()
+
+    def test_stats(self):
+        events = []
+        options = dict(self.options,
+                       buf_retention_limit=1000,
+                       flush_interval=10,
+                       stats_callback=lambda *event: events.append(event))
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        self.server.fail_next(1)
+        handler.buffer_logs_sync(self.lines(0, 100))
+        handler.close()
+
+        stats = handler.stats()
+        self.assertEqual(stats['lines_in'], 100)
+        dropped = stats['lines_dropped']['retention']
+        self.assertGreater(dropped, 0)
+        self.assertEqual(stats['lines_shed'], {'INFO': dropped})
+        # The batch also reports the lines dropped
+        self.assertEqual(stats['lines_sent'], 100 - dropped + 1)
+        self.assertEqual(stats['lines_sent'], self.server.lines)
+        self.assertEqual(stats['bytes_sent'], self.server.bytes_received)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['status_codes'], {503: 1, 200: 1})
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(sum(stats['batch_bytes'].values()), 1)
+        self.assertEqual(sum(stats['request_latency'].values()), 2)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['inflight_requests'], 0)
+
+        self.assertEqual(
+            events.count(('drop', {
+                'lines': 1,
+                'reason': 'retention',
+                'level': 'INFO'
+            })), dropped)
+        requests = [fields for event, fields in events if event == 'request']
+        self.assertEqual([r['status_code'] for r in requests], [503, 200])
+        self.assertEqual(requests[1]['lines'], 100 - dropped + 1)
+        self.assertEqual([e for e, _ in events if e == 'retry'], ['retry'])
+
+    def test_circuit_breaker(self):
+        events = []
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(self.options,
+                 circuit_breaker=2,
+                 circuit_breaker_reset=0.5,
+                 # The failed batches wait for their retries until flush()
+                 retry_interval_secs=60,
+                 stats_callback=lambda event, fields: events.append(
+                     (event, fields))))
+        self.server.fail_next(2)
+        handler.try_request(self.lines(0, 10))
+        handler.try_request(self.lines(10, 20))
+        self.assertEqual(handler.breaker.state, 'open')
+
+        # While the circuit is open, batches are held without a request
+        handler.try_request(self.lines(20, 30))
+        stats = handler.stats()
+        self.assertEqual(stats['circuit_state'], 'open')
+        self.assertEqual(stats['circuit_failures'], 2)
+        self.assertEqual(stats['parked_batches'], 1)
+        self.assertEqual(self.server.failures, 2)
+        self.assertEqual(self.server.requests, 0)
+
+        # A single probe closes it, and the held batch goes out
+        self.assertTrue(wait_for(lambda: handler.breaker.state == 'closed'))
+        self.assertEqual(self.server.lines, 10)
+        self.assertEqual(self.server.failures, 2)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(handler.stats()['parked_batches'], 0)
+
+        self.assertTrue(handler.flush(timeout=5)['flushed'])
+        self.assertEqual(self.server.lines, 30)
+        stats = handler.stats()
+        self.assertEqual(stats['circuit_transitions'], {
+            'open': 1,
+            'closed': 1
+        })
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['lines_sent'], 30)
+        self.assertEqual([f['state'] for e, f in events if e == 'circuit'],
+                         ['open', 'closed'])
+        handler.close()
+
+    def test_circuit_breaker_replay_without_slot(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            handler = LogDNAHandler(
+                LOGDNA_API_KEY,
+                dict(self.options,
+                     spool_dir=spool_dir,
+                     circuit_breaker=1,
+                     circuit_breaker_reset=0.1))
+            handler.spool_payload(
+                LogBuffer(encode_message(line) for line in self.lines(0, 5)),
+                None)
+            handler.breaker.record(False, time.monotonic())
+            time.sleep(0.2)
+
+            # The replay finds no request slot free, and leaves the probe
+            # of the half open circuit to the next batch
+            self.assertTrue(handler.pacer.acquire())
+            handler.schedule_replay()
+            self.assertTrue(handler.wait_for_requests(5))
+            handler.pacer.release()
+            self.assertEqual(self.server.requests, 0)
+
+            handler.try_request(self.lines(5, 10))
+            self.assertTrue(wait_for(lambda: self.server.lines == 10))
+            self.assertEqual(handler.breaker.state, 'closed')
+            handler.close()
+
+    def test_circuit_breaker_close(self):
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(self.options, circuit_breaker=1, circuit_breaker_reset=10))
+        self.server.fail_next(1)
+        handler.try_request(self.lines(0, 10))
+        handler.buffer_logs_sync(self.lines(10, 20))
+
+        # close() does not wait for the circuit to close again
+        started = time.monotonic()
+        report = handler.close()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(
+            report, {
+                'flushed': False,
+                'lines_sent': 0,
+                'lines_spooled': 0,
+                'lines_dropped': 20,
+                'batches_pending': 0
+            })
+        self.assertEqual(handler.stats()['lines_discarded'],
+                         {'shutdown': 20})
+        self.assertEqual(self.server.failures, 1)
+
+    def test_retry_after(self):
+        events = []
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(self.options,
+                 max_concurrent_requests=4,
+                 stats_callback=lambda event, fields: events.append(
+                     (event, fields))))
+        self.server.fail_next(1, 429, retry_after=1)
+        started = time.monotonic()
+        handler.try_request(self.lines(0, 10))
+
+        # The pause holds back every batch, not only the throttled one,
+        # without counting an attempt
+        handler.try_request(self.lines(10, 20))
+        self.assertEqual(self.server.failures, 1)
+        self.assertEqual(self.server.requests, 0)
+        stats = handler.stats()
+        self.assertEqual(stats['concurrency_limit'], 2)
+        self.assertGreater(stats['paused_secs'], 0.5)
+
+        self.assertTrue(wait_for(lambda: self.server.lines == 20))
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertEqual(self.server.requests, 2)
+        stats = handler.stats()
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['paused_secs'], 0)
+        self.assertEqual(
+            [fields for event, fields in events if event == 'backoff'], [{
+                'status_code': 429,
+                'retry_after': 1,
+                'concurrency': 2
+            }])
+        handler.close()
+
+    def test_rate_limited(self):
+        handler = LogDNAHandler(
+            LOGDNA_API_KEY,
+            dict(self.options, max_concurrent_requests=10, flush_limit=300))
+        self.server.fail_next(3, 429, retry_after=1)
+        started = time.monotonic()
+        handler.buffer_logs_sync(self.lines(0, 300))
+        report = handler.close()
+
+        # Every worker backs off together, for as long as the server asked,
+        # so nothing runs out of retries and only the throttled requests
+        # are sent again
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertTrue(report['flushed'])
+        self.assertEqual(report['lines_sent'], 300)
+        self.assertEqual(self.server.lines, 300)
+        self.assertEqual(handler.stats()['lines_discarded'], {})
+        self.assertEqual(self.server.throttled, 3)
+        self.assertEqual(self.server.failures, 3)
+
+    def test_split_rejected_batch(self):
+        with IngestServer(poison='poison') as server:
+            handler = LogDNAHandler(LOGDNA_API_KEY,
+                                    dict(self.options, url=server.url))
+            lines = self.lines(0, 16)
+            lines[5]['line'] = 'poison'
+            handler.try_request(lines)
+            report = handler.close()
+
+            # Halving the rejected batch narrows it down to the one line
+            self.assertEqual(server.lines, 15)
+            self.assertEqual(report['lines_sent'], 15)
+            stats = handler.stats()
+            self.assertEqual(stats['lines_discarded'], {'status': 1})
+            self.assertEqual(stats['batches_split'], 4)
+            self.assertEqual(stats['status_codes'][400], 5)
+
+    def test_split_stops_when_every_request_is_rejected(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, self.options)
+        self.server.fail_next(1000, 400)
+        handler.try_request(self.lines(0, 512))
+        handler.close()
+
+        # The batch, its halves, and the halves of the first half, which
+        # was split before the second half was rejected as well
+        self.assertLessEqual(self.server.failures, 5)
+        self.assertEqual(self.server.lines, 0)
+        stats = handler.stats()
+        self.assertEqual(stats['lines_discarded'], {'status': 512})
+        self.assertLessEqual(stats['batches_split'], 2)
+
+    def test_max_request_bytes(self):
+        with IngestServer(max_body_bytes=1000) as server:
+            handler = LogDNAHandler(
+                LOGDNA_API_KEY,
+                dict(self.options, url=server.url, max_request_bytes=1000))
+            lines = [{
+                'line': 'x' * 100,
+                'timestamp': now
+            } for _ in range(50)]
+            handler.try_request(lines)
+            handler.close()
+
+            self.assertEqual(server.lines, 50)
+            self.assertEqual(server.failures, 0)
+            self.assertGreater(server.requests, 5)
+            self.assertEqual(handler.stats()['batches'], server.requests)
+
+    def test_flush_timeout(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(self.options, flush_interval=10))
+        self.server.fail_next(1)
+        handler.buffer_logs_sync(self.lines(0, 50))
+        # The retry is sent without waiting for retry_interval_secs
+        handler.retry_interval_secs = 10
+        started = time.monotonic()
+        report = handler.flush(timeout=5)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(
+            report, {
+                'flushed': True,
+                'lines_sent': 50,
+                'lines_spooled': 0,
+                'lines_dropped': 0,
+                'batches_pending': 0
+            })
+        self.assertEqual(self.server.lines, 50)
+        handler.close()
+
+    def close_slowly(self, **options):
+        # Small batches sent one at a time, to a server that takes 0.2
+        # seconds for each
+        with IngestServer(latency=0.2) as server:
+            handler = LogDNAHandler(
+                LOGDNA_API_KEY,
+                dict(self.options, url=server.url, flush_limit=500,
+                     **options))
+            handler.buffer_logs_sync(self.lines(0, 100))
+            started = time.monotonic()
+            report = handler.close(timeout=0.5)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertFalse(report['flushed'])
+            self.assertGreater(report['lines_sent'], 0)
+
+            # The request under way when time ran out is left to complete
+            self.assertTrue(handler.wait_for_requests(1))
+            self.assertEqual(server.lines, handler.stats()['lines_sent'])
+        return handler, report
+
+    def test_close_timeout(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            options = dict(self.options, spool_dir=tmpdir)
+            handler, report = self.close_slowly(spool_dir=tmpdir)
+            # What was not sent by then is left for the next start
+            self.assertEqual(report['lines_dropped'], 0)
+            self.assertEqual(
+                handler.stats()['lines_sent'] + report['lines_spooled'], 100)
+
+            handler = LogDNAHandler(LOGDNA_API_KEY, options)
+            self.assertTrue(
+                wait_for(lambda: self.server.lines == report['lines_spooled']))
+            handler.close()
+
+    def test_close_timeout_drops(self):
+        handler, report = self.close_slowly()
+        stats = handler.stats()
+        self.assertEqual(stats['lines_discarded'],
+                         {'shutdown': report['lines_dropped']})
+        self.assertEqual(stats['lines_sent'] + report['lines_dropped'], 100)
+
+    def test_close_timeout_exit(self):
+        # The whole process exits in time, not only close(): the request
+        # still under way does not hold up the interpreter at exit
+        script = '\n'.join([
+            'import sys, time',
+            'from logdna import LogDNAHandler',
+            'handler = LogDNAHandler("key", {"url": sys.argv[1]})',
+            'handler.buffer_log_sync({"line": "slow", "timestamp": 1})',
+            'handler.flush(timeout=0.2)',
+            'handler.close(timeout=0.5)',
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with IngestServer(latency=5) as server:
+            started = time.monotonic()
+            subprocess.run([sys.executable, '-c', script, server.url],
+                           cwd=root, timeout=10, check=True)
+            self.assertLess(time.monotonic() - started, 3)
+
+    def test_adaptive_flush(self):
+        events = []
+        options = dict(self.options,
+                       adaptive_flush=True,
+                       min_flush_limit=8192,
+                       stats_callback=lambda *event: events.append(event))
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        stats = handler.stats()
+        self.assertEqual(stats['flush_limit'], 8192)
+        self.assertEqual(stats['flush_interval'], 0.1)
+
+        # Batches grow with the arrival rate
+        for i in range(20):
+            handler.buffer_logs_sync(self.lines(i * 200, (i + 1) * 200))
+            time.sleep(0.02)
+        self.assertGreater(handler.stats()['arrival_rate'], 0)
+        handler.close()
+
+        adapted = [fields for event, fields in events if event == 'adapt']
+        self.assertGreater(max(f['flush_limit'] for f in adapted), 8192)
+        self.assertEqual(self.server.lines, 4000)
+
+    def test_adaptive_flush_small_limit(self):
+        events = []
+        options = dict(self.options,
+                       adaptive_flush=True,
+                       flush_limit=2000,
+                       flush_interval=0.05,
+                       stats_callback=lambda *event: events.append(event))
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        stats = handler.stats()
+        self.assertEqual(stats['flush_limit'], 2000)
+        self.assertEqual(stats['flush_interval'], 0.05)
+
+        for i in range(10):
+            handler.buffer_logs_sync(self.lines(i * 100, (i + 1) * 100))
+            time.sleep(0.02)
+        handler.close()
+
+        # Never above the flush_limit option
+        limits = [fields['flush_limit'] for event, fields in events
+                  if event == 'adapt'] + [handler.stats()['flush_limit']]
+        self.assertLessEqual(max(limits), 2000)
+        self.assertEqual(self.server.lines, 1000)
+
+    def test_retry_jitter(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY, self.options)
+        handler.send_request = unittest.mock.Mock(return_value=False)
+        handler.scheduler.call_later = unittest.mock.Mock()
+        delays = set()
+        for _ in range(10):
+            handler.attempt_request(b'', None, 1)
+            delays.add(handler.scheduler.call_later.call_args[0][0])
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertGreaterEqual(delay, handler.retry_interval_secs)
+            self.assertLessEqual(
+                delay, handler.retry_interval_secs + handler.max_retry_jitter)
+
+    def test_streamed_request(self):
+        options = dict(self.options, compression='gzip')
+        handler = LogDNAHandler(LOGDNA_API_KEY, options)
+        handler.try_request(self.lines(0, 10000))
+        handler.close()
+        self.assertEqual(self.server.lines, 10000)
+        self.assertEqual(self.server.last_encoding, 'gzip')
+        self.assertEqual(self.server.last_body['ls'][-1]['line'], '9999')
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_fork_safety(self):
+        handler = LogDNAHandler(LOGDNA_API_KEY,
+                                dict(self.options, flush_interval=10))
+        handler.buffer_logs_sync(self.lines(0, 5))
+
+        # Fork while another thread holds the buffer lock
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with handler._lock:
+                locked.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+
+        def child():
+            handler.buffer_logs_sync(self.lines(5, 8))
+            handler.close()
+
+        process = multiprocessing.get_context('fork').Process(target=child)
+        process.start()
+        release.set()
+        holder.join()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+        self.assertEqual(process.exitcode, 0)
+
+        # The child only sends its own lines
+        self.assertEqual(self.server.lines, 3)
+        handler.close()
+        self.assertEqual(self.server.lines, 8)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from logdna.pacing import RequestPacer
+
+
+class RequestPacerTest(unittest.TestCase):
+    def test_pause(self):
+        pacer = RequestPacer(10, 60)
+        self.assertEqual(pacer.pause_remaining(0), 0)
+        pacer.throttled(5, 100)
+        self.assertEqual(pacer.pause_remaining(101), 4)
+        # A shorter pause does not cut a longer one short, and pauses are
+        # capped
+        pacer.throttled(1, 101)
+        self.assertEqual(pacer.pause_remaining(101), 4)
+        pacer.throttled(3600, 101)
+        self.assertEqual(pacer.pause_remaining(101), 60)
+        self.assertEqual(pacer.pause_remaining(200), 0)
+
+    def test_aimd(self):
+        pacer = RequestPacer(8, 60)
+        pacer.throttled(None, 0)
+        self.assertEqual(pacer.limit, 4)
+        self.assertEqual(pacer.pause_remaining(0), 0)
+        for _ in range(3):
+            pacer.throttled(None, 0)
+        self.assertEqual(pacer.limit, 1)
+
+        # Back up by one for every limit's worth of successes
+        pacer.succeeded()
+        self.assertEqual(pacer.limit, 2)
+        pacer.succeeded()
+        pacer.succeeded()
+        self.assertEqual(int(pacer.limit), 2)
+        pacer.succeeded()
+        self.assertEqual(int(pacer.limit), 3)
+        for _ in range(100):
+            pacer.succeeded()
+        self.assertEqual(pacer.limit, 8)
+
+    def test_acquire_waits_for_a_slot(self):
+        pacer = RequestPacer(2, 60)
+        pacer.throttled(None, 0)
+        self.assertTrue(pacer.acquire())
+        granted = []
+        self.assertFalse(pacer.acquire(granted.append, 1))
+        self.assertFalse(pacer.acquire(granted.append, 2))
+        self.assertFalse(pacer.acquire())
+        self.assertEqual(granted, [])
+
+        # Slots go to the waiters in order, as they are freed or the limit
+        # grows
+        pacer.release()
+        self.assertEqual(granted, [1])
+        self.assertEqual(pacer.sending, 1)
+        pacer.succeeded()
+        self.assertEqual(granted, [1, 2])
+        self.assertEqual(pacer.sending, 2)
+
+    def test_take(self):
+        pacer = RequestPacer(1, 60)
+        pacer.acquire()
+        pacer.acquire(print, 'waiting')
+        self.assertEqual(pacer.take(), [(print, ('waiting', ))])
+        pacer.release()
+        self.assertEqual(pacer.sending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
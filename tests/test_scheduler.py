@@ -0,0 +1,94 @@
+import threading
+import time
+import unittest
+
+from logdna.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_call_later(self):
+        called = threading.Event()
+        call = self.scheduler.call_later(0.01, called.set)
+        self.assertTrue(called.wait(1))
+        self.assertTrue(call.done)
+
+    def test_call_order(self):
+        calls = []
+        done = threading.Event()
+        self.scheduler.call_later(0.05, done.set)
+        self.scheduler.call_later(0.03, calls.append, 3)
+        self.scheduler.call_later(0.01, calls.append, 1)
+        self.scheduler.call_later(0.02, calls.append, 2)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_cancel(self):
+        calls = []
+        done = threading.Event()
+        call = self.scheduler.call_later(0.01, calls.append, 1)
+        call.cancel()
+        self.scheduler.call_later(0.02, done.set)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [])
+        self.assertFalse(call.done)
+
+    def test_remaining(self):
+        call = self.scheduler.call_later(10, lambda: None)
+        self.assertGreater(call.remaining(), 9)
+        self.assertLessEqual(call.remaining(), 10)
+
+    def test_error_does_not_stop_scheduler(self):
+        done = threading.Event()
+        self.scheduler.call_later(0, lambda: 1 / 0)
+        self.scheduler.call_later(0.01, done.set)
+        self.assertTrue(done.wait(1))
+
+    def test_single_thread(self):
+        before = threading.active_count()
+        events = [threading.Event() for _ in range(20)]
+        for event in events:
+            self.scheduler.call_later(0, event.set)
+            event.wait(1)
+        self.assertTrue(all(event.is_set() for event in events))
+        self.assertEqual(threading.active_count(), before + 1)
+
+    def test_take(self):
+        calls = []
+        done = threading.Event()
+        self.scheduler.call_later(0.05, calls.append, 1)
+        self.scheduler.call_later(0.05, calls.append, 2)
+        self.scheduler.call_later(0.1, done.set)
+        taken = self.scheduler.take(calls.append)
+        self.assertEqual(sorted(call.args for call in taken), [(1, ), (2, )])
+        self.assertEqual(self.scheduler.take(calls.append), [])
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [])
+
+    def test_client_shutdown(self):
+        calls = []
+        done = threading.Event()
+        first = self.scheduler.client()
+        second = self.scheduler.client()
+        first.call_later(0.05, calls.append, 1)
+        second.call_later(0.05, calls.append, 2)
+        second.call_later(0.1, done.set)
+        first.shutdown()
+        with self.assertRaises(RuntimeError):
+            first.call_later(0, calls.append, 3)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [2])
+
+    def test_shutdown(self):
+        calls = []
+        self.scheduler.call_later(0.05, calls.append, 1)
+        self.scheduler.shutdown()
+        time.sleep(0.1)
+        self.assertEqual(calls, [])
+        with self.assertRaises(RuntimeError):
+            self.scheduler.call_later(0, calls.append, 2)
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from benchmarks.ingest_server import IngestServer
+from logdna import ForwardingLogDNAHandler, LogShipper
+from logdna.configs import defaults
+from unittest import mock
+
+
+def record(line):
+    return logging.LogRecord('test', logging.INFO, 'test', 1, line, (), None)
+
+
+def forward_lines(address, count):
+    handler = ForwardingLogDNAHandler(address, {'app': 'worker'})
+    for i in range(count):
+        handler.emit(record('%d %d' % (os.getpid(), i)))
+    handler.close()
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+class LogShipperTest(unittest.TestCase):
+    def setUp(self):
+        self.server = IngestServer().start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.tmpdir.name, 'shipper.sock')
+        self.shipper = LogShipper(None, self.address, {
+            'url': self.server.url,
+            'hostname': 'shipper',
+            'ip': '127.0.0.1',
+            'flush_interval': 10
+        }).start()
+
+    def tearDown(self):
+        self.shipper.close()
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_forwards_lines(self):
+        forward_lines(self.address, 100)
+        self.shipper.close()
+        self.assertEqual(self.server.lines, 100)
+        self.assertEqual(self.server.requests, 1)
+
+        line = self.server.last_body['ls'][0]
+        self.assertEqual(line['app'], 'worker')
+        self.assertEqual(line['line'], '%d 0' % os.getpid())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_one_shipper_for_many_processes(self):
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=forward_lines, args=(self.address, 200))
+            for _ in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+            self.assertEqual(worker.exitcode, 0)
+
+        self.shipper.close()
+        self.assertEqual(self.server.lines, 1600)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_close_reports(self):
+        handler = ForwardingLogDNAHandler(self.address)
+        for i in range(3):
+            handler.emit(record(str(i)))
+        self.assertIsNone(handler.flush())
+        self.assertEqual(handler.flush(1)['lines_sent'], 0)
+        report = handler.close(1)
+        self.assertTrue(report['flushed'])
+        self.assertEqual(report['batches_pending'], 0)
+
+    def test_drops_lines_without_shipper(self):
+        self.shipper.close()
+        handler = ForwardingLogDNAHandler(self.address)
+        started = time.monotonic()
+        handler.emit(record('dropped'))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNone(handler.sock)
+        handler.close()
+
+    def test_replaces_stale_socket(self):
+        self.shipper.close()
+        open(self.address, 'w').close()
+        self.shipper = LogShipper(None, self.address,
+                                  {'url': self.server.url}).start()
+        forward_lines(self.address, 1)
+        self.shipper.close()
+        self.assertEqual(self.server.lines, 1)
+
+    @mock.patch.dict(defaults, SHIPPER_MAX_DATAGRAM=1024)
+    def test_long_lines(self):
+        self.shipper.close()
+        self.shipper = LogShipper(None, self.address,
+                                  {'url': self.server.url}).start()
+
+        # Lines are cut down to fit in a datagram
+        handler = ForwardingLogDNAHandler(self.address)
+        handler.emit(record('x' * 2000))
+        handler.emit(record('short'))
+        self.assertEqual(handler.stats()['lines_truncated'], 1)
+        handler.close()
+
+        # and datagrams that did not fit are not parsed
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'{"line": "%s"}' % (b'y' * 2000), self.address)
+        self.shipper.close()
+        self.assertEqual(self.shipper.stats()['lines_dropped'],
+                         {'truncated': 1})
+        self.assertEqual(self.server.lines, 2)
+        lines = [line['line'] for line in self.server.last_body['ls']]
+        self.assertEqual(lines[1], 'short')
+        self.assertTrue(lines[0].startswith('xxx'))
+        self.assertLess(len(lines[0]), 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import time
+import unittest
+
+from logdna.spool import DiskSpool
+
+MAX_BYTES = 1024 * 1024
+MAX_AGE = 60
+SEGMENT_BYTES = 64
+
+
+class DiskSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.spool = self.open()
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp.cleanup()
+
+    def open(self, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        return DiskSpool(self.dir, max_bytes, max_age, SEGMENT_BYTES)
+
+    def drain(self, spool):
+        payloads = []
+        while True:
+            entry = spool.peek()
+            if entry is None:
+                return payloads
+            token, payload = entry
+            payloads.append(payload)
+            spool.commit(token)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.dir)
+                      if name.endswith('.spool'))
+
+    def test_replay_in_order(self):
+        payloads = [('batch %d' % i).encode() * 5 for i in range(10)]
+        for payload in payloads:
+            self.spool.append(payload)
+        self.assertTrue(self.spool.pending())
+        self.assertGreater(len(self.segments()), 1)
+
+        self.assertEqual(self.drain(self.spool), payloads)
+        self.assertFalse(self.spool.pending())
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.spool.size, 0)
+
+    def test_peek_without_commit(self):
+        self.spool.append(b'first')
+        self.spool.append(b'second')
+        self.assertEqual(self.spool.peek()[1], b'first')
+        self.assertEqual(self.spool.peek()[1], b'first')
+
+    def test_recover(self):
+        for i in range(6):
+            self.spool.append(('batch %d' % i).encode() * 5)
+        token, _ = self.spool.peek()
+        self.spool.commit(token)
+        self.spool.close()
+
+        spool = self.open()
+        self.assertEqual(self.drain(spool),
+                         [('batch %d' % i).encode() * 5 for i in range(1, 6)])
+        spool.close()
+
+    def test_recover_torn_frame(self):
+        self.spool.append(b'complete')
+        self.spool.append(b'torn')
+        self.spool.close()
+
+        path = os.path.join(self.dir, self.segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(size - 2)
+
+        spool = self.open()
+        self.assertEqual(os.path.getsize(path), size - 12)
+        spool.append(b'after')
+        self.assertEqual(self.drain(spool), [b'complete', b'after'])
+        spool.close()
+
+    def test_recover_corrupt_frame(self):
+        self.spool.append(b'complete')
+        self.spool.append(b'corrupt')
+        self.spool.close()
+
+        path = os.path.join(self.dir, self.segments()[-1])
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+
+        spool = self.open()
+        self.assertEqual(self.drain(spool), [b'complete'])
+        spool.close()
+
+    def test_max_bytes(self):
+        spool = self.open(max_bytes=3 * SEGMENT_BYTES)
+        for i in range(20):
+            spool.append(('batch %02d' % i).encode() * 8)
+        self.assertLessEqual(spool.size, 4 * SEGMENT_BYTES)
+        self.assertGreater(spool.dropped_batches, 0)
+
+        payloads = self.drain(spool)
+        self.assertEqual(payloads[-1], b'batch 19' * 8)
+        self.assertEqual(len(payloads) + spool.dropped_batches, 20)
+        spool.close()
+
+    def test_max_age(self):
+        self.spool.append(b'old')
+        self.spool.append(b'old' * 30)
+        old = time.time() - MAX_AGE - 1
+        for name in self.segments():
+            os.utime(os.path.join(self.dir, name), (old, old))
+        self.assertIsNone(self.spool.peek())
+        self.assertEqual(self.spool.dropped_batches, 2)
+        self.assertFalse(self.spool.pending())
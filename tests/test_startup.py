@@ -0,0 +1,74 @@
+import json
+import logging.config
+import logging.handlers
+import os
+import subprocess
+import sys
+import unittest
+
+# Run in a fresh interpreter, so that nothing has been imported yet
+IMPORT = '''
+import json, sys
+before = set(sys.modules)
+import logdna
+%s
+print(json.dumps(sorted(set(sys.modules) - before)))
+'''
+
+CONSTRUCT = '''
+import json, sys, threading
+import logdna
+threads = threading.active_count()
+modules = set(sys.modules)
+handlers = [logdna.LogDNAHandler('key') for _ in range(%d)]
+print(json.dumps({
+    'modules': sorted(set(sys.modules) - modules),
+    'threads': threading.active_count() - threads,
+    'sessions': sum(h._session is not None for h in handlers),
+    'ips': sum(h._ip is not None for h in handlers)
+}))
+for handler in handlers:
+    handler.close()
+'''
+
+HANDLERS = 100
+
+
+def measure(script):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=root)
+    return json.loads(output)
+
+
+class StartupTest(unittest.TestCase):
+    def test_import(self):
+        # Neither asyncio nor requests is imported with the package
+        modules = measure(IMPORT % '')
+        self.assertNotIn('asyncio', modules)
+        self.assertNotIn('requests', modules)
+        self.assertNotIn('logdna.aio', modules)
+
+        # The asyncio handler is imported when asked for
+        modules = measure(IMPORT % 'logdna.AsyncLogDNAHandler')
+        self.assertIn('asyncio', modules)
+        self.assertIn('logdna.aio', modules)
+        from logdna.aio import AsyncLogDNAHandler
+        configurator = logging.config.BaseConfigurator({})
+        self.assertIs(configurator.resolve('logdna.AsyncLogDNAHandler'),
+                      AsyncLogDNAHandler)
+        self.assertFalse(hasattr(logging.handlers, 'AsyncLogDNAHandler'))
+
+    def test_construction(self):
+        constructed = measure(CONSTRUCT % HANDLERS)
+        # Threads, connection pools and the IP are left to first use
+        self.assertEqual(constructed['threads'], 0)
+        self.assertEqual(constructed['sessions'], 0)
+        self.assertEqual(constructed['ips'], 0)
+        # Nor are requests and its dependencies imported
+        self.assertNotIn('requests', constructed['modules'])
+        self.assertNotIn('urllib3', constructed['modules'])
+
+
+if __name__ == '__main__':
+    unittest.main()
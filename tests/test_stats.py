@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+from logdna.stats import Stats
+
+
+class StatsTest(unittest.TestCase):
+    def test_merges_threads(self):
+        stats = Stats()
+        ready = threading.Barrier(5)
+        done = threading.Event()
+
+        def count():
+            for _ in range(1000):
+                stats.incr('lines_in')
+            stats.incr(('status_codes', 200), 2)
+            ready.wait()
+            done.wait()
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['lines_in'], 4000)
+        self.assertEqual(snapshot['status_codes'], {200: 8})
+
+        # Counts of threads that have exited are kept
+        done.set()
+        for thread in threads:
+            thread.join()
+        stats.incr('lines_in')
+        self.assertEqual(stats.snapshot()['lines_in'], 4001)
+        self.assertEqual(len(stats._shards), 1)
+
+    def test_snapshot_defaults(self):
+        snapshot = Stats().snapshot()
+        self.assertEqual(snapshot['lines_sent'], 0)
+        self.assertEqual(snapshot['lines_dropped'], {})
+        self.assertEqual(sum(snapshot['request_latency'].values()), 0)
+
+    def test_histogram(self):
+        stats = Stats()
+        for latency in (0.001, 0.2, 0.2, 60):
+            stats.observe('request_latency', latency)
+        snapshot = stats.snapshot()
+        latency = snapshot['request_latency']
+        self.assertEqual(latency[0.005], 1)
+        self.assertEqual(latency[0.25], 2)
+        self.assertEqual(latency[float('inf')], 1)
+        self.assertAlmostEqual(snapshot['request_latency_sum'], 60.401)
+
+
+if __name__ == '__main__':
+    unittest.main()
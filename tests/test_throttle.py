@@ -0,0 +1,85 @@
+import logging
+import unittest
+
+from logdna.throttle import Deduplicator, RateLimiter
+
+
+def record(msg, name='test', level=logging.ERROR):
+    return logging.LogRecord(name, level, 'test', 1, msg, (), None)
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def test_collapses_repeats_within_window(self):
+        dedup = Deduplicator(10, 100)
+        self.assertTrue(dedup.admit(record('failed %s'), 0))
+        for now in range(1, 10):
+            self.assertFalse(dedup.admit(record('failed %s'), now))
+        self.assertEqual(dedup.suppressed, 9)
+        self.assertEqual(dedup.take_repeated(), [])
+
+        # Other loggers, levels and messages are not repeats
+        self.assertTrue(dedup.admit(record('failed %s', name='other'), 1))
+        self.assertTrue(
+            dedup.admit(record('failed %s', level=logging.INFO), 1))
+        self.assertTrue(dedup.admit(record('done'), 1))
+
+        # A new window starts once this one is over
+        last = record('failed %s')
+        dedup.admit(last, 9.5)
+        self.assertTrue(dedup.admit(record('failed %s'), 10))
+        self.assertEqual(dedup.take_repeated(), [(last, 10)])
+        self.assertEqual(dedup.suppressed, 0)
+
+    def test_expire(self):
+        dedup = Deduplicator(10, 100)
+        for now in range(3):
+            dedup.admit(record('first'), now)
+            dedup.admit(record('second'), now + 5)
+        dedup.expire(12)
+        repeated = dedup.take_repeated()
+        self.assertEqual([(r.msg, n) for r, n in repeated], [('first', 2)])
+        dedup.expire(float('inf'))
+        repeated = dedup.take_repeated()
+        self.assertEqual([(r.msg, n) for r, n in repeated], [('second', 2)])
+
+    def test_bounded(self):
+        dedup = Deduplicator(10, 3)
+        for i in range(10):
+            dedup.admit(record(str(i)), 0)
+            dedup.admit(record(str(i)), 0)
+        self.assertEqual(len(dedup._windows), 3)
+        self.assertEqual(len(dedup.take_repeated()), 7)
+
+    def test_non_string_messages_pass(self):
+        dedup = Deduplicator(10, 100)
+        for _ in range(3):
+            self.assertTrue(dedup.admit(record({'key': 'value'}), 0))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_token_bucket_per_logger(self):
+        limiter = RateLimiter(10, 5, 100)
+        admitted = [limiter.admit('a', 0) for _ in range(8)]
+        self.assertEqual(admitted, [True] * 5 + [False] * 3)
+        self.assertTrue(limiter.admit('b', 0))
+
+        # Refills at rate
+        self.assertTrue(limiter.admit('a', 0.1))
+        self.assertFalse(limiter.admit('a', 0.1))
+        self.assertEqual(limiter.take_dropped(), {'a': 4})
+        self.assertEqual(limiter.take_dropped(), {})
+
+        # Up to burst
+        self.assertEqual(
+            sum(limiter.admit('a', 100) for _ in range(10)), 5)
+
+    def test_bounded(self):
+        limiter = RateLimiter(1, 1, 2)
+        for name in 'abc':
+            limiter.admit(name, 0)
+        self.assertEqual(list(limiter._buckets), ['b', 'c'])
+        self.assertTrue(limiter.admit('a', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,16 @@
+import email.utils
+import gzip
+import json
+import time
 import unittest
 from unittest.mock import patch
 from logdna.utils import is_jsonable
 from logdna.utils import sanitize_meta
 from logdna.utils import get_ip
 from logdna.utils import normalize_list_option
+from logdna.utils import compress, zstandard
+from logdna.utils import iter_compressed
+from logdna.utils import parse_retry_after
 
 IP = '10.0.50.10'
 VIP = '10.1.60.20'
@@ -38,6 +45,29 @@ class SanitizeTest(unittest.TestCase):
             '__errors': 'These keys have been sanitized: baz'
         })
 
+    def test_sanitize_not_indexed(self):
+        clean = sanitize_meta(self.valid)
+        self.assertEqual(json.loads(clean), self.valid)
+
+        clean = sanitize_meta(self.invalid)
+        self.assertEqual(json.loads(clean), {
+            'bar': 'foo',
+            '__errors': 'These keys have been sanitized: baz'
+        })
+
+    def test_sanitize_invalid_key(self):
+        clean = sanitize_meta({'bar': 'foo', ('baz', ): 'whizbang'}, True)
+        self.assertDictEqual(clean, {
+            'bar': 'foo',
+            '__errors': "These keys have been sanitized: ('baz',)"
+        })
+
+    def test_sanitize_serializes_once(self):
+        with patch('json.dumps', side_effect=json.dumps) as dumps_mock:
+            sanitize_meta(dict(self.valid), True)
+            sanitize_meta(dict(self.valid))
+            self.assertEqual(dumps_mock.call_count, 2)
+
 
 class IPTest(unittest.TestCase):
     @patch('socket.socket', **{'return_value.connect.side_effect': OSError()})
@@ -59,3 +89,43 @@ class NormalizeListOptionTest(unittest.TestCase):
         self.assertEqual(value1, ['a', 'b'])
         self.assertEqual(value1, value2)
         self.assertEqual(value3, [])
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('5'), 5)
+        self.assertEqual(parse_retry_after(' 0 '), 0)
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(date), 30, delta=2)
+        self.assertEqual(
+            parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        for value in (None, '', 'soon', '-1', '1.5'):
+            self.assertIsNone(parse_retry_after(value))
+
+
+class CompressTest(unittest.TestCase):
+    def test_compress_gzip(self):
+        body = b'{"e": "ls", "ls": []}' * 100
+        self.assertEqual(gzip.decompress(compress(body, 'gzip')), body)
+        self.assertEqual(gzip.decompress(compress(body, 'gzip', 1)), body)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_compress_zstd(self):
+        body = b'{"e": "ls", "ls": []}' * 100
+        compressed = compress(body, 'zstd')
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(
+            zstandard.ZstdDecompressor().decompress(compressed), body)
+
+    def test_iter_compressed_gzip(self):
+        chunks = [b'{"e": "ls", "ls": []}'] * 100
+        compressed = b''.join(iter_compressed(iter(chunks), 'gzip'))
+        self.assertEqual(gzip.decompress(compressed), b''.join(chunks))
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_iter_compressed_zstd(self):
+        chunks = [b'{"e": "ls", "ls": []}'] * 100
+        compressed = b''.join(iter_compressed(iter(chunks), 'zstd'))
+        self.assertEqual(
+            zstandard.ZstdDecompressor().decompressobj().decompress(
+                compressed), b''.join(chunks))